@@ -0,0 +1,93 @@
+"""
+Memory and perplexity of the quantized kv cache (sample.py --kv_cache_quant_bits).
+
+Windows of val.bin are evaluated with the kv cache in the loop: a prefill and
+then chunks of chunk_size tokens, each attending to the keys and values cached
+so far. The same windows are run with a float cache and with every requested
+quantization, and the cache memory and perplexity delta are reported.
+
+Example:
+    python3 benchmarks/kv_cache_quant.py --out_dir out --device cpu --bits 8 4
+"""
+import argparse
+import math
+import os
+import sys
+from contextlib import nullcontext
+
+import numpy as np
+import torch
+from torch.nn import functional as F
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from sample import load_checkpoint_model, load_validation_data
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the quantized kv cache against a float cache")
+    parser.add_argument("--out_dir", type=str, default="out", help="Directory to load checkpoint from")
+    parser.add_argument("--dataset", type=str, default=None, help="Dataset with val.bin (or val_shards/), default the checkpoint's dataset")
+    parser.add_argument("--device", type=str, default="cuda", help="Device to run on (e.g., 'cpu', 'cuda')")
+    parser.add_argument("--dtype", type=str, default="float32", choices=["bfloat16", "float16", "float32"], help="Torch data type for inference")
+    parser.add_argument("--bits", type=int, nargs="+", default=[8, 4], choices=[8, 4], help="Cache precisions to compare with the float cache")
+    parser.add_argument("--quant_method", type=str, default="symmetric_quant", choices=["symmetric_quant", "affine_quant"], help="Quantization of the cached keys and values")
+    parser.add_argument("--group_size", type=int, default=None, help="Head channels sharing a scale, default the whole head")
+    parser.add_argument("--num_windows", type=int, default=20, help="Windows of block_size tokens evaluated")
+    parser.add_argument("--prefill", type=int, default=None, help="Tokens prefilled at once, default block_size // 4")
+    parser.add_argument("--chunk_size", type=int, default=8, help="Tokens fed per cached forward after the prefill")
+    return parser.parse_args()
+
+
+def cached_loss(model, x, y, kv_cache, prefill, chunk_size):
+    """Mean cross entropy of y given x, fed through kv_cache in a prefill and chunks."""
+    logits = []
+    for start in [0] + list(range(prefill, x.size(1), chunk_size)):
+        end = prefill if start == 0 else min(start + chunk_size, x.size(1))
+        chunk_logits, _ = model(x[:, start:end], kv_cache=kv_cache, full_logits=True)
+        logits.append(chunk_logits)
+    logits = torch.cat(logits, dim=1)
+    return F.cross_entropy(logits.view(-1, logits.size(-1)).float(), y.view(-1)).item()
+
+
+def main():
+    args = parse_args()
+    device_type = 'cuda' if 'cuda' in args.device else 'cpu'
+    ptdtype = {'bfloat16': torch.bfloat16, 'float16': torch.float16, 'float32': torch.float32}[args.dtype]
+    ctx = nullcontext() if device_type == 'cpu' else torch.amp.autocast(device_type=device_type, dtype=ptdtype)
+
+    model, checkpoint = load_checkpoint_model(args.out_dir, args.device)
+    if model.init_kv_cache(1) is None:
+        sys.exit(f"attention_variant {model.config.attention_variant} has no kv cache support")
+    dataset = args.dataset if args.dataset else checkpoint['config']['dataset']
+    val_data = load_validation_data(dataset, model.config.vocab_size)
+
+    block_size = model.config.block_size
+    prefill = args.prefill if args.prefill else max(1, block_size // 4)
+    starts = np.linspace(0, len(val_data) - block_size - 1, args.num_windows).astype(np.int64)
+
+    configs = [("float", None)] + [(f"int{bits}", bits) for bits in args.bits]
+    results = {}
+    with torch.no_grad():
+        with ctx:
+            for name, bits in configs:
+                losses = []
+                memory = 0
+                for i in starts:
+                    window = torch.from_numpy(val_data[i:i + block_size + 1].astype(np.int64)).to(args.device)
+                    x, y = window[None, :-1], window[None, 1:]
+                    kv_cache = model.init_kv_cache(1, quant_bits=bits, quant_method=args.quant_method, quant_group_size=args.group_size)
+                    losses.append(cached_loss(model, x, y, kv_cache, prefill, args.chunk_size))
+                    memory = kv_cache.memory_bytes()
+                results[name] = (float(np.mean(losses)), memory)
+
+    base_loss, base_memory = results["float"]
+    print(f"{len(starts)} windows of {block_size} tokens from {dataset} val, prefill {prefill}, chunks of {args.chunk_size}")
+    print(f"{'cache':<8}{'KiB':>12}{'saved':>9}{'loss':>10}{'ppl':>10}{'ppl delta':>11}")
+    for name, (loss, memory) in results.items():
+        saved = 1 - memory / base_memory
+        ppl_delta = math.exp(loss) - math.exp(base_loss)
+        print(f"{name:<8}{memory / 1024:>12.1f}{saved:>8.1%}{loss:>10.4f}{math.exp(loss):>10.3f}{ppl_delta:>+11.4f}")
+
+
+if __name__ == "__main__":
+    main()
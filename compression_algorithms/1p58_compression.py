@@ -46,31 +46,20 @@ def pack_trits(digits: np.ndarray) -> bytearray:
     Pack a numpy array of ternary values (-1, 0, 1) into bytes.
     Each group of 5 trits maps onto one byte.
 
-    Steps:
+    Steps (vectorized over all groups):
     1. Convert each trit from {-1,0,1} to {0,1,2}.
     2. Combine each group of 5 ternary digits into a single base-3 integer (0..242).
-    3. Scale that integer into a byte [0..255] using encode_five_trits_to_byte.
+    3. Scale that integer into a byte [0..255] as in encode_five_trits_to_byte.
     """
     assert len(digits) % 5 == 0, "Input length must be multiple of 5."
-    n_groups = len(digits) // 5
 
-    packed = bytearray()
-    for i in range(n_groups):
-        group_val = 0
-        # Aggregate 5 trits into a base-3 number:
-        for j in range(5):
-            trit = int(digits[5*i + j])
-            # Map -1,0,1 to 0,1,2
-            normalized = (max(-1, min(trit, 1))) + 1
-            group_val = group_val * 3 + normalized
+    # Map -1,0,1 to 0,1,2, one row per group of 5
+    groups = np.clip(np.asarray(digits), -1, 1).astype(np.int32).reshape(-1, 5) + 1
+    group_vals = groups @ np.array([81, 27, 9, 3, 1], dtype=np.int32)
 
-        # Convert this 0..242 range value into one byte.
-        encoded = encode_five_trits_to_byte(group_val)
-        packed.append(encoded)
-
-    return packed
-
-from typing import Union
+    # Convert the 0..242 range values into bytes.
+    encoded = (group_vals * 256 + (243 - 1)) // 243
+    return bytearray(encoded.astype(np.uint8).tobytes())
 
 def unpack_trits(packed: Union[bytes, bytearray]) -> np.ndarray:
     """
@@ -79,19 +68,17 @@ def unpack_trits(packed: Union[bytes, bytearray]) -> np.ndarray:
     We reverse the packing:
     - Each byte represents 5 trits.
     - Repeatedly multiply by 3, extract the top bits for the current trit,
-      and keep the remaining bits for the next extraction.
+      and keep the remaining bits for the next extraction, for all bytes at once.
     """
-    trits = []
-    for enc_byte in packed:
-        b = enc_byte
-        for _ in range(5):
-            # Multiply by 3 to shift and extract the high bits as a trit:
-            temp = b * 3
-            extracted_trit = (temp >> 8) - 1  # map 0,1,2 back to -1,0,1
-            trits.append(extracted_trit)
-            # Keep lower 8 bits for next iteration
-            b = temp & 0xFF
-    return np.array(trits, dtype=np.int8)
+    b = np.frombuffer(bytes(packed), dtype=np.uint8).astype(np.int16)
+    trits = np.empty((len(b), 5), dtype=np.int8)
+    for i in range(5):
+        # Multiply by 3 to shift and extract the high bits as a trit:
+        temp = b * 3
+        trits[:, i] = (temp >> 8) - 1  # map 0,1,2 back to -1,0,1
+        # Keep lower 8 bits for next iteration
+        b = temp & 0xFF
+    return trits.reshape(-1)
 
 def print_comparison(original: np.ndarray, packed: bytearray):
     """
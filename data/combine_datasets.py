@@ -1,16 +1,37 @@
 import numpy as np
 import argparse
 import os
+import shutil
+import sys
 
-def combine_binaries(file_paths, output_file):
-    """Combine binary files from provided paths into a single file."""
-    combined_data = []
-    for file_path in file_paths:
-        data = np.fromfile(file_path, dtype=np.uint16)  # Adjust dtype if needed
-        combined_data.append(data)
-    combined_data = np.concatenate(combined_data)
-    combined_data.tofile(output_file)
-    print(f"Combined {len(file_paths)} files into {output_file} with {len(combined_data)} entries.")
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')))
+from utils.token_shards import NO_HASH, ShardWriter, load_tokens, tokenizer_hash
+
+def combine_binaries(dirs, split, output_dir, shard_size=None):
+    """Combine the split (train.bin or its shards) of every directory into output_dir, in one dtype."""
+    datasets = []
+    for dir in dirs:
+        try:
+            datasets.append(load_tokens(dir, split))
+        except ValueError as e:
+            sys.exit(f"Error: {e}")
+    dtypes = {data.dtype for data in datasets}
+    if len(dtypes) > 1:
+        sys.exit(f"Error: {split} of {dirs} are in different token dtypes {sorted(str(d) for d in dtypes)}, were they tokenized the same way?")
+    dtype = dtypes.pop()
+    total = sum(len(data) for data in datasets)
+    if shard_size:
+        writer = ShardWriter(os.path.join(output_dir, f"{split}_shards"), split, dtype, shard_size, tokenizer_hash(os.path.join(dirs[0], "meta.pkl")))
+        for data in datasets:
+            writer.write(data[:])
+        writer.close()
+        output_file = os.path.join(output_dir, f"{split}_shards")
+    else:
+        output_file = os.path.join(output_dir, f"{split}.bin")
+        with open(output_file, 'wb') as f_out:
+            for data in datasets:
+                np.asarray(data[:], dtype=dtype).tofile(f_out)
+    print(f"Combined {len(dirs)} {split} splits into {output_file} with {total} {dtype} entries.")
 
 def main():
     parser = argparse.ArgumentParser(
@@ -21,7 +42,7 @@ def main():
         type=str,
         nargs='+',
         required=True,
-        help="List of directories containing train.bin and val.bin files",
+        help="List of directories containing train.bin and val.bin files (or train_shards/ and val_shards/)",
     )
     parser.add_argument(
         "--output_dir",
@@ -29,24 +50,29 @@ def main():
         default="output",
         help="Directory to save the combined train and validation binary data files",
     )
+    parser.add_argument(
+        "--shard_size",
+        type=int,
+        default=None,
+        help="Write train_shards/ and val_shards/ of this many tokens per shard instead of train.bin and val.bin",
+    )
 
     args = parser.parse_args()
 
+    # The token dtype of each directory comes from its shard headers or its meta.pkl,
+    # which all directories have to share
+    hashes = {tokenizer_hash(os.path.join(dir, "meta.pkl")) for dir in args.dirs}
+    if len(hashes) > 1:
+        sys.exit(f"Error: the meta.pkl files of {args.dirs} differ, the datasets were tokenized differently")
+
     # Create output directory if it doesn't exist
     os.makedirs(args.output_dir, exist_ok=True)
-
-    # Generate file paths for train and validation binaries
-    train_files = [os.path.join(dir, "train.bin") for dir in args.dirs]
-    val_files = [os.path.join(dir, "val.bin") for dir in args.dirs]
-
-    # Specify output files for combined binaries
-    output_train_file = os.path.join(args.output_dir, "train.bin")
-    output_val_file = os.path.join(args.output_dir, "val.bin")
+    if hashes != {NO_HASH}:
+        shutil.copy(os.path.join(args.dirs[0], "meta.pkl"), os.path.join(args.output_dir, "meta.pkl"))
 
     # Combine train and validation binaries
-    combine_binaries(train_files, output_train_file)
-    combine_binaries(val_files, output_val_file)
+    combine_binaries(args.dirs, "train", args.output_dir, args.shard_size)
+    combine_binaries(args.dirs, "val", args.output_dir, args.shard_size)
 
 if __name__ == "__main__":
     main()
-
@@ -1,5 +1,6 @@
 import json
 import os
+import sys
 import argparse
 import numpy as np
 from tokenizers import (
@@ -13,6 +14,10 @@ from tokenizers import (
 from tqdm import tqdm
 import os
 
+# repository root, for the token shard format shared with train.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..')))
+from utils.token_shards import ShardWriter, tokenizer_hash
+
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description="Tokenize text data using different methods.")
@@ -41,9 +46,28 @@ def parse_arguments():
     parser.add_argument("--numeric_range", action="store_true", help="Use numeric range tokenization method")
     parser.add_argument("--min_token", type=int, default=0, help="Minimum value for numeric tokens")
     parser.add_argument("--max_token", type=int, default=65535, help="Maximum value for numeric tokens")
+    # Document boundaries, for train.py --pack_documents
+    parser.add_argument("--document_separator", type=str, default=None, help="Text ending each document (e.g. '\\n\\n'), writes the token offset of every document start to <output>_docs.bin")
+    # Sharded output, read by train.py in place of train.bin / val.bin
+    parser.add_argument("--shard_size", type=int, default=None, help="Write each split as shards of this many tokens with self describing headers plus a manifest, in <output>_shards/ (e.g. train_shards/)")
     return parser.parse_args()
 
 
+def document_starts(ids, separator_ids):
+    """
+    Token offsets of the document starts: 0 and every position right after
+    the tokens of the separator. A separator merged into other tokens by the
+    tokenizer is not found, those documents stay joined.
+    """
+    ids = np.asarray(ids)
+    n = len(separator_ids)
+    match = np.ones(max(len(ids) - n + 1, 0), dtype=bool)
+    for j, token in enumerate(separator_ids):
+        match &= ids[j:len(ids) - n + 1 + j] == token
+    ends = np.flatnonzero(match) + n
+    return np.concatenate(([0], ends[ends < len(ids)])).astype(np.int64)
+
+
 def save_args(args, out_dir):
     os.makedirs(out_dir, exist_ok=True)
     with open(os.path.join(out_dir, 'args.json'), 'w') as f:
@@ -118,9 +142,31 @@ def main():
     else:
         dtype = np.uint16
 
-    save_tokens(train_ids, args.train_output, dtype)
+    def save_shards(ids, output_file, dtype):
+        name = os.path.splitext(output_file)[0]
+        writer = ShardWriter(name + "_shards", os.path.basename(name), dtype, args.shard_size, tokenizer_hash("meta.pkl"))
+        batch_size = 1024 * 1024
+        for i in tqdm(range(0, len(ids), batch_size), desc=f"Saving {name}_shards"):
+            writer.write(ids[i:i+batch_size])
+        manifest = writer.close()
+        print(f"{name}_shards: {len(manifest['shards'])} shards, {manifest['total_tokens']} tokens")
+
+    save = save_shards if args.shard_size else save_tokens
+    save(train_ids, args.train_output, dtype)
     if val_data and val_ids:
-        save_tokens(val_ids, args.val_output, dtype)
+        save(val_ids, args.val_output, dtype)
+
+    if args.document_separator:
+        # np.int64 document start offsets next to each .bin, read by train.py --pack_documents
+        separator = args.document_separator.encode().decode("unicode_escape")
+        separator_ids = tokenizer.tokenize(separator)
+        outputs = [(train_ids, args.train_output)]
+        if val_data and val_ids:
+            outputs.append((val_ids, args.val_output))
+        for ids, output_file in outputs:
+            starts = document_starts(ids, separator_ids)
+            starts.tofile(os.path.splitext(output_file)[0] + "_docs.bin")
+            print(f"{output_file}: {len(starts)} documents, {len(ids) / len(starts):.1f} tokens per document")
 
 
 if __name__ == "__main__":
@@ -22,6 +22,10 @@ class GPTConfig:
     lsv_variant: str = "one_hot"
     apply_lsv_at_layer_idx: int = None
 
+    # Multi-token prediction (Medusa) heads
+    n_medusa_heads: int = 0
+    medusa_loss_weight: float = 0.2
+
     ## Files to insert or obtain vectors from
     apply_vector_file: str = None
     apply_vector_scaling_factor: float = 1.0
@@ -72,6 +76,7 @@ class GPTConfig:
 
     # Attention Options
     attention_variant: str = "causal"
+    linear_attn_chunk_size: int = None
 
     # MLP Options
     use_parallel_mlp: bool = False
@@ -244,6 +249,15 @@ class GPTConfig:
     linear_variant_attn_proj: str = None
     linear_variant_mlp_up: str = None
     linear_variant_mlp_down: str = None
+    linear_variant_lm_head: str = "linear"
+
+    ## bitlinear_1p58 packed inference (set by quantization/export_1p58.py)
+    bitlinear_1p58_packed: bool = False
+    bitlinear_1p58_tile_size: int = 256
+
+    ## int4_weight_only (filled by quantization/convert_int4.py)
+    int4_group_size: int = 128
+    int4_tile_size: int = 256
 
     ## Linear Initialization Options
     linear_mean_init: float= 0.0
@@ -295,6 +309,10 @@ class GPTConfig:
     quantize_mlp_act_output: bool = False
     quantize_mlp_act_output_bits: int = None
     store_activations: bool = False
+    # per layer overrides of the quantize_*_bits args, {"layer_idx": {arg: bits}} (quantization/bit_search.py)
+    quantization_layer_bits: dict = None
+    # activation scales frozen by post-training calibration (quantization/ptq.py)
+    static_activation_quant: bool = False
 
     ## Linear Quantizations
     quantize_linear_method: str = "affine_quant"
@@ -312,6 +330,7 @@ class GPTConfig:
     quantize_linear_mlp_down_method: str = None
     quantize_linear_mlp_down_bits: int = None
     quantization_warmup_iters: int = 100
+    quantize_linear_eval_path: str = "dequant"
 
     @classmethod
     def from_json(cls, filename: str):
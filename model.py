@@ -9,6 +9,7 @@ https://github.com/huggingface/transformers/blob/main/src/transformers/models/gp
 
 import math
 import inspect
+import dataclasses
 import sys
 import re
 from rich import print
@@ -27,7 +28,7 @@ from gpt_conf import GPTConfig
 import torch.utils.checkpoint as checkpoint
 
 # Variations
-from variations.attention_variations import attention_dictionary
+from variations.attention_variations import attention_dictionary, PackedSegments
 from variations.mlp_variations import get_mlp_instance
 from variations.moe_variations import MoELayer
 from variations.lsv_variations import lsv_dictionary
@@ -37,9 +38,28 @@ from variations.position_encoding_variations import QuantizedEmbedding, RotaryEm
 from variations.activation_variations import activation_dictionary
 from variations.linear_variations import linear_dictionary
 from variations.router_variations import router_dictionary
+from variations.kv_cache_variations import KVCache, PagedKVCache
+from variations.sampling_variations import TokenSampler
+from utils.streaming import StreamingDetokenizer, StopSequenceMatcher
+from variations.medusa_variations import MedusaHead, typical_acceptance
 from quantization.quantize import quantize_dictionary, dequantize, fake_quantize_act
 from quantization.quant_utils import set_variant, create_activation_buffers
 
+def quantization_layer_config(config, layer_idx):
+    """
+    config with the quantize_*_bits overrides of layer layer_idx from
+    config.quantization_layer_bits applied, e.g. a mixed precision allocation
+    from quantization/bit_search.py ({"0": {"quantize_linear_attn_q_bits": 4}, ...}).
+    """
+    if not config.quantization_layer_bits:
+        return config
+    overrides = config.quantization_layer_bits.get(str(layer_idx))
+    if not overrides:
+        return config
+    for arg in overrides:
+        assert arg.startswith("quantize_") and arg.endswith("_bits"), f"quantization_layer_bits only sets quantize_*_bits args, got {arg}"
+    return dataclasses.replace(config, **overrides)
+
 def create_shared_param_group(layer_type, config):
     """
     Creates a shared list of layer blocks (either MLP or Attn), optionally reusing blocks
@@ -87,18 +107,20 @@ def create_shared_param_group(layer_type, config):
 
         # Create a new layer block every "shared_size"
         if i % shared_size == 0:
+            # per layer quantization bits, if any
+            layer_config = quantization_layer_config(config, i)
             if layer_type == "mlp":
                 # Possibly handle MoE
                 if config.use_moe and i % config.moe_layer_freq == 0:
-                    layer_block = MoELayer(config)
+                    layer_block = MoELayer(layer_config)
                 else:
-                    layer_block = get_mlp_instance(config)
+                    layer_block = get_mlp_instance(layer_config)
 
             elif layer_type == "attn":
                 attn_cls = attention_dictionary[config.attention_variant]
 
                 # Instantiate an attention layer
-                layer_block = attn_cls(config, fire_pos_enc=fire_pos_enc)
+                layer_block = attn_cls(layer_config, fire_pos_enc=fire_pos_enc)
             else:
                 sys.exit(f"{layer_type} not supported, exiting")
 
@@ -150,21 +172,21 @@ class Block(nn.Module):
         else:
             self.mlp = mlp
 
-    def forward(self, x, iter_num):
+    def forward(self, x, iter_num, layer_cache=None, segments=None):
         def custom_forward(*inputs):
             x = inputs[0]
             if self.use_post_ln:
                 if self.use_parallel_mlp:
-                    x = self.ln_1(x + self.attn(x, iter_num) + self.mlp(x, iter_num))
+                    x = self.ln_1(x + self.attn(x, iter_num, layer_cache, segments) + self.mlp(x, iter_num))
                 else:
-                    x = self.ln_1(x + self.attn(x, iter_num))
+                    x = self.ln_1(x + self.attn(x, iter_num, layer_cache, segments))
                     x = self.ln_2(x + self.mlp(x, iter_num))
             else:
                 if self.use_parallel_mlp:
                     ln_1 = self.ln_1(x)
-                    x = x + self.attn(ln_1, iter_num) + self.mlp(ln_1, iter_num)
+                    x = x + self.attn(ln_1, iter_num, layer_cache, segments) + self.mlp(ln_1, iter_num)
                 else:
-                    x = x + self.attn(self.ln_1(x), iter_num)
+                    x = x + self.attn(self.ln_1(x), iter_num, layer_cache, segments)
                     x = x + self.mlp(self.ln_2(x), iter_num)
             return x
 
@@ -237,15 +259,23 @@ class GPT(nn.Module):
         if self.softmax_variant_output != "softmax":
             self.softmax_layer_output = softmax_dictionary[config.softmax_variant_output](config)
 
+        lm_head_variant = linear_dictionary[config.linear_variant_lm_head]
         if config.n_embd_wte:
-            self.lm_head = nn.Linear(config.n_embd_wte, config.vocab_size, bias=False)
+            self.lm_head = lm_head_variant(config.n_embd_wte, config.vocab_size, config, config.quantize_linear_method, config.quantize_linear_bits, bias=False)
         else:
-            self.lm_head = nn.Linear(config.n_embd, config.vocab_size, bias=False)
+            self.lm_head = lm_head_variant(config.n_embd, config.vocab_size, config, config.quantize_linear_method, config.quantize_linear_bits, bias=False)
         # with weight tying when using torch.compile() some warnings get generated:
         # "UserWarning: functional_call was passed multiple values for tied weights.
         # This behavior is deprecated and will be an error in future versions"
         # not 100% sure what this is, so far seems to be harmless. TODO investigate
-        self.transformer.wte.weight = self.lm_head.weight # https://paperswithcode.com/method/weight-tying
+        # (an int4_weight_only lm_head has no float weight, wte keeps its own)
+        if getattr(self.lm_head, "weight", None) is not None:
+            self.transformer.wte.weight = self.lm_head.weight # https://paperswithcode.com/method/weight-tying
+
+        # Multi-token prediction heads, sharing the lm_head
+        self.n_medusa_heads = config.n_medusa_heads
+        if self.n_medusa_heads > 0:
+            self.medusa_heads = nn.ModuleList([MedusaHead(config) for _ in range(self.n_medusa_heads)])
 
         # Initialize and possibly import scale_up and scale_down matrices, if factorization is set
         if self.n_embd_wte:
@@ -264,6 +294,11 @@ class GPT(nn.Module):
         # init all weights
         self.apply(self._init_weights)
 
+        # medusa heads start as identity, i.e. predicting like the lm_head
+        if self.n_medusa_heads > 0:
+            for head in self.medusa_heads:
+                torch.nn.init.zeros_(head.linear.weight)
+
         # import wte
         if self.config.import_wte_npy:
             # Replace wte with values from numpy and retie weights
@@ -309,7 +344,9 @@ class GPT(nn.Module):
 
     def _init_weights(self, module):
         if isinstance(module, nn.Linear):
-            torch.nn.init.normal_(module.weight, mean=self.config.linear_mean_init, std=self.config.linear_std_init)
+            # packed ternary layers (bitlinear_1p58_packed) have no float weight
+            if module.weight is not None:
+                torch.nn.init.normal_(module.weight, mean=self.config.linear_mean_init, std=self.config.linear_std_init)
             if module.bias is not None:
                 torch.nn.init.zeros_(module.bias)
         elif isinstance(module, nn.Embedding):
@@ -377,9 +414,105 @@ class GPT(nn.Module):
         np.savez(file_path, scale_up=scale_up_matrix, scale_down=scale_down_matrix)
         print(f"Scale matrices saved to {file_path}")
 
-    def forward(self, idx, targets=None, iter_num=None):
+    def init_kv_cache(self, batch_size, max_len=None, kv_pool=None, rolling=False, num_sink=0,
+                      quant_bits=None, quant_method="symmetric_quant", quant_group_size=None, rollback=False):
+        """
+        Create a KVCache for incremental decoding of batch_size sequences, paged
+        in the blocks of kv_pool (a KVBlockPool) if given. With rolling, sliding
+        window models get a ring buffer cache of window_size (+ num_sink pinned
+        attention sinks) positions, for generation of unbounded length. With
+        quant_bits (8 or 4) keys and values are stored quantized.
+        Linear attention gets its recurrent state instead of keys and values,
+        unless the caller needs to rollback (truncate) the cache.
+        Returns None for attention variants without cache support, in which
+        case callers fall back to recomputing the full context every step.
+        """
+        if self.config.attention_variant == "linear":
+            if rollback:
+                return None
+            return KVCache(self.config, batch_size, max_len=max_len, variant="linear_state")
+        if self.config.attention_variant != "causal":
+            return None
+        if quant_bits is not None:
+            assert kv_pool is None and not rolling, "quantized kv cache is only supported for the contiguous cache"
+            return KVCache(self.config, batch_size, max_len=max_len, variant="quantized",
+                           bits=quant_bits, quant_method=quant_method, group_size=quant_group_size)
+        if rolling:
+            assert self.config.window_size is not None, "rolling kv cache requires window_size"
+            assert not self.config.use_abs_pos_embeddings, "rolling kv cache positions grow past block_size, use relative position encodings"
+            return KVCache(self.config, batch_size, max_len=max_len, variant="rolling", num_sink=num_sink)
+        if kv_pool is not None:
+            return PagedKVCache(self.config, kv_pool, batch_size=batch_size, max_len=max_len)
+        return KVCache(self.config, batch_size, max_len=max_len)
+
+    def crop_idx_cond(self, idx, kv_cache=None):
+        """
+        Select the tokens to feed the model for the next decoding step.
+
+        Without a cache this is the usual crop to the last block_size tokens.
+        With a cache only the tokens not yet processed are returned. When these
+        would overflow the cache it is reset and re-prefilled with the last
+        block_size // 2 tokens, so the full recompute is paid only once every
+        block_size // 2 steps instead of on every step.
+
+        A pinned prefix of the cache (KVCache.pin_prefix) survives the refill:
+        the context becomes the prefix followed by the most recent tokens, and
+        only the recent part is recomputed. Recurrent state (linear attention)
+        cannot be rolled back to the prefix, it is reset and re-prefilled with
+        the prefix and the recent tokens.
+        """
+        block_size = self.config.block_size
+        if kv_cache is None:
+            return idx if idx.size(1) <= block_size else idx[:, -block_size:]
+
+        window = min(block_size, kv_cache.max_len)
+        seen = kv_cache.offset + kv_cache.seq_len
+        pinned = kv_cache.pinned
+        if pinned and idx.size(1) > pinned and (kv_cache.seq_len == 0 or idx.size(1) - seen > kv_cache.free_slots()):
+            if kv_cache.seq_len == 0:
+                keep = window - pinned
+            else:
+                keep = min(kv_cache.recent, window - pinned) if kv_cache.recent else max(1, (window - pinned) // 2)
+            keep = min(keep, idx.size(1) - pinned)
+            if kv_cache.seq_len >= pinned and kv_cache.rollback:
+                # the prefix is cached already, recompute only the recent tokens after it
+                kv_cache.drop_after_prefix(offset=idx.size(1) - keep - pinned)
+                return idx[:, -keep:]
+            kv_cache.reset(offset=idx.size(1) - keep - pinned)
+            return torch.cat((idx[:, :pinned], idx[:, -keep:]), dim=1)
+        if kv_cache.seq_len == 0 or idx.size(1) - seen > kv_cache.free_slots():
+            keep = window if kv_cache.seq_len == 0 else max(1, window // 2)
+            keep = min(keep, idx.size(1))
+            kv_cache.reset(offset=idx.size(1) - keep)
+            return idx[:, -keep:]
+        return idx[:, seen:]
+
+    def medusa_logits(self, x):
+        """Logits of every medusa head for final norm outputs x, shape (n_heads, B, T, vocab)."""
+        head_logits = []
+        for head in self.medusa_heads:
+            h = head(x)
+            if self.n_embd_wte:
+                h = F.linear(h, self.transformer.scale_down.weight.t())
+            head_logits.append(self.lm_head(h))
+        return torch.stack(head_logits)
+
+    def freeze_non_medusa_parameters(self):
+        """Freeze the backbone so only the medusa heads are trained."""
+
+        print("Freezing all parameters except for medusa_heads")
+
+        for name, param in self.named_parameters():
+            param.requires_grad = name.startswith("medusa_heads.")
+
+    def forward(self, idx, targets=None, iter_num=None, kv_cache=None, full_logits=False, return_medusa=False, segment_ids=None):
+        """segment_ids: optional (b, t) document of each token when several documents are packed
+        into a row, attention then stays within a document and positions restart at each one."""
         device = idx.device
         b, t = idx.size()
+        segments = None
+        if segment_ids is not None:
+            segments = PackedSegments(segment_ids, self.config.window_size, self.config.use_flex_attn)
         # assert t <= self.config.block_size, f"Cannot forward sequence of length {t}, block size is only {self.config.block_size}"
 
         # forward the GPT model itself
@@ -389,7 +522,12 @@ class GPT(nn.Module):
         if self.n_embd_wte:
             tok_emb = self.transformer.scale_up(tok_emb)
         if self.config.use_abs_pos_embeddings:
-            pos = torch.arange(0, t, dtype=torch.long, device=device) # shape (t)
+            if kv_cache is not None:
+                pos = kv_cache.positions(t, device).clamp(min=0) # shape (t) or (b, t) when left padded
+            elif segments is not None:
+                pos = segments.positions # shape (b, t), restarting at each document
+            else:
+                pos = torch.arange(0, t, dtype=torch.long, device=device) # shape (t)
             pos_emb = self.transformer.wpe(pos) # position embeddings of shape (t, n_embd)
             x = self.transformer.drop(tok_emb + pos_emb)
         else:
@@ -401,12 +539,13 @@ class GPT(nn.Module):
             x = self.lsv_matrix(x)
 
         layer = 1
-        for block in self.transformer.h:
+        for i, block in enumerate(self.transformer.h):
+            layer_cache = kv_cache.layers[i] if kv_cache is not None else None
             # Propagate tokens through layers
             if self.config.use_gradient_checkpointing:
-                x = checkpoint.checkpoint(block, x, iter_num, use_reentrant=self.config.recompute_backward_pass)
+                x = checkpoint.checkpoint(block, x, iter_num, layer_cache, segments, use_reentrant=self.config.recompute_backward_pass)
             else:
-                x = block(x, iter_num)
+                x = block(x, iter_num, layer_cache, segments)
 
             # Intercept for Learned Steering Vectors
             if self.use_lsv and layer == self.config.apply_lsv_at_layer_idx:
@@ -423,6 +562,7 @@ class GPT(nn.Module):
             layer +=1
 
         x = self.transformer.ln_f(x)
+        x_norm = x
 
         if self.n_embd_wte:
             x = F.linear(x, self.transformer.scale_down.weight.t())
@@ -431,11 +571,28 @@ class GPT(nn.Module):
             # if we are given some desired targets also calculate the loss
             logits = self.lm_head(x)
             loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.view(-1), ignore_index=-1)
+            if self.n_medusa_heads > 0:
+                # head i predicts the target i steps further along
+                head_logits = self.medusa_logits(x_norm)
+                medusa_loss = 0.0
+                for i in range(1, self.n_medusa_heads + 1):
+                    logits_i = head_logits[i - 1][:, :-i, :]
+                    medusa_loss = medusa_loss + F.cross_entropy(logits_i.reshape(-1, logits_i.size(-1)), targets[:, i:].reshape(-1), ignore_index=-1)
+                loss = loss + self.config.medusa_loss_weight * medusa_loss / self.n_medusa_heads
+        elif full_logits:
+            # logits for every input position, e.g. to verify several drafted tokens at once
+            logits = self.lm_head(x)
+            loss = None
         else:
             # inference-time mini-optimization: only forward the lm_head on the very last position
             logits = self.lm_head(x[:, [-1], :]) # note: using list [-1] to preserve the time dim
+            x_norm = x_norm[:, [-1], :]
             loss = None
 
+        if return_medusa and targets is None:
+            # (B, T, 1 + n_heads, vocab), regular next token logits first
+            logits = torch.cat((logits.unsqueeze(2), self.medusa_logits(x_norm).permute(1, 2, 0, 3)), dim=2)
+
         return logits, loss
 
     def set_lsv_scaling_factor(self, factor):
@@ -622,61 +779,303 @@ class GPT(nn.Module):
         return mfu
 
     @torch.no_grad()
-    def generate(self, idx, max_new_tokens, temperature=1.0, top_k=None):
+    def generate(self, idx, max_new_tokens, temperature=1.0, top_k=None, use_kv_cache=True, prefix_cache=None, top_p=None, min_p=None):
         """
         Take a conditioning sequence of indices idx (LongTensor of shape (b,t)) and complete
         the sequence max_new_tokens times, feeding the predictions back into the model each time.
+        With use_kv_cache only the newest token is fed after the prompt prefill, and a
+        prefix_cache (PrefixCache) lets repeated prompts skip the prefill.
+        temperature 0 decodes greedily, top_p and min_p filter the top_k candidates further.
         Most likely you'll want to make sure to be in model.eval() mode of operation for this.
         """
-        for _ in range(max_new_tokens):
+        sampler = self.sampler(temperature, top_k, top_p, min_p)
+        kv_cache = self.init_kv_cache(idx.size(0)) if use_kv_cache else None
+        if prefix_cache is not None:
+            prefix_cache.restore(idx, kv_cache)
+        for step in range(max_new_tokens):
             # if the sequence context is growing too long we must crop it at block_size
-            idx_cond = idx if idx.size(1) <= self.config.block_size else idx[:, -self.config.block_size:]
+            idx_cond = self.crop_idx_cond(idx, kv_cache)
             # forward the model to get the logits for the index in the sequence
-            logits, _ = self(idx_cond)
-            # pluck the logits at the final step and scale by desired temperature
-            logits = logits[:, -1, :] / temperature
-            # optionally crop the logits to only the top k options
-            if top_k is not None:
-                v, _ = torch.topk(logits, min(top_k, logits.size(-1)))
-                logits[logits < v[:, [-1]]] = -float('Inf')
-
-            probs = None
-            if self.config.softmax_variant_output != 'softmax':
-                probs = self.softmax_layer_output(logits)
-            else:
-                probs = F.softmax(logits, dim=-1)
-            assert probs != None
-            idx_next = torch.multinomial(probs, num_samples=1)
+            logits, _ = self(idx_cond, kv_cache=kv_cache)
+            if step == 0 and prefix_cache is not None:
+                prefix_cache.store(idx, kv_cache)
+            # sample from the logits at the final step
+            idx_next = sampler.sample(logits[:, -1, :])
             # append sampled index to the running sequence and continue
             idx = torch.cat((idx, idx_next), dim=1)
 
         return idx
 
+    def sampler(self, temperature=1.0, top_k=None, top_p=None, min_p=None):
+        """TokenSampler for the next token, using the output softmax variant of this model."""
+        softmax_layer = self.softmax_layer_output if self.config.softmax_variant_output != 'softmax' else None
+        return TokenSampler(temperature, top_k, top_p, min_p, softmax_layer)
+
+    @torch.no_grad()
+    def generate_speculative(self, idx, draft_model, max_new_tokens, num_draft_tokens=4, temperature=1.0, top_k=None, use_kv_cache=True,
+                             top_p=None, min_p=None):
+        """
+        Speculative decoding: draft_model (a small model sharing the tokenizer)
+        proposes num_draft_tokens tokens, which this model checks in a single
+        forward. Each draft token x is kept with probability min(1, q(x) / p(x))
+        (q target, p draft probabilities); on the first rejection a token is
+        resampled from norm(max(0, q - p)), and if all are kept a bonus token is
+        sampled from q. The output distribution is exactly that of sampling
+        from this model alone. Both distributions are those of TokenSampler
+        (temperature 0 is greedy: a draft token is kept when it is the target's
+        argmax). Only batch size 1 is supported.
+
+        Returns idx and a dict with the number of proposed and accepted draft
+        tokens and target model forwards.
+        """
+        assert idx.size(0) == 1, "speculative decoding supports a single sequence"
+        assert draft_model.config.vocab_size == self.config.vocab_size, "draft and target models must share a vocabulary"
+        block_size = min(self.config.block_size, draft_model.config.block_size)
+        assert num_draft_tokens < block_size // 2, "num_draft_tokens must be below half the block size"
+
+        sampler = self.sampler(temperature, top_k, top_p, min_p)
+        draft_sampler = draft_model.sampler(temperature, top_k, top_p, min_p)
+        kv_cache = self.init_kv_cache(1, rollback=True) if use_kv_cache else None
+        draft_cache = draft_model.init_kv_cache(1, rollback=True) if use_kv_cache else None
+        stats = {"proposed": 0, "accepted": 0, "target_forwards": 0}
+        start_len = idx.size(1)
+
+        while idx.size(1) - start_len < max_new_tokens:
+            k = min(num_draft_tokens, max_new_tokens - (idx.size(1) - start_len))
+
+            # draft k tokens autoregressively with the small model
+            draft_tokens = idx
+            draft_probs = []
+            for _ in range(k):
+                idx_cond = draft_model.crop_idx_cond(draft_tokens, draft_cache)
+                logits, _ = draft_model(idx_cond, kv_cache=draft_cache)
+                probs = draft_sampler.probs(logits[:, -1, :])
+                draft_probs.append(probs)
+                draft_tokens = torch.cat((draft_tokens, torch.multinomial(probs, num_samples=1)), dim=1)
+
+            # score all drafted tokens (plus one bonus position) in one forward of the target
+            idx_cond = self.crop_idx_cond(draft_tokens, kv_cache)
+            logits, _ = self(idx_cond, kv_cache=kv_cache, full_logits=True)
+            target_probs = sampler.probs(logits[:, -(k + 1):, :])
+            stats["target_forwards"] += 1
+            stats["proposed"] += k
+
+            drafted = draft_tokens[0, idx.size(1):]
+            n_accepted = 0
+            next_token = None
+            for i in range(k):
+                token = drafted[i]
+                q = target_probs[0, i]
+                p = draft_probs[i][0]
+                if torch.rand(1, device=idx.device) < torch.clamp(q[token] / p[token], max=1.0):
+                    n_accepted += 1
+                    continue
+                residual = torch.clamp(q - p, min=0.0)
+                residual = residual / residual.sum() if residual.sum() > 0 else q
+                next_token = torch.multinomial(residual, num_samples=1)
+                break
+            if next_token is None:
+                next_token = torch.multinomial(target_probs[0, k], num_samples=1)
+            stats["accepted"] += n_accepted
+
+            idx = torch.cat((idx, drafted[None, :n_accepted], next_token[None, :]), dim=1)
+
+            # roll back rejected tokens, the newest token is fed on the next step
+            if kv_cache is not None:
+                kv_cache.truncate(min(kv_cache.seq_len, idx.size(1) - 1 - kv_cache.offset))
+            if draft_cache is not None:
+                draft_cache.truncate(min(draft_cache.seq_len, idx.size(1) - 1 - draft_cache.offset))
+
+        return idx[:, :start_len + max_new_tokens], stats
+
+    @torch.no_grad()
+    def generate_medusa(self, idx, max_new_tokens, temperature=1.0, top_k=None, medusa_top_k=2, max_candidates=16,
+                        posterior_threshold=0.09, posterior_alpha=0.3, use_kv_cache=True, top_p=None, min_p=None):
+        """
+        Self-speculative decoding with the medusa heads. Each step samples the
+        next token from the lm_head and builds candidate continuations from the
+        medusa_top_k best tokens of every head (a tree, cut to max_candidates
+        paths by rank). All paths are verified in one batched forward sharing the
+        cached prefix, candidate tokens are kept by the typical acceptance rule
+        and the path with the most accepted tokens wins. Only batch size 1 is
+        supported.
+
+        Returns idx and a dict with the number of accepted head tokens and forwards.
+        """
+        assert idx.size(0) == 1, "medusa decoding supports a single sequence"
+        assert self.n_medusa_heads > 0, "model has no medusa heads, train with --n_medusa_heads"
+        n = self.n_medusa_heads
+        block_size = self.config.block_size
+        assert n + 1 < block_size // 2, "n_medusa_heads must be below half the block size"
+
+        # candidate paths as per head ranks, best (lowest rank sum) first
+        ranks = torch.cartesian_prod(*[torch.arange(medusa_top_k)] * n).view(-1, n)
+        ranks = ranks[torch.argsort(ranks.sum(dim=-1), stable=True)][:max_candidates].to(idx.device)
+        C = ranks.size(0)
+
+        sampler = self.sampler(temperature, top_k, top_p, min_p)
+        kv_cache = self.init_kv_cache(1, rollback=True) if use_kv_cache else None
+        stats = {"accepted": 0, "forwards": 0}
+        start_len = idx.size(1)
+
+        idx_cond = self.crop_idx_cond(idx, kv_cache)
+        logits, _ = self(idx_cond, kv_cache=kv_cache, return_medusa=True)
+        stats["forwards"] += 1
+        step_logits = logits[0, -1] # (1 + n, vocab)
+
+        while idx.size(1) - start_len < max_new_tokens:
+            next_token = sampler.sample(step_logits[:1])[0]
+            head_top = torch.topk(step_logits[1:], medusa_top_k, dim=-1).indices # (n, medusa_top_k)
+            candidates = torch.cat((next_token.expand(C, 1), head_top[torch.arange(n, device=idx.device), ranks]), dim=1)
+
+            if kv_cache is not None:
+                if kv_cache.free_slots() < n + 1:
+                    # refill the cache with the most recent half block
+                    keep = min(block_size // 2, idx.size(1))
+                    kv_cache.reset(offset=idx.size(1) - keep)
+                    self(idx[:, -keep:], kv_cache=kv_cache)
+                past = kv_cache.seq_len
+                kv_cache.select_rows(torch.zeros(C, dtype=torch.long, device=idx.device))
+                logits, _ = self(candidates, kv_cache=kv_cache, full_logits=True, return_medusa=True)
+            else:
+                cond = torch.cat((idx.expand(C, -1), candidates), dim=1)[:, -block_size:]
+                logits, _ = self(cond, full_logits=True, return_medusa=True)
+                logits = logits[:, -(n + 1):]
+            stats["forwards"] += 1
+
+            # position j of each path predicts its token j + 1
+            verify_probs = sampler.probs(logits[:, :-1, 0])
+            accepted = typical_acceptance(verify_probs, candidates[:, 1:], posterior_threshold, posterior_alpha)
+            n_accepted = accepted.long().cumprod(dim=-1).sum(dim=-1)
+            best = int(torch.argmax(n_accepted))
+            a = int(n_accepted[best])
+            stats["accepted"] += a
+
+            idx = torch.cat((idx, candidates[best:best + 1, :a + 1]), dim=1)
+            step_logits = logits[best, a]
+            if kv_cache is not None:
+                kv_cache.select_rows(torch.tensor([best], device=idx.device))
+                kv_cache.truncate(past + a + 1)
+
+        return idx[:, :start_len + max_new_tokens], stats
+
     @torch.no_grad()
-    def generate_with_stop(self, idx, max_new_tokens, stop_string, decode, temperature=1.0, top_k=None):
+    def generate_batch(self, prompts, max_new_tokens, temperature=1.0, top_k=None, stop_tokens=None, pad_token=0, use_kv_cache=True, kv_pool=None,
+                       kv_quant_bits=None, kv_quant_method="symmetric_quant", top_p=None, min_p=None):
+        """
+        Sample continuations for a list of prompts (lists of token ids) with one
+        forward per step for the whole batch.
+
+        Prompts of different lengths are left padded, which requires the kv cache
+        to keep padding out of attention; without it prompts must share a length.
+        Identical prompts (e.g. several samples of one prompt) are prefilled once
+        and their cache shared by all rows, copy-on-write with a kv_pool.
+        stop_tokens optionally gives a stop token id (or None) per row; finished
+        rows are dropped from the batch (and cache) so the remaining rows run on.
+        kv_quant_bits (8 or 4) stores the cache quantized, for larger batches.
+        Returns the generated ids for each prompt, including its stop token.
+        """
+        device = self.transformer.wte.weight.device
+        sampler = self.sampler(temperature, top_k, top_p, min_p)
+        B = len(prompts)
+        lengths = [len(p) for p in prompts]
+        max_len = max(lengths)
+
+        kv_cache = None
+        if use_kv_cache:
+            kv_cache = self.init_kv_cache(B, kv_pool=kv_pool, quant_bits=kv_quant_bits, quant_method=kv_quant_method)
+        shared_prompt = kv_cache is not None and B > 1 and all(p == prompts[0] for p in prompts)
+        if kv_cache is None and len(set(lengths)) != 1:
+            sys.exit("Prompts of different lengths need a kv cache, group them by length or enable the cache")
+
+        idx = torch.full((B, max_len), pad_token, dtype=torch.long, device=device)
+        for i, p in enumerate(prompts):
+            idx[i, max_len - len(p):] = torch.tensor(p, dtype=torch.long, device=device)
+        if kv_cache is not None and len(set(lengths)) != 1:
+            kv_cache.set_pad(torch.tensor([max_len - l for l in lengths], dtype=torch.long, device=device))
+
+        if stop_tokens is None:
+            stop_tokens = [None] * B
+        stop = torch.tensor([-1 if s is None else s for s in stop_tokens], dtype=torch.long, device=device)
+        rows = torch.arange(B, device=device) # original prompt index of each active row
+        outputs = [[] for _ in range(B)]
+
+        for step in range(max_new_tokens):
+            if shared_prompt and step == 0:
+                # prefill the prompt once, then repeat its cache for every row
+                kv_cache.select_rows(torch.zeros(1, dtype=torch.long, device=device))
+                logits, _ = self(self.crop_idx_cond(idx[:1], kv_cache), kv_cache=kv_cache)
+                kv_cache.select_rows(torch.zeros(B, dtype=torch.long, device=device))
+                logits = logits.expand(B, -1, -1)
+            else:
+                idx_cond = self.crop_idx_cond(idx, kv_cache)
+                logits, _ = self(idx_cond, kv_cache=kv_cache)
+            idx_next = sampler.sample(logits[:, -1, :])
+            idx = torch.cat((idx, idx_next), dim=1)
+
+            finished = idx_next[:, 0] == stop
+            if step == max_new_tokens - 1:
+                finished[:] = True
+            if finished.any():
+                for r in finished.nonzero()[:, 0].tolist():
+                    outputs[rows[r].item()] = idx[r, max_len:].tolist()
+                keep = ~finished
+                if not keep.any():
+                    break
+                idx, rows, stop = idx[keep], rows[keep], stop[keep]
+                if kv_cache is not None:
+                    kv_cache.select_rows(keep)
+
+        if isinstance(kv_cache, PagedKVCache):
+            kv_cache.free()
+        return outputs
+
+    @torch.no_grad()
+    def generate_with_stop(self, idx, max_new_tokens, stop_string, decode, temperature=1.0, top_k=None, use_kv_cache=True, prefix_cache=None, top_p=None, min_p=None,
+                           encode=None, stream=None, kv_cache=None):
         """
         Generate tokens and stop on fixed string match, return the state for further input.
+        Text is detokenized incrementally, only complete characters, and each new
+        piece is passed to stream if given. With encode the stop string is matched
+        on token ids, otherwise on the last len(stop_string) characters of text.
+        With a prefix_cache the conversation so far is stored, so the next call only
+        prefills the new input. A kv_cache passed in is used (and left filled)
+        instead of a new one, for sessions continuing idx over several calls.
         """
         generated_text = ""
-        buffer = ""
+        tail = ""
+        detokenizer = StreamingDetokenizer(decode)
+        stop_matcher = StopSequenceMatcher.from_strings([stop_string], encode) if encode is not None else None
+        sampler = self.sampler(temperature, top_k, top_p, min_p)
+        if kv_cache is None and use_kv_cache:
+            kv_cache = self.init_kv_cache(idx.size(0))
+        if prefix_cache is not None:
+            prefix_cache.restore(idx, kv_cache)
         for _ in range(max_new_tokens):
-            idx_cond = idx if idx.size(1) <= self.config.block_size else idx[:, -self.config.block_size:]
-            logits, _ = self(idx_cond)
-            logits = logits[:, -1, :] / temperature
-            if top_k is not None:
-                v, _ = torch.topk(logits, min(top_k, logits.size(-1)))
-                logits[logits < v[:, [-1]]] = -float('Inf')
-            probs = F.softmax(logits, dim=-1)
-            idx_next = torch.multinomial(probs, num_samples=1)
+            idx_cond = self.crop_idx_cond(idx, kv_cache)
+            logits, _ = self(idx_cond, kv_cache=kv_cache)
+            idx_next = sampler.sample(logits[:, -1, :])
             idx = torch.cat((idx, idx_next), dim=1)
 
-            next_token_text = decode(idx_next[0].tolist())
+            next_token_text = detokenizer.push(idx_next[0].item())
             generated_text += next_token_text
-            buffer += next_token_text
-
-            # Check if the buffer ends with the stop_string
-            if buffer.endswith(stop_string):
-                break
-
+            if stream is not None and next_token_text:
+                stream(next_token_text)
+
+            # Check if the newest tokens (or text) end with the stop_string
+            if stop_matcher is not None:
+                if stop_matcher.push(idx_next[0].item()):
+                    break
+            elif stop_string:
+                tail = (tail + next_token_text)[-len(stop_string):]
+                if tail == stop_string:
+                    break
+
+        remaining_text = detokenizer.flush()
+        generated_text += remaining_text
+        if stream is not None and remaining_text:
+            stream(remaining_text)
+        if prefix_cache is not None:
+            prefix_cache.store(idx, kv_cache)
         return idx, generated_text
 
@@ -0,0 +1,250 @@
+"""
+Per layer mixed precision search for a trained checkpoint.
+
+Every linear layer (attention q/k/v/proj, mlp up/down) and every activation
+quantization point of every block is quantized on its own at each candidate
+bit width, and the val loss increase on windows of val.bin is measured. The
+float inputs of each block are cached once, so measuring a site of block i
+only runs blocks i and up. The bit widths are then allocated greedily: all
+sites start at the widest candidate and the site losing the least loss per
+bit saved is narrowed until the average weight bits (model size, and weight
+traffic per decoded token) and the average activation bits fit the budgets.
+
+The allocation is written as a json of quantization args with per layer bits
+in quantization_layer_bits, for quantization/ptq.py --bits_config or
+train.py --load_config_json (QAT with the searched precisions).
+
+Example:
+    python3 quantization/bit_search.py --out_dir out --avg_weight_bits 5 --avg_act_bits 7
+"""
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+import torch
+from torch.nn import functional as F
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from gpt_conf import GPTConfig
+from model import GPT
+from quantization.quantize import quantize_dictionary, dequantize
+from quantization.ptq import get_batches, quantization_dict_of
+from sample import load_validation_data
+from variations.linear_variations import linear_dictionary
+
+# linear layers of the attention / mlp blocks: (attribute, bits arg, variant arg)
+linear_sites = {
+    "quantization_attn_dict": [("c_attn_q", "quantize_linear_attn_q_bits", "linear_variant_q"),
+                               ("c_attn_k", "quantize_linear_attn_k_bits", "linear_variant_k"),
+                               ("c_attn_v", "quantize_linear_attn_v_bits", "linear_variant_v"),
+                               ("c_proj", "quantize_linear_attn_proj_bits", "linear_variant_attn_proj")],
+    "quantization_mlp_dict": [("c_fc", "quantize_linear_mlp_up_bits", "linear_variant_mlp_up"),
+                              ("c_proj", "quantize_linear_mlp_down_bits", "linear_variant_mlp_down")],
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Search per layer weight and activation bit widths under a size budget')
+    parser.add_argument("--out_dir", type=str, default="out", help="Directory to load checkpoint from")
+    parser.add_argument("--config_out", type=str, default=None, help="Json to write the allocation to, default out_dir/mixed_precision.json")
+    parser.add_argument("--dataset", type=str, default=None, help="Dataset with val.bin (or val_shards/), default the checkpoint's dataset")
+    parser.add_argument("--device", type=str, default="cuda", help="Device to run on (e.g., 'cpu', 'cuda')")
+    parser.add_argument("--bits", type=int, nargs="+", default=[8, 6, 4, 3], help="Candidate bit widths")
+    parser.add_argument("--search", type=str, nargs="+", default=["linear", "act"], choices=["linear", "act"], help="Search the linear weights and / or the activation quantization points")
+    parser.add_argument("--avg_weight_bits", type=float, default=6.0, help="Budget: average bits per weight over the searched linear layers")
+    parser.add_argument("--avg_act_bits", type=float, default=8.0, help="Budget: average bits over the searched activation points")
+    parser.add_argument("--linear_quant_method", type=str, default="symmetric_quant", choices=["symmetric_quant", "affine_quant"], help="quantized_linear weight quantization method")
+    parser.add_argument("--act_quant_method", type=str, default="symmetric_quant", choices=["symmetric_quant", "affine_quant"], help="Activation quantization method")
+    parser.add_argument("--eval_batches", type=int, default=4, help="Batches of val.bin each site is evaluated on")
+    parser.add_argument("--batch_size", type=int, default=8, help="Windows of block_size tokens per batch")
+    parser.add_argument("--seed", type=int, default=1337, help="Seed for the evaluation windows")
+    return parser.parse_args()
+
+
+class Site:
+    """ One linear layer or activation point of the block starting at layer, quantizable at any bit width """
+    def __init__(self, layer, module, kind, name, bits_arg, cost, variant_arg=None, linear=None):
+        self.layer = layer
+        self.module = module
+        self.kind = kind
+        self.name = name
+        self.bits_arg = bits_arg
+        self.cost = cost
+        self.variant_arg = variant_arg
+        self.linear = linear
+
+    def apply(self, bits, quant_method):
+        """Quantize the site, returns a function restoring it."""
+        if self.kind == "linear":
+            weight = self.linear.weight.data.clone()
+            zero_point, scale, quantized = quantize_dictionary[quant_method](weight.float(), bits)
+            self.linear.weight.data.copy_(dequantize(zero_point, scale, quantized).to(weight.dtype))
+            return lambda: self.linear.weight.data.copy_(weight)
+        quantization_dict = quantization_dict_of(self.module)
+        saved = (quantization_dict[self.name], quantization_dict[self.bits_arg])
+        quantization_dict[self.name] = True
+        quantization_dict[self.bits_arg] = bits
+        def restore():
+            quantization_dict[self.name], quantization_dict[self.bits_arg] = saved
+        return restore
+
+
+def find_sites(model, search):
+    """Sites of every attention / mlp block, a block shared between layers counted at its first layer."""
+    sites = []
+    seen = set()
+    float_linear = linear_dictionary["linear"]
+    for layer, block in enumerate(model.transformer.h):
+        for module in block.modules():
+            quantization_dict = quantization_dict_of(module)
+            if quantization_dict is None or id(module) in seen:
+                continue
+            seen.add(id(module))
+            dict_name = "quantization_attn_dict" if hasattr(module, "quantization_attn_dict") else "quantization_mlp_dict"
+            if "linear" in search:
+                for attr, bits_arg, variant_arg in linear_sites[dict_name]:
+                    linear = getattr(module, attr, None)
+                    # other variants have their own weight format
+                    if type(linear) is float_linear:
+                        sites.append(Site(layer, module, "linear", attr, bits_arg, linear.weight.numel(), variant_arg, linear))
+            if "act" in search:
+                for key, val in quantization_dict.items():
+                    # points already quantized in the checkpoint are part of the baseline
+                    if key.startswith("quantize_") and "_act_" in key and not key.endswith("_bits") and not val:
+                        sites.append(Site(layer, module, "act", key, f"{key}_bits", 1))
+    return sites
+
+
+def tail_loss(model, start, x, y):
+    """Loss of the model run from block start on, with x the cached input of that block."""
+    for block in model.transformer.h[start:]:
+        x = block(x, None)
+    x = model.transformer.ln_f(x)
+    if model.n_embd_wte:
+        x = F.linear(x, model.transformer.scale_down.weight.t())
+    logits = model.lm_head(x)
+    return F.cross_entropy(logits.view(-1, logits.size(-1)), y.view(-1), ignore_index=-1).item()
+
+
+def allocate(sites, candidates, deltas, budget):
+    """
+    Greedy multiple choice knapsack: start every site at the widest candidate and
+    narrow the site with the smallest loss increase per cost saved until the
+    total cost (cost x bits) fits the budget. Returns the bits of each site.
+    """
+    choice = {site: 0 for site in sites}
+    total = sum(site.cost * candidates[0] for site in sites)
+    while total > budget:
+        best = None
+        for site in sites:
+            i = choice[site]
+            if i + 1 < len(candidates):
+                saved = site.cost * (candidates[i] - candidates[i + 1])
+                increase = deltas[site][i + 1] - deltas[site][i]
+                if best is None or increase / saved < best[0]:
+                    best = (increase / saved, site, saved)
+        if best is None:
+            sys.exit(f"budget {budget} is below the narrowest candidate, {sum(site.cost for site in sites) * candidates[-1]}")
+        _, site, saved = best
+        choice[site] += 1
+        total -= saved
+    return {site: candidates[choice[site]] for site in sites}
+
+
+def main():
+    args = parse_args()
+    candidates = sorted(set(args.bits), reverse=True)
+    checkpoint = torch.load(os.path.join(args.out_dir, 'ckpt.pt'), map_location=args.device)
+    model_args = checkpoint['model_args']
+    model_args['dropout'] = 0.0
+    model_args['activations_quant_method'] = args.act_quant_method
+    model = GPT(GPTConfig(**model_args))
+    state_dict = checkpoint['model']
+    unwanted_prefix = '_orig_mod.'
+    for k, v in list(state_dict.items()):
+        if k.startswith(unwanted_prefix):
+            state_dict[k[len(unwanted_prefix):]] = state_dict.pop(k)
+    model.load_state_dict(state_dict, strict=False)
+    model.eval()
+    model.to(args.device)
+    if model.use_lsv or model.config.apply_vector_at_layer_idx is not None or model.config.obtain_vector_at_layer_idx is not None:
+        sys.exit("steering vectors are not supported by the per block evaluation")
+    for module in model.modules():
+        if hasattr(module, "quantization_attn_dict"):
+            # the qk / pv points only exist in the manual attention path
+            module.flash = False
+
+    dataset = args.dataset if args.dataset else checkpoint['config']['dataset']
+    val_data = load_validation_data(dataset, model.config.vocab_size)
+    generator = np.random.default_rng(args.seed)
+    batches = list(get_batches(val_data, model.config.block_size, args.batch_size, args.eval_batches, generator, args.device))
+
+    sites = find_sites(model, args.search)
+    if not sites:
+        sys.exit("no float linear layers or unquantized activation points to search")
+
+    with torch.no_grad():
+        # float input of every block for every batch
+        block_inputs = [[] for _ in model.transformer.h]
+        handles = [block.register_forward_pre_hook(lambda module, inputs, i=i: block_inputs[i].append(inputs[0].detach()))
+                   for i, block in enumerate(model.transformer.h)]
+        for x, _ in batches:
+            model(x)
+        for handle in handles:
+            handle.remove()
+
+        def mean_tail_loss(start):
+            return sum(tail_loss(model, start, block_inputs[start][b], y) for b, (_, y) in enumerate(batches)) / len(batches)
+
+        base_loss = mean_tail_loss(0)
+        print(f"float val loss {base_loss:.4f}, {len(sites)} sites x {len(candidates)} bit widths")
+        print(f"{'layer':>5}  {'site':<42}" + "".join(f"{f'{bits} bits':>11}" for bits in candidates))
+        deltas = {}
+        for site in sites:
+            method = args.linear_quant_method if site.kind == "linear" else args.act_quant_method
+            deltas[site] = []
+            for bits in candidates:
+                restore = site.apply(bits, method)
+                deltas[site].append(mean_tail_loss(site.layer) - base_loss)
+                restore()
+            print(f"{site.layer:>5}  {site.name:<42}" + "".join(f"{delta:>+11.4f}" for delta in deltas[site]))
+
+        allocation = {}
+        budgets = [("linear", args.avg_weight_bits, "weight"), ("act", args.avg_act_bits, "activation")]
+        for kind, avg_bits, label in budgets:
+            kind_sites = [site for site in sites if site.kind == kind]
+            if kind_sites:
+                allocation.update(allocate(kind_sites, candidates, deltas, avg_bits * sum(site.cost for site in kind_sites)))
+                weighted = sum(site.cost * allocation[site] for site in kind_sites) / sum(site.cost for site in kind_sites)
+                print(f"average {label} bits {weighted:.2f} (budget {avg_bits})")
+
+        # all sites at their allocated width together
+        restores = [site.apply(bits, args.linear_quant_method if site.kind == "linear" else args.act_quant_method) for site, bits in allocation.items()]
+        mixed_loss = mean_tail_loss(0)
+        for restore in reversed(restores):
+            restore()
+    predicted = sum(deltas[site][candidates.index(bits)] for site, bits in allocation.items())
+    print(f"val loss with the allocation {mixed_loss:.4f} ({mixed_loss - base_loss:+.4f}, sum of the single site increases {predicted:+.4f})")
+
+    config = {}
+    layer_bits = {}
+    for site, bits in allocation.items():
+        layer_bits.setdefault(str(site.layer), {})[site.bits_arg] = bits
+        if site.kind == "linear":
+            config[site.variant_arg] = "quantized_linear"
+            config["quantize_linear_method"] = args.linear_quant_method
+        else:
+            config[site.name] = True
+            config["activations_quant_method"] = args.act_quant_method
+    config["quantization_layer_bits"] = layer_bits
+
+    config_out = args.config_out if args.config_out else os.path.join(args.out_dir, "mixed_precision.json")
+    with open(config_out, "w") as f:
+        json.dump(config, f, indent=4)
+    print(f"saved {config_out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Convert a float checkpoint to weight-only int4 (linear variant int4_weight_only).
+
+The attention, mlp and lm_head linears are affine quantized to 4 bits in groups
+of --group_size input channels (a scale and zero point per output row and
+group) and packed two per byte. The converted out_dir loads with sample.py as
+usual; the int4 layers dequantize a tile of rows at a time during inference.
+
+Example:
+    python3 quantization/convert_int4.py --out_dir out --int4_out_dir out_int4 --group_size 64
+"""
+import argparse
+import os
+import shutil
+import sys
+
+import torch
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from gpt_conf import GPTConfig
+from model import GPT
+from quantization.quant_utils import set_variant
+from variations.linear_variations import Int4WeightLinear
+
+# linear_variant args set to int4_weight_only, and the per layer overrides they take precedence over
+converted_args = {
+    "attn": ("linear_variant_attn", ["linear_variant_q", "linear_variant_k", "linear_variant_v", "linear_variant_attn_proj"]),
+    "mlp": ("linear_variant_mlp", ["linear_variant_mlp_up", "linear_variant_mlp_down"]),
+    "lm_head": ("linear_variant_lm_head", []),
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Quantize the linear layers of a checkpoint to weight-only int4')
+    parser.add_argument("--out_dir", type=str, default="out", help="Directory to load checkpoint from")
+    parser.add_argument("--int4_out_dir", type=str, default="out_int4", help="Directory to write the int4 checkpoint (and meta.pkl) to")
+    parser.add_argument("--group_size", type=int, default=128, choices=[32, 64, 128], help="Input channels sharing a scale and zero point")
+    parser.add_argument("--tile_size", type=int, default=256, help="Output rows dequantized at a time during inference")
+    parser.add_argument("--layers", type=str, nargs="+", default=["attn", "mlp", "lm_head"], choices=list(converted_args), help="Linear layers to convert")
+    return parser.parse_args()
+
+
+def state_dict_bytes(state_dict):
+    # tied weights (wte / lm_head) are counted once
+    tensors = {v.data_ptr(): v for v in state_dict.values() if torch.is_tensor(v)}
+    return sum(v.numel() * v.element_size() for v in tensors.values())
+
+
+def main():
+    args = parse_args()
+    checkpoint = torch.load(os.path.join(args.out_dir, 'ckpt.pt'), map_location='cpu')
+    model_args = checkpoint['model_args']
+    for layers in args.layers:
+        variant_arg, override_args = converted_args[layers]
+        variants = {set_variant(model_args.get(arg), model_args.get(variant_arg, "linear")) for arg in override_args} or {model_args.get(variant_arg, "linear")}
+        if variants != {"linear"}:
+            sys.exit(f"{layers} layers use {sorted(variants)}, only float 'linear' layers can be converted")
+        model_args[variant_arg] = "int4_weight_only"
+        for arg in override_args:
+            model_args[arg] = None
+    model_args['int4_group_size'] = args.group_size
+    model_args['int4_tile_size'] = args.tile_size
+
+    state_dict = checkpoint['model']
+    unwanted_prefix = '_orig_mod.'
+    for k, v in list(state_dict.items()):
+        if k.startswith(unwanted_prefix):
+            state_dict[k[len(unwanted_prefix):]] = state_dict.pop(k)
+
+    model = GPT(GPTConfig(**model_args))
+    # loads everything but the int4 layer weights, quantized below
+    model.load_state_dict(state_dict, strict=False)
+    int4_layers = [(name, module) for name, module in model.named_modules() if isinstance(module, Int4WeightLinear)]
+    for name, module in int4_layers:
+        module.quantize_weight(state_dict[f"{name}.weight"])
+
+    int4_state_dict = model.state_dict()
+    checkpoint['model'] = int4_state_dict
+    # the optimizer state refers to the float weights
+    checkpoint.pop('optimizer', None)
+
+    os.makedirs(args.int4_out_dir, exist_ok=True)
+    torch.save(checkpoint, os.path.join(args.int4_out_dir, 'ckpt.pt'))
+    meta_path = os.path.join(args.out_dir, 'meta.pkl')
+    if os.path.exists(meta_path):
+        shutil.copy(meta_path, args.int4_out_dir)
+
+    before = state_dict_bytes(state_dict)
+    after = state_dict_bytes(int4_state_dict)
+    print(f"converted {len(int4_layers)} linear layers to int4, group size {args.group_size}")
+    print(f"model weights: {before / 1024:.1f} KiB -> {after / 1024:.1f} KiB ({before / after:.2f}x smaller)")
+    print(f"saved {os.path.join(args.int4_out_dir, 'ckpt.pt')}")
+
+
+if __name__ == "__main__":
+    main()
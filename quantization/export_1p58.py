@@ -0,0 +1,80 @@
+"""
+Export a checkpoint with bitlinear_1p58 layers in packed ternary form.
+
+Every BitLinear1p58 weight is replaced by its ternary values packed 5 per byte
+plus one absmean scale (BitLinear1p58.pack), about 5x smaller than int8 and
+20x smaller than float32. The exported out_dir loads with sample.py as usual,
+the packed layers unpack a tile of rows at a time during inference.
+
+Example:
+    python3 quantization/export_1p58.py --out_dir out --packed_out_dir out_packed
+"""
+import argparse
+import os
+import shutil
+import sys
+
+import torch
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from gpt_conf import GPTConfig
+from model import GPT
+from variations.linear_variations import BitLinear1p58
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Pack the bitlinear_1p58 weights of a checkpoint into 5 trits per byte')
+    parser.add_argument("--out_dir", type=str, default="out", help="Directory to load checkpoint from")
+    parser.add_argument("--packed_out_dir", type=str, default="out_packed", help="Directory to write the packed checkpoint (and meta.pkl) to")
+    parser.add_argument("--tile_size", type=int, default=None, help="Output rows unpacked at a time during inference, default the checkpoint's bitlinear_1p58_tile_size")
+    return parser.parse_args()
+
+
+def state_dict_bytes(state_dict):
+    return sum(v.numel() * v.element_size() for v in state_dict.values() if torch.is_tensor(v))
+
+
+def main():
+    args = parse_args()
+    checkpoint = torch.load(os.path.join(args.out_dir, 'ckpt.pt'), map_location='cpu')
+    model_args = checkpoint['model_args']
+    if model_args.get('bitlinear_1p58_packed'):
+        sys.exit(f"{args.out_dir}/ckpt.pt is already packed")
+    if args.tile_size:
+        model_args['bitlinear_1p58_tile_size'] = args.tile_size
+
+    model = GPT(GPTConfig(**model_args))
+    state_dict = checkpoint['model']
+    unwanted_prefix = '_orig_mod.'
+    for k, v in list(state_dict.items()):
+        if k.startswith(unwanted_prefix):
+            state_dict[k[len(unwanted_prefix):]] = state_dict.pop(k)
+    model.load_state_dict(state_dict, strict=False)
+
+    packed_layers = [module for module in model.modules() if isinstance(module, BitLinear1p58)]
+    if not packed_layers:
+        sys.exit("checkpoint has no bitlinear_1p58 layers to pack")
+    for module in packed_layers:
+        module.pack()
+
+    packed_state_dict = model.state_dict()
+    checkpoint['model'] = packed_state_dict
+    checkpoint['model_args']['bitlinear_1p58_packed'] = True
+    # the optimizer state refers to the float weights
+    checkpoint.pop('optimizer', None)
+
+    os.makedirs(args.packed_out_dir, exist_ok=True)
+    torch.save(checkpoint, os.path.join(args.packed_out_dir, 'ckpt.pt'))
+    meta_path = os.path.join(args.out_dir, 'meta.pkl')
+    if os.path.exists(meta_path):
+        shutil.copy(meta_path, args.packed_out_dir)
+
+    before = state_dict_bytes(state_dict)
+    after = state_dict_bytes(packed_state_dict)
+    print(f"packed {len(packed_layers)} bitlinear_1p58 layers")
+    print(f"model weights: {before / 1024:.1f} KiB -> {after / 1024:.1f} KiB ({before / after:.2f}x smaller)")
+    print(f"saved {os.path.join(args.packed_out_dir, 'ckpt.pt')}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+"""
+GPTQ weight quantization of a trained checkpoint, calibrated on val.bin.
+
+Blocks are quantized one after the other. For each block the inputs of its
+linear layers are collected over calibration batches of val.bin (through the
+already quantized blocks before it) into the Hessian H = X^T X / n, then the
+weight columns are quantized in order and the error of each column is spread
+over the columns not quantized yet, weighted by the inverse Hessian
+(Frantar et al., 2022, https://arxiv.org/abs/2210.17323). Grids use the
+symmetric_quant / affine_quant methods of quantize_dictionary with a scale per
+output row, or per group of --group_size input channels.
+
+The reconstruction error of every layer (relative ||(W - Q) X||^2, next to the
+round to nearest error on the same grid) and the val loss before and after are
+printed. --format float writes the dequantized weights into the float linear
+layers, --format int4 (4 bits, affine_quant, group size 32/64/128) writes
+packed int4_weight_only layers. Both load with sample.py as usual.
+
+Example:
+    python3 quantization/gptq.py --out_dir out --gptq_out_dir out_gptq --bits 4 --group_size 64 --format int4
+"""
+import argparse
+import os
+import shutil
+import sys
+
+import numpy as np
+import torch
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from gpt_conf import GPTConfig
+from model import GPT
+from quantization.quantize import quantize_dictionary, dequantize, static_quantize, set_dtype
+from quantization.ptq import get_batches, mean_loss
+from sample import load_validation_data
+from variations.linear_variations import linear_dictionary, Int4WeightLinear
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='GPTQ weight quantization with Hessians calibrated on val.bin')
+    parser.add_argument("--out_dir", type=str, default="out", help="Directory to load checkpoint from")
+    parser.add_argument("--gptq_out_dir", type=str, default="out_gptq", help="Directory to write the quantized checkpoint (and meta.pkl) to")
+    parser.add_argument("--dataset", type=str, default=None, help="Dataset with val.bin (or val_shards/), default the checkpoint's dataset")
+    parser.add_argument("--device", type=str, default="cuda", help="Device to quantize on (e.g., 'cpu', 'cuda')")
+    parser.add_argument("--bits", type=int, default=4, help="Bits of the quantized weights")
+    parser.add_argument("--quant_method", type=str, default="affine_quant", choices=["symmetric_quant", "affine_quant"], help="Weight quantization grid")
+    parser.add_argument("--group_size", type=int, default=None, help="Input channels sharing a scale (and zero point), default one per output row")
+    parser.add_argument("--block_size", type=int, default=128, help="Columns quantized before the error is applied to the remaining columns")
+    parser.add_argument("--percdamp", type=float, default=0.01, help="Dampening added to the Hessian diagonal, as a fraction of its mean")
+    parser.add_argument("--calibration_batches", type=int, default=16, help="Batches of val.bin used to collect the Hessians")
+    parser.add_argument("--eval_batches", type=int, default=8, help="Batches of val.bin to compare the loss before and after quantization")
+    parser.add_argument("--batch_size", type=int, default=8, help="Windows of block_size tokens per batch")
+    parser.add_argument("--seed", type=int, default=1337, help="Seed for the calibration and evaluation windows")
+    parser.add_argument("--format", type=str, default="float", choices=["float", "int4"], help="Write dequantized float weights, or packed int4_weight_only layers")
+    return parser.parse_args()
+
+
+def quantize_groups(weight, bits, quant_method, group_size):
+    """Round to nearest on the per row (or per group) grid, for comparison with GPTQ."""
+    quantized = torch.zeros_like(weight)
+    for start in range(0, weight.size(1), group_size):
+        zero_point, scale, ints = quantize_dictionary[quant_method](weight[:, start:start + group_size], bits, dim=-1)
+        quantized[:, start:start + group_size] = dequantize(zero_point, scale, ints)
+    return quantized
+
+
+def gptq_quantize(weight, hessian, bits, quant_method, group_size=None, block_size=128, percdamp=0.01):
+    """
+    Quantize the columns of weight (out, in) in order, compensating each
+    column's error in the remaining columns with the inverse of hessian (in, in).
+    Returns the dequantized weight, the integer weight and the (out, n_groups)
+    scales and zero points.
+    """
+    W = weight.float().clone()
+    rows, cols = W.shape
+    H = hessian.clone()
+    # inputs that were always zero carry no information
+    dead = torch.diag(H) == 0
+    H[dead, dead] = 1
+    W[:, dead] = 0
+    H += percdamp * torch.mean(torch.diag(H)) * torch.eye(cols, device=H.device)
+    # upper Cholesky factor of H^-1, its rows give the updates of the remaining columns
+    Hinv = torch.linalg.cholesky(torch.cholesky_inverse(torch.linalg.cholesky(H)), upper=True)
+
+    group = group_size if group_size else cols
+    if group_size:
+        # groups must not cross blocks, their grid is taken from the updated weights of the block
+        block_size = group_size * max(1, block_size // group_size)
+
+    Q = torch.zeros_like(W)
+    ints = torch.zeros(rows, cols, dtype=set_dtype(bits), device=W.device)
+    scales, zero_points = [], []
+    for i1 in range(0, cols, block_size):
+        i2 = min(i1 + block_size, cols)
+        W1 = W[:, i1:i2].clone()
+        Err1 = torch.zeros_like(W1)
+        Hinv1 = Hinv[i1:i2, i1:i2]
+        for i in range(i2 - i1):
+            if (i1 + i) % group == 0:
+                zero_point, scale, _ = quantize_dictionary[quant_method](W1[:, i:i + group] if group_size else W, bits, dim=-1)
+                zero_point = torch.broadcast_to(zero_point, scale.shape)
+                scales.append(scale)
+                zero_points.append(zero_point)
+            w = W1[:, i:i + 1]
+            q_int = static_quantize(w, bits, scale, zero_point)
+            q = dequantize(zero_point, scale, q_int)
+            Q[:, i1 + i:i1 + i + 1] = q
+            ints[:, i1 + i:i1 + i + 1] = q_int
+            err = (w - q) / Hinv1[i, i]
+            W1[:, i:] -= err @ Hinv1[i:i + 1, i:]
+            Err1[:, i:i + 1] = err
+        # lazy batch update of the columns after this block
+        W[:, i2:] -= Err1 @ Hinv[i1:i2, i2:]
+    return Q, ints, torch.cat(scales, dim=1), torch.cat(zero_points, dim=1)
+
+
+def reconstruction_error(weight, quantized, hessian):
+    """||(W - Q) X||^2 / ||W X||^2 over the calibration inputs X."""
+    delta = weight.float() - quantized
+    return ((delta @ hessian) * delta).sum().item() / ((weight.float() @ hessian) * weight.float()).sum().item()
+
+
+def main():
+    args = parse_args()
+    if args.format == "int4" and (args.bits != 4 or args.quant_method != "affine_quant" or args.group_size not in (32, 64, 128)):
+        sys.exit("--format int4 needs --bits 4 --quant_method affine_quant and --group_size 32, 64 or 128")
+
+    checkpoint = torch.load(os.path.join(args.out_dir, 'ckpt.pt'), map_location=args.device)
+    model_args = checkpoint['model_args']
+    model_args['dropout'] = 0.0
+    model = GPT(GPTConfig(**model_args))
+    state_dict = checkpoint['model']
+    unwanted_prefix = '_orig_mod.'
+    for k, v in list(state_dict.items()):
+        if k.startswith(unwanted_prefix):
+            state_dict[k[len(unwanted_prefix):]] = state_dict.pop(k)
+    model.load_state_dict(state_dict, strict=False)
+    model.eval()
+    model.to(args.device)
+
+    dataset = args.dataset if args.dataset else checkpoint['config']['dataset']
+    val_data = load_validation_data(dataset, model.config.vocab_size)
+    generator = np.random.default_rng(args.seed)
+    calibration = list(get_batches(val_data, model.config.block_size, args.batch_size, args.calibration_batches, generator, args.device))
+    evaluation = list(get_batches(val_data, model.config.block_size, args.batch_size, args.eval_batches, generator, args.device))
+
+    # only float layers, the other variants have their own weight format
+    float_linear = linear_dictionary["linear"]
+    quantized = {}
+    with torch.no_grad():
+        float_loss = mean_loss(model, evaluation)
+        print(f"{'layer':<36}{'shape':>14}{'gptq err':>12}{'rtn err':>12}")
+        for layer in range(len(model.transformer.h)):
+            prefix = f"transformer.h.{layer}."
+            # named_modules lists a module shared between blocks only once
+            linears = {name: module for name, module in model.named_modules() if name.startswith(prefix) and type(module) is float_linear}
+            if not linears:
+                continue
+
+            hessians = {name: torch.zeros(module.in_features, module.in_features, device=args.device) for name, module in linears.items()}
+            counts = dict.fromkeys(linears, 0)
+            def collect(name):
+                def hook(module, inputs):
+                    x = inputs[0].reshape(-1, module.in_features).float()
+                    hessians[name] += x.t() @ x
+                    counts[name] += x.size(0)
+                return hook
+            handles = [module.register_forward_pre_hook(collect(name)) for name, module in linears.items()]
+            # inputs of this block come from the blocks quantized so far
+            for x, _ in calibration:
+                model(x)
+            for handle in handles:
+                handle.remove()
+
+            for name, module in linears.items():
+                hessian = hessians[name] / max(counts[name], 1)
+                weight = module.weight.detach()
+                Q, ints, scales, zero_points = gptq_quantize(weight, hessian, args.bits, args.quant_method, args.group_size, args.block_size, args.percdamp)
+                rtn = quantize_groups(weight.float(), args.bits, args.quant_method, args.group_size or weight.size(1))
+                gptq_error = reconstruction_error(weight, Q, hessian)
+                rtn_error = reconstruction_error(weight, rtn, hessian)
+                module.weight.copy_(Q.to(weight.dtype))
+                quantized[name] = (ints, scales, zero_points)
+                shape = f"{module.out_features}x{module.in_features}"
+                print(f"{name:<36}{shape:>14}{gptq_error:>12.5f}{rtn_error:>12.5f}")
+
+        gptq_loss = mean_loss(model, evaluation)
+
+    skipped = [name for name, module in model.named_modules() if name.startswith("transformer.h.") and isinstance(module, torch.nn.Linear) and name not in quantized]
+    if skipped:
+        print(f"skipped layers that are not float 'linear' variants: {', '.join(skipped)}")
+    if not quantized:
+        sys.exit("no float linear layers to quantize")
+
+    if args.format == "int4":
+        for variant_arg, override_args in [("linear_variant_attn", ["linear_variant_q", "linear_variant_k", "linear_variant_v", "linear_variant_attn_proj"]),
+                                           ("linear_variant_mlp", ["linear_variant_mlp_up", "linear_variant_mlp_down"])]:
+            if model_args.get(variant_arg, "linear") == "linear" and not any(model_args.get(arg) for arg in override_args):
+                model_args[variant_arg] = "int4_weight_only"
+        model_args['int4_group_size'] = args.group_size
+        int4_model = GPT(GPTConfig(**model_args))
+        int4_model.load_state_dict(model.state_dict(), strict=False)
+        for name, module in int4_model.named_modules():
+            if isinstance(module, Int4WeightLinear):
+                if name not in quantized:
+                    sys.exit(f"{name} has no int4 weights, use --format float")
+                module.set_quantized(*quantized[name])
+        model = int4_model
+
+    checkpoint['model'] = model.state_dict()
+    checkpoint['model_args'] = model_args
+    # the optimizer state refers to the float model
+    checkpoint.pop('optimizer', None)
+    os.makedirs(args.gptq_out_dir, exist_ok=True)
+    torch.save(checkpoint, os.path.join(args.gptq_out_dir, 'ckpt.pt'))
+    if os.path.exists(os.path.join(args.out_dir, 'meta.pkl')):
+        shutil.copy(os.path.join(args.out_dir, 'meta.pkl'), args.gptq_out_dir)
+
+    grid = f"group size {args.group_size}" if args.group_size else "per row"
+    print(f"quantized {len(quantized)} layers to {args.bits} bits ({args.quant_method}, {grid}) with {args.calibration_batches} batches of {dataset} val")
+    print(f"val loss: float {float_loss:.4f}, gptq {gptq_loss:.4f} ({gptq_loss - float_loss:+.4f})")
+    print(f"saved {os.path.join(args.gptq_out_dir, 'ckpt.pt')}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+"""
+Post-training quantization of a trained checkpoint, calibrated on val.bin.
+
+Observers are attached to the activation quantization points of every
+attention and mlp block (the quantize_attn_act_* / quantize_mlp_act_* entries
+of quantization_attn_dict / quantization_mlp_dict) and record the float
+activations over calibration batches of val.bin. Each observer's range is then
+frozen into per tensor static scales and zero points (static_activation_quant),
+and the float linear layers become quantized_linear with int weights. The
+written out_dir loads with sample.py as usual, no QAT run needed.
+
+Observers:
+    minmax      full range of the calibration activations
+    percentile  clips outliers to the --percentile of the observed values
+    mse         clipping range minimizing the quantization MSE of the observed values
+
+Example:
+    python3 quantization/ptq.py --out_dir out --ptq_out_dir out_ptq --observer percentile
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+
+import numpy as np
+import torch
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from gpt_conf import GPTConfig
+from model import GPT
+from quantization.quantize import static_quantize, dequantize
+from sample import load_validation_data
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Post-training quantization with activation scales calibrated on val.bin')
+    parser.add_argument("--out_dir", type=str, default="out", help="Directory to load checkpoint from")
+    parser.add_argument("--ptq_out_dir", type=str, default="out_ptq", help="Directory to write the quantized checkpoint (and meta.pkl) to")
+    parser.add_argument("--dataset", type=str, default=None, help="Dataset with val.bin (or val_shards/), default the checkpoint's dataset")
+    parser.add_argument("--device", type=str, default="cuda", help="Device to calibrate on (e.g., 'cpu', 'cuda')")
+    parser.add_argument("--observer", type=str, default="minmax", choices=list(observer_dictionary), help="How the calibration activations set the quantization range")
+    parser.add_argument("--percentile", type=float, default=99.99, help="Percentile of the observed values kept by the percentile observer")
+    parser.add_argument("--calibration_batches", type=int, default=16, help="Batches of val.bin used for calibration")
+    parser.add_argument("--eval_batches", type=int, default=8, help="Batches of val.bin to compare the loss before and after quantization")
+    parser.add_argument("--batch_size", type=int, default=8, help="Windows of block_size tokens per batch")
+    parser.add_argument("--seed", type=int, default=1337, help="Seed for the calibration and evaluation windows")
+    parser.add_argument("--act_bits", type=int, default=8, help="Bits of the activation quantization")
+    parser.add_argument("--act_quant_method", type=str, default="symmetric_quant", choices=["symmetric_quant", "affine_quant"], help="Activation quantization method")
+    parser.add_argument("--quantize_attn_act", default=True, action=argparse.BooleanOptionalAction, help="Quantize the attention activations")
+    parser.add_argument("--quantize_mlp_act", default=True, action=argparse.BooleanOptionalAction, help="Quantize the mlp activations")
+    parser.add_argument("--quantize_linear", default=True, action=argparse.BooleanOptionalAction, help="Turn the float linear layers into quantized_linear")
+    parser.add_argument("--weight_bits", type=int, default=8, help="Bits of the quantized_linear weights")
+    parser.add_argument("--weight_quant_method", type=str, default="symmetric_quant", choices=["symmetric_quant", "affine_quant"], help="Weight quantization method")
+    parser.add_argument("--bits_config", type=str, default=None, help="json of quantization args applied last, e.g. the mixed precision allocation of quantization/bit_search.py")
+    parser.add_argument("--max_samples", type=int, default=2**20, help="Activation values kept per observer for the percentile and mse searches")
+    return parser.parse_args()
+
+
+def qparams_from_range(low, high, bits, quant_method):
+    """Zero point and scale mapping [low, high] onto the integer range, as symmetric_quantize / affine_quantize."""
+    bit_max = (1 << (bits - 1)) - 1
+    bit_min = -bit_max - 1
+    if quant_method == "symmetric_quant":
+        scale = max(max(abs(low), abs(high)) / bit_max, 1e-8)
+        zero_point = 0.0
+    else:
+        scale = max((high - low) / ((1 << bits) - 1), 1e-8)
+        zero_point = -round(low / scale) + bit_min
+    return torch.tensor(zero_point), torch.tensor(scale)
+
+
+class MinMaxObserver:
+    """ Running min / max of the observed activations
+
+    Also keeps a strided sample of up to samples_per_batch values of each
+    observed tensor for the observers searching a clipping range.
+    """
+    def __init__(self, samples_per_batch, **kwargs):
+        self.samples_per_batch = samples_per_batch
+        self.min = float("inf")
+        self.max = float("-inf")
+        self.samples = []
+
+    def observe(self, tensor):
+        values = tensor.detach().float().flatten()
+        # masked attention scores are -inf
+        values = values[torch.isfinite(values)]
+        if values.numel() == 0:
+            return
+        self.min = min(self.min, values.min().item())
+        self.max = max(self.max, values.max().item())
+        step = max(1, values.numel() // self.samples_per_batch)
+        self.samples.append(values[::step][:self.samples_per_batch].cpu())
+
+    @property
+    def observed(self):
+        return len(self.samples) > 0
+
+    def compute_range(self, bits, quant_method):
+        return self.min, self.max
+
+    def compute_qparams(self, bits, quant_method):
+        low, high = self.compute_range(bits, quant_method)
+        return qparams_from_range(low, high, bits, quant_method)
+
+
+class PercentileObserver(MinMaxObserver):
+    """ Clips the range to the given percentile of the observed values (and 100 - percentile below) """
+    def __init__(self, samples_per_batch, percentile=99.99, **kwargs):
+        super().__init__(samples_per_batch)
+        self.percentile = percentile
+
+    def compute_range(self, bits, quant_method):
+        samples = torch.cat(self.samples)
+        quantiles = torch.tensor([1 - self.percentile / 100, self.percentile / 100])
+        low, high = torch.quantile(samples, quantiles).tolist()
+        return min(low, 0.0), max(high, 0.0)
+
+
+class MSEObserver(MinMaxObserver):
+    """ Searches the clipping of the min / max range minimizing the quantization MSE of the observed values """
+    def __init__(self, samples_per_batch, num_candidates=100, **kwargs):
+        super().__init__(samples_per_batch)
+        self.num_candidates = num_candidates
+
+    def compute_range(self, bits, quant_method):
+        samples = torch.cat(self.samples)
+        best_error, best_range = float("inf"), (self.min, self.max)
+        for ratio in torch.linspace(1.0 / self.num_candidates, 1.0, self.num_candidates).tolist():
+            low, high = min(self.min * ratio, 0.0), max(self.max * ratio, 0.0)
+            zero_point, scale = qparams_from_range(low, high, bits, quant_method)
+            error = (dequantize(zero_point, scale, static_quantize(samples, bits, scale, zero_point)) - samples).pow(2).mean().item()
+            if error < best_error:
+                best_error, best_range = error, (low, high)
+        return best_range
+
+
+observer_dictionary = {
+    "minmax": MinMaxObserver,
+    "percentile": PercentileObserver,
+    "mse": MSEObserver,
+}
+
+
+def quantization_dict_of(module):
+    """quantization_attn_dict / quantization_mlp_dict of an attention or mlp block, None for other modules."""
+    return getattr(module, "quantization_attn_dict", None) or getattr(module, "quantization_mlp_dict", None)
+
+
+def activation_points(module):
+    """Names of the enabled activation quantization points of an attention or mlp block."""
+    quantization_dict = quantization_dict_of(module)
+    if quantization_dict is None:
+        return []
+    return [key[len("quantize_"):] for key, val in quantization_dict.items()
+            if key.startswith("quantize_") and "_act_" in key and not key.endswith("_bits") and val]
+
+
+def get_batches(val_data, block_size, batch_size, num_batches, generator, device):
+    for _ in range(num_batches):
+        ix = generator.integers(0, len(val_data) - block_size - 1, size=batch_size)
+        x = torch.stack([torch.from_numpy(val_data[i:i + block_size].astype(np.int64)) for i in ix])
+        y = torch.stack([torch.from_numpy(val_data[i + 1:i + 1 + block_size].astype(np.int64)) for i in ix])
+        yield x.to(device), y.to(device)
+
+
+def mean_loss(model, batches):
+    losses = [model(x, targets=y)[1].item() for x, y in batches]
+    return sum(losses) / len(losses)
+
+
+def main():
+    args = parse_args()
+    checkpoint = torch.load(os.path.join(args.out_dir, 'ckpt.pt'), map_location=args.device)
+    model_args = checkpoint['model_args']
+    model_args['dropout'] = 0.0
+
+    model_args['activations_quant_method'] = args.act_quant_method
+    model_args['quantize_attn_act'] = args.quantize_attn_act
+    model_args['quantize_attn_act_bits'] = args.act_bits
+    model_args['quantize_mlp_act'] = args.quantize_mlp_act
+    model_args['quantize_mlp_act_bits'] = args.act_bits
+    model_args['static_activation_quant'] = True
+    if args.quantize_linear:
+        model_args['quantize_linear_method'] = args.weight_quant_method
+        model_args['quantize_linear_bits'] = args.weight_bits
+        for arg in ['linear_variant_attn', 'linear_variant_mlp', 'linear_variant_q', 'linear_variant_k', 'linear_variant_v',
+                    'linear_variant_attn_proj', 'linear_variant_mlp_up', 'linear_variant_mlp_down']:
+            if model_args.get(arg) == "linear":
+                model_args[arg] = "quantized_linear"
+    if args.bits_config:
+        with open(args.bits_config) as f:
+            model_args.update(json.load(f))
+
+    model = GPT(GPTConfig(**model_args))
+    state_dict = checkpoint['model']
+    unwanted_prefix = '_orig_mod.'
+    for k, v in list(state_dict.items()):
+        if k.startswith(unwanted_prefix):
+            state_dict[k[len(unwanted_prefix):]] = state_dict.pop(k)
+    model.load_state_dict(state_dict, strict=False)
+    model.eval()
+    model.to(args.device)
+
+    dataset = args.dataset if args.dataset else checkpoint['config']['dataset']
+    val_data = load_validation_data(dataset, model.config.vocab_size)
+    block_size = model.config.block_size
+    generator = np.random.default_rng(args.seed)
+    calibration = list(get_batches(val_data, block_size, args.batch_size, args.calibration_batches, generator, args.device))
+    evaluation = list(get_batches(val_data, block_size, args.batch_size, args.eval_batches, generator, args.device))
+
+    observed_modules = []
+    samples_per_batch = max(1, args.max_samples // args.calibration_batches)
+    for module in model.modules():
+        points = activation_points(module)
+        if points:
+            module.activation_observers = {point: observer_dictionary[args.observer](samples_per_batch, percentile=args.percentile) for point in points}
+            observed_modules.append(module)
+    if not observed_modules:
+        sys.exit("no activation quantization points enabled, see --quantize_attn_act / --quantize_mlp_act")
+
+    with torch.no_grad():
+        # observers pass the float activations through
+        float_loss = mean_loss(model, evaluation)
+        for x, _ in calibration:
+            model(x)
+
+        num_frozen = 0
+        for module in observed_modules:
+            for point, observer in module.activation_observers.items():
+                if not observer.observed:
+                    # e.g. points of a flash / flex attention path, never quantized at inference either
+                    print(f"{point} of {type(module).__name__} was not reached, keeping the default scale")
+                    continue
+                # per point (and with quantization_layer_bits per layer) precision
+                bits = quantization_dict_of(module)[f"quantize_{point}_bits"]
+                zero_point, scale = observer.compute_qparams(bits, model_args['activations_quant_method'])
+                getattr(module, f"{point}_static_scale").copy_(scale)
+                getattr(module, f"{point}_static_zero_point").copy_(zero_point)
+                num_frozen += 1
+            del module.activation_observers
+
+        ptq_loss = mean_loss(model, evaluation)
+
+    checkpoint['model'] = model.state_dict()
+    checkpoint['model_args'] = model_args
+    # the optimizer state refers to the float model
+    checkpoint.pop('optimizer', None)
+    os.makedirs(args.ptq_out_dir, exist_ok=True)
+    torch.save(checkpoint, os.path.join(args.ptq_out_dir, 'ckpt.pt'))
+    if os.path.exists(os.path.join(args.out_dir, 'meta.pkl')):
+        shutil.copy(os.path.join(args.out_dir, 'meta.pkl'), args.ptq_out_dir)
+
+    print(f"froze {num_frozen} activation scales with the {args.observer} observer over {args.calibration_batches} batches of {dataset} val")
+    print(f"val loss: float activations {float_loss:.4f}, quantized activations {ptq_loss:.4f} ({ptq_loss - float_loss:+.4f})")
+    print(f"saved {os.path.join(args.ptq_out_dir, 'ckpt.pt')}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,5 @@
+import torch
+
 
 def set_variant(variant, default_variant):
     # If variant is false or None, then set to provided default value
@@ -10,3 +12,9 @@ def create_activation_buffers(obj, arg):
     obj.register_buffer(arg_str, None)
     obj.register_buffer(f"{arg_str}_scale", None)
     obj.register_buffer(f"{arg_str}_zero_point", None)
+
+def create_static_quant_buffers(obj, arg):
+    # Calibrated per tensor scale and zero point, filled by quantization/ptq.py
+    arg_str = arg.split("quantize_")[1]
+    obj.register_buffer(f"{arg_str}_static_scale", torch.ones(()))
+    obj.register_buffer(f"{arg_str}_static_zero_point", torch.zeros(()))
@@ -10,7 +10,8 @@ def set_dtype(bits):
     
 def ternary_quantize(tensor, bits, causal_mask=False):
     if causal_mask:
-        lower_triangular = torch.tril(tensor)
+        # Offset the diagonal for non-square scores, e.g. new queries against cached keys
+        lower_triangular = torch.tril(tensor, diagonal=tensor.size(-1) - tensor.size(-2))
         scale = lower_triangular.abs().mean().clamp(min=1e-5)
     else:
         scale = tensor.abs().mean().clamp(min=1e-5)
@@ -29,21 +30,24 @@ def calculate_quant_level(training, quant_scheduler, start_quant_level, full_qua
     elif quant_scheduler == "linear":
         return min(iter_num / full_quant_iter + (full_quant_iter * start_quant_level), 1)
     
-def symmetric_quantize(tensor, bits, causal_mask=False):
+def symmetric_quantize(tensor, bits, causal_mask=False, dim=None):
     """
     Symmetric quantization function
     :param tensor: Tensor to be quantized
     :param bits: Number of bits of quantization
+    :param dim: If given, one scale per slice along the other dims (reduced over dim)
     :return: zero point, scale, quantized tensor
     """
     bit_max = (1 << (bits - 1)) - 1
     bit_min = -bit_max - 1
     if causal_mask:
         # Apply torch.tril to get the lower triangular part (including diagonal)
-        lower_triangular = torch.tril(tensor)
+        lower_triangular = torch.tril(tensor, diagonal=tensor.size(-1) - tensor.size(-2))
 
         # Find the maximum value
         abs_max = lower_triangular.abs().max()
+    elif dim is not None:
+        abs_max = tensor.abs().amax(dim=dim, keepdim=True).clamp(min=1e-8)
     else:
         abs_max = tensor.abs().max()
     scale = abs_max / bit_max
@@ -51,18 +55,24 @@ def symmetric_quantize(tensor, bits, causal_mask=False):
     clamped_array = torch.clamp(xi_array, min=bit_min, max=bit_max).to(dtype=set_dtype(bits))
     return torch.tensor([0], device=tensor.device), scale, clamped_array
 
-def affine_quantize(tensor, bits):
+def affine_quantize(tensor, bits, dim=None):
     """
     Affine (asymmetric) quantization function
     :param tensor: Tensor to be quantized
     :param bits: Number of bits of quantization
+    :param dim: If given, one scale and zero point per slice along the other dims (reduced over dim)
     :return: zero point, scale, quantized tensor
     """
     bit_max = (1 << (bits - 1)) - 1
     bit_min = -bit_max - 1
-    max = tensor.max()
-    min = tensor.min()
-    scale = (max - min) / ((1 << bits) - 1)
+    if dim is not None:
+        max = tensor.amax(dim=dim, keepdim=True)
+        min = tensor.amin(dim=dim, keepdim=True)
+        scale = ((max - min) / ((1 << bits) - 1)).clamp(min=1e-8)
+    else:
+        max = tensor.max()
+        min = tensor.min()
+        scale = (max - min) / ((1 << bits) - 1)
     zero_point = -torch.round(min / scale) + bit_min
     xi_array = torch.round(tensor / scale) + zero_point
     return zero_point, scale, torch.clamp(xi_array, min=bit_min, max=bit_max).to(dtype=set_dtype(bits))
@@ -125,15 +135,94 @@ def dequantize(zero_point, scale, tensor, causal_mask=False):
     dequantized = (tensor - zero_point) * scale
     return dequantized
 
+def pack_int4(tensor):
+    """
+    Pack pairs of 4 bit values (int8 in [-8, 7]) along the last dim into uint8
+    :param tensor: Quantized tensor, last dim must be even
+    :return: uint8 tensor with half the last dim
+    """
+    unsigned = (tensor.to(torch.int16) + 8).to(torch.uint8)
+    return unsigned[..., 0::2] | (unsigned[..., 1::2] << 4)
+
+def unpack_int4(packed):
+    """
+    Inverse of pack_int4
+    :param packed: uint8 tensor
+    :return: int8 tensor in [-8, 7] with twice the last dim
+    """
+    low = (packed & 0xF).to(torch.int8) - 8
+    high = (packed >> 4).to(torch.int8) - 8
+    return torch.stack((low, high), dim=-1).flatten(-2)
+
+def pack_trits(tensor):
+    """
+    Pack ternary values (-1, 0, 1) along the last dim, 5 trits per byte
+    (compression_algorithms/1p58_compression.py): the 5 trits form a base 3
+    number in [0, 242] which is scaled to a byte, rounding up
+    :param tensor: Ternary tensor, the last dim is zero padded to a multiple of 5
+    :return: uint8 tensor with ceil(last dim / 5) bytes
+    """
+    size = tensor.size(-1)
+    digits = tensor.clamp(-1, 1).to(torch.int32) + 1
+    if size % 5:
+        digits = torch.nn.functional.pad(digits, (0, 5 - size % 5), value=1)
+    digits = digits.unflatten(-1, (-1, 5))
+    powers = torch.tensor([81, 27, 9, 3, 1], dtype=torch.int32, device=tensor.device)
+    value = (digits * powers).sum(dim=-1)
+    return ((value * 256 + 242) // 243).to(torch.uint8)
+
+def unpack_trits(packed, size):
+    """
+    Inverse of pack_trits: multiplying a byte by 3 moves the next trit into
+    the bits above the low 8, no division or modulo needed
+    :param packed: uint8 tensor
+    :param size: Number of trits of the last dim before padding
+    :return: int8 tensor in [-1, 1] with last dim size
+    """
+    value = packed.to(torch.int16)
+    trits = []
+    for _ in range(5):
+        value = value * 3
+        trits.append((value >> 8) - 1)
+        value = value & 0xFF
+    return torch.stack(trits, dim=-1).flatten(-2)[..., :size].to(torch.int8)
+
+def static_quantize(tensor, bits, scale, zero_point):
+    """
+    Quantize with a fixed (calibrated) scale and zero point
+    :param tensor: Tensor to be quantized
+    :param bits: Number of bits of quantization
+    :param scale: Calibrated scale, see quantization/ptq.py
+    :param zero_point: Calibrated zero point, 0 for symmetric quantization
+    :return: quantized tensor
+    """
+    bit_max = (1 << (bits - 1)) - 1
+    bit_min = -bit_max - 1
+    xi_array = torch.round(tensor / scale) + zero_point
+    return torch.clamp(xi_array, min=bit_min, max=bit_max).to(dtype=set_dtype(bits))
+
 def fake_quantize_act(obj, activation, tensor, num_bits, quant_method, iter_num, causal_mask=False):
-    zero_point, scale, act = quantize_dictionary[quant_method](tensor, num_bits, causal_mask=causal_mask)
+    # post-training calibration (quantization/ptq.py): record the float activation
+    observers = getattr(obj, "activation_observers", None)
+    if observers is not None and activation in observers:
+        observers[activation].observe(tensor)
+        return tensor
+
+    static_scale = getattr(obj, f"{activation}_static_scale", None)
+    if static_scale is not None:
+        # scales frozen by calibration (static_activation_quant)
+        zero_point = getattr(obj, f"{activation}_static_zero_point")
+        scale = static_scale
+        act = static_quantize(tensor, num_bits, scale, zero_point)
+    else:
+        zero_point, scale, act = quantize_dictionary[quant_method](tensor, num_bits, causal_mask=causal_mask)
     setattr(obj, activation, act)
     setattr(obj, f"{activation}_scale", scale)
     setattr(obj, f"{activation}_zero_point", zero_point)
     dequantized = dequantize(zero_point, scale, act, causal_mask=causal_mask)
     if causal_mask:
         # Create a mask for the upper triangular part
-        upper_tri_mask = torch.triu(torch.ones_like(tensor), diagonal=1).bool()
+        upper_tri_mask = torch.triu(torch.ones_like(tensor), diagonal=1 + tensor.size(-1) - tensor.size(-2)).bool()
 
         # Set the upper triangular part to -inf
         tensor[upper_tri_mask] = 0
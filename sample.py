@@ -1,7 +1,9 @@
 import argparse
 import json
+import math
 import os
 import pickle
+import sys
 import time
 from contextlib import nullcontext
 from datetime import datetime
@@ -12,11 +14,14 @@ import seaborn as sns
 import torch
 import tiktoken
 from rich import print
+from rich.markup import escape
 from torch.nn import functional as F
 from collections import OrderedDict
 
 from model import GPT, GPTConfig
+from variations.kv_cache_variations import KVBlockPool, PrefixCache
 from utils.model_info import print_summary, print_module_structure, print_model_blocks
+from utils.token_shards import load_tokens
 from variations.model_variations import model_variation_dictionary
 
 def parse_args():
@@ -28,13 +33,17 @@ def parse_args():
     parser.add_argument("--start", type=str, default="\n", help="Start text for generation. Can specify a file using 'FILE:prompt.txt'")
     parser.add_argument("--num_samples", type=int, default=3, help="Number of inference streams to draw")
     parser.add_argument("--max_new_tokens", type=int, default=500, help="Number of tokens to generate in each sample")
-    parser.add_argument("--temperature", type=float, default=0.8, help="Temperature for predictions (1.0 = no change, < 1.0 = less random, > 1.0 = more random)")
+    parser.add_argument("--temperature", type=float, default=0.8, help="Temperature for predictions (1.0 = no change, < 1.0 = less random, > 1.0 = more random, 0 = greedy)")
     parser.add_argument("--top_k", type=int, default=200, help="Retain only the top_k most likely tokens")
+    parser.add_argument("--top_p", type=float, default=None, help="Nucleus sampling, retain the most likely tokens up to this cumulative probability")
+    parser.add_argument("--min_p", type=float, default=None, help="Retain only tokens with at least min_p times the probability of the most likely token")
     parser.add_argument("--seed", type=int, default=1337, help="Seed for pseudorandom number generator")
     parser.add_argument("--dtype", type=str, default="bfloat16", choices=["bfloat16", "float16", "float32"], help="Torch data type for inference")
     parser.add_argument('--compile', action=argparse.BooleanOptionalAction, help="Compile the model (requires PyTorch 2.0)")
     parser.add_argument('--sample_file', type=str, default=None, help="Output file for inference")
     parser.add_argument('--interactive', action=argparse.BooleanOptionalAction, help="Enable interactive generation")
+    parser.add_argument('--interactive_keep_prefix', default=True, action=argparse.BooleanOptionalAction, help="Keep the --start prompt in context when an interactive conversation outgrows the block size")
+    parser.add_argument('--interactive_recent_window', type=int, default=None, help="Most recent tokens kept after the prefix when the conversation is truncated, default half the remaining context")
     parser.add_argument('--stop_string', type=str, default='~W', help="String to stop generation and allow user input")
     parser.add_argument('--show_heatmaps', action=argparse.BooleanOptionalAction, help="Show heatmaps of top-k choices for each token")
     parser.add_argument('--last_k_tokens', type=int, default=10, help="Number of last tokens to display in heatmaps")
@@ -42,8 +51,30 @@ def parse_args():
     parser.add_argument('--block_size', type=int, default=None, help="Block size for context length, default is model's block size")
     parser.add_argument('--sym_rot_num_angles', type=int, default=None, help="Number of angles for symmetrical rotary embedding")
     parser.add_argument('--rope_length', type=int, default=None, help="Number of embeddings to rotate (must be an even number <= total embedding size)")
+    parser.add_argument('--quantize_linear_eval_path', type=str, default=None, choices=["dequant", "int8_gemm"], help="Override how quantized_linear layers run inference")
     parser.add_argument('--token_boundary', type=str, default=None, help="optional separator between emitted tokens")
     parser.add_argument('--print_model_info', default=True, action=argparse.BooleanOptionalAction, help="print info about model before infernece")
+    parser.add_argument('--use_kv_cache', default=True, action=argparse.BooleanOptionalAction, help="Cache attention keys/values so each step only processes the newest token")
+    parser.add_argument('--rolling_kv_cache', default=False, action=argparse.BooleanOptionalAction, help="Ring buffer kv cache of window_size positions for sliding window models, generates past block_size at constant memory")
+    parser.add_argument('--attention_sinks', type=int, default=0, help="First tokens kept in the rolling kv cache and visible to every query")
+    parser.add_argument('--kv_cache_quant_bits', type=int, default=None, choices=[8, 4], help="Store the kv cache as int8 or packed int4, dequantized on the fly")
+    parser.add_argument('--kv_cache_quant_method', type=str, default="symmetric_quant", choices=["symmetric_quant", "affine_quant"], help="Quantization of the kv cache, one scale per token, head and group")
+    parser.add_argument('--kv_cache_quant_group_size', type=int, default=None, help="Head channels sharing a kv cache scale, default the whole head")
+    parser.add_argument('--prefix_cache_mb', type=float, default=0, help="Memory budget (MiB) for reusing the kv cache of repeated prompt prefixes across samples, 0 disables")
+
+    # Batched Generation Related
+    parser.add_argument('--prompts_file', type=str, default=None, help="File of prompts to sample in batches, .jsonl (strings or {\"prompt\", \"stop\"} objects) or text with one prompt per line")
+    parser.add_argument('--batch_size', type=int, default=1, help="Rows sampled together per forward pass, > 1 enables batched generation of num_samples copies of --start")
+    parser.add_argument('--batch_stop_string', type=str, default=None, help="Single token string that ends a row in batched generation")
+    parser.add_argument('--kv_pool_blocks', type=int, default=None, help="Page the kv cache of batched generation into a pool of this many blocks")
+    parser.add_argument('--kv_block_len', type=int, default=16, help="Tokens per block of the paged kv cache")
+
+    # Speculative Decoding Related
+    parser.add_argument('--draft_out_dir', type=str, default=None, help="Directory of a small draft checkpoint (same tokenizer) enabling speculative decoding")
+    parser.add_argument('--num_draft_tokens', type=int, default=4, help="Tokens proposed by the draft model per target forward")
+    parser.add_argument('--medusa', default=False, action=argparse.BooleanOptionalAction, help="Self-speculative decoding with the model's medusa heads (tree of candidates verified per forward)")
+    parser.add_argument('--medusa_top_k', type=int, default=2, help="Candidate tokens taken from each medusa head")
+    parser.add_argument('--medusa_max_candidates', type=int, default=16, help="Maximum candidate paths verified per forward")
 
     # Steering Vector Related
     parser.add_argument('--save_avg_vector', type=str, default=None, help="Path to save the average vector of the start text to an .npy file")
@@ -59,7 +90,9 @@ def parse_args():
     parser.add_argument('--lsv_mixture',  type=float, nargs='+', default=None, help="scaling factor mixture")
 
     parser.add_argument("--eval_only", action=argparse.BooleanOptionalAction, help="Enable evaluation only mode to calculate and print validation loss")
-    parser.add_argument("--eval_iters", type=int, default=250, help="iterations for evaluation")
+    parser.add_argument("--eval_iters", type=int, default=None, help="Limit evaluation to this many batches of windows, default the whole validation file")
+    parser.add_argument("--eval_stride", type=int, default=None, help="Tokens between evaluation windows (1 to block_size), each window scores only its last eval_stride tokens (default block_size // 2)")
+    parser.add_argument("--eval_batch_size", type=int, default=8, help="Evaluation windows per forward")
     parser.add_argument("--eval_dataset", type=str, default=None, help="dataset for evaluation")
 
     return parser.parse_args()
@@ -93,11 +126,24 @@ def save_chart(probs, idx, decode, step, out_dir, last_k_tokens, chart_type, sel
     plt.close()
 
 
-def interactive_generation(model, start_ids, device, max_new_tokens, temperature, top_k, stop_string, decode, encode):
+def interactive_generation(model, start_ids, device, max_new_tokens, temperature, top_k, stop_string, decode, encode, use_kv_cache=True, top_p=None, min_p=None,
+                           keep_prefix=True, recent_window=None):
     x = torch.tensor(start_ids, dtype=torch.long, device=device)[None, ...]
+    # the kv cache lives for the whole session, each turn only processes the new tokens
+    kv_cache = model.init_kv_cache(1) if use_kv_cache else None
+    if kv_cache is not None and keep_prefix:
+        if len(start_ids) < kv_cache.max_len // 2:
+            kv_cache.pin_prefix(len(start_ids), recent_window)
+        else:
+            print(f"start prompt of {len(start_ids)} tokens is too long to keep, truncating to the most recent tokens")
     while True:
-        x, generated_text = model.generate_with_stop(x, max_new_tokens, stop_string, decode, temperature, top_k)
-        print("[bold green]" + generated_text)
+        # text is printed as it is generated, the stop string is matched on token ids
+        start_time = time.perf_counter()
+        x, generated_text = model.generate_with_stop(x, max_new_tokens, stop_string, decode, temperature, top_k, use_kv_cache, None, top_p, min_p,
+                                                     encode=encode, stream=lambda text: print(f"[bold green]{escape(text)}", end="", flush=True),
+                                                     kv_cache=kv_cache)
+        print()
+        print(f"turn took {time.perf_counter() - start_time:.2f}s, conversation is {x.size(1)} tokens")
 
         user_input = input("User input (or 'exit' to quit): ")
         if user_input.lower() == 'exit':
@@ -107,6 +153,182 @@ def interactive_generation(model, start_ids, device, max_new_tokens, temperature
         x = torch.cat((x, torch.tensor(encode(user_input), dtype=torch.long, device=device)[None, ...]), dim=1)
 
 
+def load_prompts(prompts_file, default_stop=None):
+    """Read (prompt, stop_string) pairs from a .jsonl or plain text file."""
+    prompts = []
+    with open(prompts_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            if prompts_file.endswith('.jsonl'):
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if isinstance(entry, str):
+                    prompts.append((entry, default_stop))
+                else:
+                    prompts.append((entry['prompt'], entry.get('stop', default_stop)))
+            else:
+                line = line.rstrip('\n')
+                if line:
+                    prompts.append((line, default_stop))
+    return prompts
+
+
+def batched_generation(model, args, start, encode, decode, separator_token, ctx):
+    """Sample many prompts, batch_size rows per forward, each row stopping on its own stop token."""
+    if args.prompts_file:
+        prompts = load_prompts(args.prompts_file, args.batch_stop_string)
+    else:
+        prompts = [(start, args.batch_stop_string)] * args.num_samples
+
+    stop_ids = {}
+    for _, stop in prompts:
+        if stop is not None and stop not in stop_ids:
+            ids = encode(stop)
+            if len(ids) != 1:
+                sys.exit(f"Stop string {stop!r} must encode to a single token, got {len(ids)}")
+            stop_ids[stop] = ids[0]
+
+    kv_pool = None
+    if args.kv_pool_blocks:
+        kv_pool = KVBlockPool(model.config, args.kv_pool_blocks, block_len=args.kv_block_len)
+
+    output_lines = []
+    total_tokens = 0
+    total_time = 0.0
+    with torch.no_grad():
+        with ctx:
+            for b in range(0, len(prompts), args.batch_size):
+                chunk = prompts[b:b + args.batch_size]
+                start_time = time.perf_counter()
+                outputs = model.generate_batch([encode(p) for p, _ in chunk], args.max_new_tokens,
+                                               temperature=args.temperature, top_k=args.top_k,
+                                               stop_tokens=[stop_ids.get(stop) for _, stop in chunk],
+                                               use_kv_cache=args.use_kv_cache, kv_pool=kv_pool,
+                                               kv_quant_bits=args.kv_cache_quant_bits, kv_quant_method=args.kv_cache_quant_method,
+                                               top_p=args.top_p, min_p=args.min_p)
+                total_time += time.perf_counter() - start_time
+                for (prompt, _), out in zip(chunk, outputs):
+                    total_tokens += len(out)
+                    output_line = prompt + decode(out)
+                    if separator_token:
+                        output_line = output_line.replace(separator_token, " ")
+                    output_lines.append(output_line)
+                    print("[bold green]" + output_line)
+                    print('---------------')
+
+    print(f"{len(prompts)} samples, {total_tokens} tokens in {total_time:.2f}s ({total_tokens / max(total_time, 1e-9):.1f} tokens/s)")
+    if kv_pool is not None:
+        print(f"paged kv cache: {kv_pool.num_blocks} blocks of {kv_pool.block_len} tokens, {kv_pool.memory_bytes() / 2**20:.1f} MiB")
+    if args.sample_file:
+        with open(args.sample_file, "w") as file:
+            file.write("\n---------------\n".join(output_lines))
+
+
+def load_checkpoint_model(out_dir, device, model_args=None):
+    """
+    Load the model of out_dir/ckpt.pt for inference, with the checkpoint's
+    model args updated by model_args. Returns the model and the checkpoint.
+    """
+    checkpoint = torch.load(os.path.join(out_dir, 'ckpt.pt'), map_location=device)
+    checkpoint['model_args']['dropout'] = 0.0
+    if model_args:
+        checkpoint['model_args'].update(model_args)
+    model = GPT(GPTConfig(**checkpoint['model_args']))
+    state_dict = checkpoint['model']
+    unwanted_prefix = '_orig_mod.'
+    for k, v in list(state_dict.items()):
+        if k.startswith(unwanted_prefix):
+            state_dict[k[len(unwanted_prefix):]] = state_dict.pop(k)
+    model.load_state_dict(state_dict, strict=False)
+    model.eval()
+    model.to(device)
+    return model, checkpoint
+
+
+def find_meta_path(out_dir, checkpoint):
+    """Tokenizer meta.pkl saved with the checkpoint, or of its dataset, None if missing."""
+    if 'config' not in checkpoint or 'dataset' not in checkpoint['config']:
+        return None
+    meta_paths = [
+        os.path.join(out_dir, 'meta.pkl'),
+        os.path.join('data', checkpoint['config']['dataset'], 'meta.pkl')
+    ]
+    for meta_path in meta_paths:
+        if os.path.exists(meta_path):
+            return meta_path
+    return None
+
+
+def load_tokenizer(meta_path, token_boundary=None):
+    """Build encode/decode functions from meta.pkl, returns (encode, decode, separator_token)."""
+    print(f"Loading meta from {meta_path}...")
+    separator_token = None
+    with open(meta_path, 'rb') as f:
+        meta = pickle.load(f)
+    if 'tokenizer' in meta and meta['tokenizer'] == 'tiktoken':
+        enc = tiktoken.get_encoding(meta['tiktoken_encoding'])
+        print(f"using tiktoken encoding {meta['tiktoken_encoding']}")
+        encode = lambda s: enc.encode(s, allowed_special={""})
+        decode = lambda l: enc.decode(l)
+    elif 'tokenizer' in meta and meta['tokenizer'] == 'sentencepiece':
+        separator_token = "▁"
+        stoi, itos = meta['stoi'], meta['itos']
+        encode = lambda s: [stoi[c] for c in s]
+        decode = lambda l: ''.join([itos[i] for i in l])
+    elif 'tokenizer' in meta and meta['tokenizer'] == 'custom_char_with_byte_fallback':
+        stoi = meta['stoi']
+        itos = meta['itos']
+        custom_char_count = meta['custom_char_count']
+        encode = lambda s: custom_char_with_byte_fallback_encode(s, stoi)
+        decode = lambda l: custom_char_with_byte_fallback_decode(l, itos, custom_char_count)
+        print("Using CustomCharTokenizerWithByteFallback tokenizer")
+    elif token_boundary:
+        stoi, itos = meta['stoi'], meta['itos']
+        encode = lambda s: [stoi[c] for c in s]
+        decode = lambda l: token_boundary.join([itos[i] for i in l])
+    else:
+        stoi, itos = meta['stoi'], meta['itos']
+        encode = lambda s: [stoi[c] for c in s]
+        decode = lambda l: ''.join([itos[i] for i in l])
+    return encode, decode, separator_token
+
+
+def speculative_generation(model, draft_model, args, start_ids, decode, separator_token, ctx):
+    """Sample num_samples sequences with speculative decoding (a draft model, or
+    the medusa heads when draft_model is None), reporting acceptance and tokens/sec."""
+    with torch.no_grad():
+        with ctx:
+            for k in range(args.num_samples):
+                x = torch.tensor(start_ids, dtype=torch.long, device=args.device)[None, ...]
+                start_time = time.perf_counter()
+                if draft_model is not None:
+                    x, stats = model.generate_speculative(x, draft_model, args.max_new_tokens,
+                                                          num_draft_tokens=args.num_draft_tokens,
+                                                          temperature=args.temperature, top_k=args.top_k,
+                                                          use_kv_cache=args.use_kv_cache, top_p=args.top_p, min_p=args.min_p)
+                else:
+                    x, stats = model.generate_medusa(x, args.max_new_tokens,
+                                                     temperature=args.temperature, top_k=args.top_k,
+                                                     medusa_top_k=args.medusa_top_k,
+                                                     max_candidates=args.medusa_max_candidates,
+                                                     use_kv_cache=args.use_kv_cache, top_p=args.top_p, min_p=args.min_p)
+                elapsed = time.perf_counter() - start_time
+
+                output_line = decode(x[0].tolist()).replace(separator_token, " ") if separator_token else decode(x[0].tolist())
+                print("[bold green]" + output_line)
+                if draft_model is not None:
+                    acceptance_rate = stats["accepted"] / max(stats["proposed"], 1)
+                    print(f"acceptance rate {acceptance_rate:.3f} ({stats['accepted']}/{stats['proposed']}), "
+                          f"{stats['target_forwards']} target forwards, {args.max_new_tokens / elapsed:.1f} tokens/s")
+                else:
+                    print(f"{args.max_new_tokens / max(stats['forwards'], 1):.2f} tokens per forward "
+                          f"({stats['accepted']} from medusa heads), {args.max_new_tokens / elapsed:.1f} tokens/s")
+                print('---------------')
+                if args.sample_file:
+                    with open(args.sample_file, "w") as file:
+                        file.write(output_line)
+
+
 def save_args(args, out_dir):
     with open(os.path.join(out_dir, 'args.json'), 'w') as f:
         json.dump(vars(args), f, indent=4)
@@ -122,36 +344,71 @@ def save_quantized_data(state_dict, out_file):
     with open(f"{out_file}.pkl", 'wb') as f:
         pickle.dump(to_save, f)
 
-def load_validation_data(block_size, eval_dataset):
-    # Load validation data similar to how train data is handled
-    val_path = os.path.join('data', eval_dataset, 'val.bin')
-    assert os.path.exists(val_path), f"Validation data file {val_path} not found."
-    # Assuming validation data is similar in format to train data
-    val_data = np.memmap(val_path, dtype=np.uint16, mode='r')
-    return val_data
-
-def get_batch(data, block_size, device):
-    # Create a random batch from the dataset
-    ix = torch.randint(len(data) - block_size, (1,))
-    x = torch.stack([torch.from_numpy((data[i:i + block_size]).astype(np.int64)) for i in ix])
-    y = torch.stack([torch.from_numpy((data[i + 1:i + 1 + block_size]).astype(np.int64)) for i in ix])
-    return x.to(device), y.to(device)
-
-def calculate_validation_loss(model, val_data, block_size, eval_iters, device, dtype):
-    model.eval()
-    losses = []
+def load_validation_data(eval_dataset, vocab_size=None):
+    """Validation tokens of data/<eval_dataset>, token shards or val.bin, loaded the same way as in train.py."""
+    try:
+        return load_tokens(os.path.join('data', eval_dataset), 'val', vocab_size)
+    except ValueError as e:
+        sys.exit(f"Error: {e}")
+
+def strided_windows(num_tokens, block_size, stride):
+    """
+    (start, end, num_scored) of windows covering every target of a token file
+    exactly once. Each window is data[start:end] with at most block_size
+    tokens; its last num_scored targets are new, the rest is context already
+    scored by the previous window.
+    """
+    assert 0 < stride <= block_size, f"stride {stride} must be between 1 and block_size {block_size}"
+    windows = []
+    prev_end = 0
+    last = num_tokens - 1 # the final token is only a target
+    while prev_end < last:
+        end = min(prev_end + stride, last) if prev_end else min(block_size, last)
+        windows.append((max(0, end - block_size), end, end - prev_end))
+        prev_end = end
+    return windows
+
+def evaluate_perplexity(model, val_data, block_size, stride, batch_size, device, ctx, decode=None, max_batches=None):
+    """
+    Deterministic perplexity over the whole of val_data: overlapping windows
+    of block_size tokens, stride apart, batch_size windows per forward, each
+    token scored once with up to block_size - stride tokens of context.
+    Returns a dict with the loss (nats per token), perplexity, token count and,
+    given decode, bits per byte of the scored text.
+    """
+    windows = strided_windows(len(val_data), block_size, stride)
+    # windows of equal length batch together, only the first ones of short files differ
+    windows.sort(key=lambda w: w[1] - w[0])
+    batches = [windows[i:i + batch_size] for i in range(0, len(windows), batch_size)]
+    if max_batches is not None:
+        batches = batches[:max_batches]
+
+    total_nll = 0.0
+    total_tokens = 0
+    start_time = time.perf_counter()
     with torch.no_grad():
-        total_time = 0
-        for _ in range(eval_iters):
-            X, Y = get_batch(val_data,  block_size, device)
-            with torch.amp.autocast(device_type=device, dtype=dtype):
-                start = time.perf_counter()
-                logits, loss = model(X, Y)
-                end = time.perf_counter()
-                total_time += (end - start)
-            losses.append(loss.item())
-    print(f"Elapsed time: {total_time} seconds")
-    return np.mean(losses)
+        with ctx:
+            for batch in batches:
+                groups = {}
+                for w in batch:
+                    groups.setdefault(w[1] - w[0], []).append(w)
+                for length, group in groups.items():
+                    x = torch.from_numpy(np.stack([val_data[s:e] for s, e, _ in group]).astype(np.int64)).to(device)
+                    y = torch.from_numpy(np.stack([val_data[s + 1:e + 1] for s, e, _ in group]).astype(np.int64)).to(device)
+                    logits, _ = model(x, full_logits=True)
+                    nll = F.cross_entropy(logits.float().view(-1, logits.size(-1)), y.view(-1), reduction='none').view(len(group), length)
+                    scored = torch.arange(length, device=device)[None, :] >= torch.tensor([length - n for _, _, n in group], device=device)[:, None]
+                    total_nll += nll[scored].sum().item()
+                    total_tokens += int(scored.sum().item())
+    elapsed = time.perf_counter() - start_time
+
+    loss = total_nll / max(total_tokens, 1)
+    result = {"loss": loss, "perplexity": math.exp(loss), "tokens": total_tokens, "windows": sum(len(b) for b in batches), "seconds": elapsed}
+    if decode is not None:
+        scored_ranges = sorted((e - n + 1, e + 1) for batch in batches for _, e, n in batch)
+        num_bytes = sum(len(decode(val_data[s:e].tolist()).encode('utf-8')) for s, e in scored_ranges)
+        result["bits_per_byte"] = total_nll / math.log(2) / max(num_bytes, 1)
+    return result
 
 def custom_char_with_byte_fallback_encode(text, stoi):
     ids = []
@@ -206,13 +463,13 @@ def main():
     save_args(args, out_dir)
 
     if args.init_from == 'resume':
-        ckpt_path = os.path.join(args.out_dir, 'ckpt.pt')
-        checkpoint = torch.load(ckpt_path, map_location=args.device)
-        checkpoint['model_args']['dropout'] = 0.0
+        model_args = {}
+        if args.quantize_linear_eval_path:
+            model_args['quantize_linear_eval_path'] = args.quantize_linear_eval_path
         if args.save_avg_vector:
             print(f"saving {args.save_avg_vector}")
-            checkpoint['model_args']['obtain_vector_at_layer_idx'] = args.apply_to_layer_idx
-            checkpoint['model_args']['obtain_vector_file'] = args.save_avg_vector
+            model_args['obtain_vector_at_layer_idx'] = args.apply_to_layer_idx
+            model_args['obtain_vector_file'] = args.save_avg_vector
         # If vectors are provided, load and subtract them, then apply to a designated layer during generation
         if args.apply_vector_file1 and args.apply_vector_file2:
             vector1 = np.load(args.apply_vector_file1)
@@ -224,21 +481,14 @@ def main():
             np.save("temp.npy", diff_vector_cpu)
 
             # Convert to tensor and set in the model for application at the designated layer
-            checkpoint['model_args']['apply_vector_file']= "temp.npy"
-            checkpoint['model_args']['apply_vector_at_layer_idx']= args.apply_to_layer_idx
-            checkpoint['model_args']['apply_vector_scaling_factor']= args.steering_vector_scaling_factor
-        gptconf = GPTConfig(**checkpoint['model_args'])
-        model = GPT(gptconf)
-        state_dict = checkpoint['model']
-        unwanted_prefix = '_orig_mod.'
-        for k, v in list(state_dict.items()):
-            if k.startswith(unwanted_prefix):
-                state_dict[k[len(unwanted_prefix):]] = state_dict.pop(k)
+            model_args['apply_vector_file'] = "temp.npy"
+            model_args['apply_vector_at_layer_idx'] = args.apply_to_layer_idx
+            model_args['apply_vector_scaling_factor'] = args.steering_vector_scaling_factor
+        model, checkpoint = load_checkpoint_model(args.out_dir, args.device, model_args)
 
         if args.quantization_data_file:
-            save_quantized_data(state_dict, args.quantization_data_file)
-
-        model.load_state_dict(state_dict, strict=False)
+            # the state dict with the torch.compile prefix already stripped
+            save_quantized_data(checkpoint['model'], args.quantization_data_file)
 
     else:
         # Need to create a completely "default" GPTConfig and overwrite using model_variations
@@ -249,49 +499,13 @@ def main():
         model = GPT.from_pretrained(gptconf, model_type=args.init_from)
 
     # Load meta information if available
-    load_meta = False
     meta_path = None
     separator_token = None
-    if args.init_from == 'resume' and 'config' in checkpoint and 'dataset' in checkpoint['config']:
-        meta_paths = [
-            os.path.join(args.out_dir, 'meta.pkl'),
-            os.path.join('data', checkpoint['config']['dataset'], 'meta.pkl')
-        ]
-
-        for meta_path in meta_paths:
-            if os.path.exists(meta_path):
-                load_meta = True
-                break
-
-    if load_meta:
-        print(f"Loading meta from {meta_path}...")
-        with open(meta_path, 'rb') as f:
-            meta = pickle.load(f)
-        if 'tokenizer' in meta and meta['tokenizer'] == 'tiktoken':
-            enc = tiktoken.get_encoding(meta['tiktoken_encoding'])
-            print(f"using tiktoken encoding {meta['tiktoken_encoding']}")
-            encode = lambda s: enc.encode(s, allowed_special={""})
-            decode = lambda l: enc.decode(l)
-        elif 'tokenizer' in meta and meta['tokenizer'] == 'sentencepiece':
-            separator_token = "▁"
-            stoi, itos = meta['stoi'], meta['itos']
-            encode = lambda s: [stoi[c] for c in s]
-            decode = lambda l: ''.join([itos[i] for i in l])
-        elif 'tokenizer' in meta and meta['tokenizer'] == 'custom_char_with_byte_fallback':
-            stoi = meta['stoi']
-            itos = meta['itos']
-            custom_char_count = meta['custom_char_count']
-            encode = lambda s: custom_char_with_byte_fallback_encode(s, stoi)
-            decode = lambda l: custom_char_with_byte_fallback_decode(l, itos, custom_char_count)
-            print("Using CustomCharTokenizerWithByteFallback tokenizer")
-        elif args.token_boundary:
-            stoi, itos = meta['stoi'], meta['itos']
-            encode = lambda s: [stoi[c] for c in s]
-            decode = lambda l: args.token_boundary.join([itos[i] for i in l])
-        else:
-            stoi, itos = meta['stoi'], meta['itos']
-            encode = lambda s: [stoi[c] for c in s]
-            decode = lambda l: ''.join([itos[i] for i in l])
+    if args.init_from == 'resume':
+        meta_path = find_meta_path(args.out_dir, checkpoint)
+
+    if meta_path is not None:
+        encode, decode, separator_token = load_tokenizer(meta_path, args.token_boundary)
 
 
     if args.start.startswith('FILE:'):
@@ -326,15 +540,25 @@ def main():
 
     if args.eval_only:
         print("Running in eval_only mode...")
-        # Load the validation dataset
-        print(model.config.block_size)
-        val_data = load_validation_data(model.config.block_size,
-                                        args.eval_dataset)
-        # Calculate validation loss
-        val_loss = calculate_validation_loss(model, val_data,
-                                             model.config.block_size,
-                                             args.eval_iters, args.device, ptdtype)
-        print(f"Validation Loss: {val_loss:.4f}")
+        eval_dataset = args.eval_dataset if args.eval_dataset else checkpoint['config']['dataset']
+        # byte counts come from the eval dataset's tokenizer
+        eval_meta_path = os.path.join('data', eval_dataset, 'meta.pkl')
+        if not os.path.exists(eval_meta_path):
+            eval_meta_path = meta_path
+        eval_decode = load_tokenizer(eval_meta_path, args.token_boundary)[1] if eval_meta_path else None
+        val_data = load_validation_data(eval_dataset, model.config.vocab_size)
+        block_size = model.config.block_size
+        stride = args.eval_stride if args.eval_stride is not None else max(1, block_size // 2)
+        if not 0 < stride <= block_size:
+            sys.exit(f"--eval_stride must be between 1 and the block size {block_size}, got {stride}")
+        result = evaluate_perplexity(model, val_data, block_size, stride, args.eval_batch_size,
+                                     args.device, ctx, eval_decode, args.eval_iters)
+        print(f"Evaluated {result['tokens']} tokens in {result['windows']} windows "
+              f"(block_size {block_size}, stride {stride}) in {result['seconds']:.2f}s")
+        print(f"Validation Loss: {result['loss']:.4f}")
+        print(f"Perplexity: {result['perplexity']:.4f}")
+        if "bits_per_byte" in result:
+            print(f"Bits per byte: {result['bits_per_byte']:.4f}")
         return
 
     x = torch.tensor(start_ids, dtype=torch.long, device=args.device)[None, ...]
@@ -351,10 +575,23 @@ def main():
 
 
 
-    if args.interactive:
-        interactive_generation(model, start_ids, args.device, args.max_new_tokens, args.temperature, args.top_k, args.stop_string, decode, encode)
+    prefix_cache = PrefixCache(int(args.prefix_cache_mb * 2**20)) if args.prefix_cache_mb > 0 else None
+    if args.rolling_kv_cache and (model.config.window_size is None or model.config.use_abs_pos_embeddings):
+        sys.exit("--rolling_kv_cache needs a model trained with window_size and without absolute position embeddings")
+
+    if args.draft_out_dir:
+        draft_model, _ = load_checkpoint_model(args.draft_out_dir, args.device)
+        speculative_generation(model, draft_model, args, start_ids, decode, separator_token, ctx)
+    elif args.medusa:
+        speculative_generation(model, None, args, start_ids, decode, separator_token, ctx)
+    elif args.prompts_file or args.batch_size > 1:
+        batched_generation(model, args, args.start, encode, decode, separator_token, ctx)
+    elif args.interactive:
+        interactive_generation(model, start_ids, args.device, args.max_new_tokens, args.temperature, args.top_k, args.stop_string, decode, encode, args.use_kv_cache, args.top_p, args.min_p,
+                               args.interactive_keep_prefix, args.interactive_recent_window)
     else:
         # Run generation
+        sampler = model.sampler(args.temperature, args.top_k, args.top_p, args.min_p)
         with torch.no_grad():
             with ctx:
                 for k in range(args.num_samples):
@@ -369,19 +606,25 @@ def main():
                         else:
                             model.set_lsv_mode(1)
                     x = torch.tensor(start_ids, dtype=torch.long, device=args.device)[None, ...]
-                    block_size = args.block_size if args.block_size else model.config.block_size
+                    kv_cache = None
+                    if args.use_kv_cache:
+                        kv_cache = model.init_kv_cache(x.size(0), rolling=args.rolling_kv_cache, num_sink=args.attention_sinks,
+                                                       quant_bits=args.kv_cache_quant_bits, quant_method=args.kv_cache_quant_method,
+                                                       quant_group_size=args.kv_cache_quant_group_size)
+                    # steering vectors change the keys/values, so each lsv setting gets its own entries
+                    prefix_namespace = (k % args.lsv_size, args.lsv_scaling_factor, args.lsv_mixture) if args.use_lsv else None
+                    if prefix_cache is not None:
+                        prefix_cache.restore(x, kv_cache, prefix_namespace)
                     for step in range(args.max_new_tokens):
-                        idx_cond = x if x.size(1) <= block_size else x[:, -block_size:]
-                        logits, _ = model(idx_cond)
-                        logits = logits[:, -1, :] / args.temperature
-                        if args.top_k is not None:
-                            v, _ = torch.topk(logits, min(args.top_k, logits.size(-1)))
-                            logits[logits < v[:, [-1]]] = -float('Inf')
-                        probs = F.softmax(logits, dim=-1)
-                        idx_next = torch.multinomial(probs, num_samples=1)
+                        idx_cond = model.crop_idx_cond(x, kv_cache)
+                        logits, _ = model(idx_cond, kv_cache=kv_cache)
+                        if step == 0 and prefix_cache is not None:
+                            prefix_cache.store(x, kv_cache, prefix_namespace)
+                        idx_next = sampler.sample(logits[:, -1, :])
                         x = torch.cat((x, idx_next), dim=1)
 
                         if args.show_heatmaps:
+                            probs = sampler.probs(logits[:, -1, :])
                             selected_token = decode([idx_next[0].item()])
                             save_chart(probs, x, decode, step, out_dir, args.last_k_tokens, args.chart_type, selected_token)
 
@@ -393,6 +636,8 @@ def main():
                     if args.sample_file:
                         with open(args.sample_file, "w") as file:
                             file.write(output_line)
+                if prefix_cache is not None:
+                    print(f"prefix cache: {prefix_cache.stats()}")
 
 if __name__ == "__main__":
     main()
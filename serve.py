@@ -0,0 +1,342 @@
+"""
+Local inference server with continuous batching.
+
+Loads a checkpoint once (like sample.py) and serves generation requests over
+HTTP/JSON on a TCP port or a Unix socket. Requests join the running batch
+between decode steps: every iteration first prefills newly arrived prompts,
+then runs a single forward for the next token of all active sequences. Their
+keys and values live in a paged kv cache, so sequences of any length share
+one memory pool.
+
+API:
+  POST /generate  {"prompt": str, "max_new_tokens": int, "temperature": float,
+                   "top_k": int, "top_p": float, "min_p": float,
+                   "stop": str or [str], "stream": bool}
+                  with "stream" the response is newline delimited JSON,
+                  one {"text": ...} per token and a final {"done": true, ...},
+                  which holds an "error" when generation failed
+  GET  /health    pool and queue status
+"""
+
+import argparse
+import json
+import os
+import queue
+import socketserver
+import sys
+import threading
+import time
+import traceback
+from contextlib import nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import torch
+
+from sample import load_checkpoint_model, find_meta_path, load_tokenizer
+from utils.streaming import StreamingDetokenizer, StopSequenceMatcher
+from variations.kv_cache_variations import KVBlockPool, PagedKVCache, PagedSequence
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Continuous batching inference server")
+    parser.add_argument("--out_dir", type=str, default="out", help="Directory to load checkpoint from")
+    parser.add_argument("--device", type=str, default="cuda", help="Device to run inference (e.g., 'cpu', 'cuda', 'cuda:0')")
+    parser.add_argument("--dtype", type=str, default="bfloat16", choices=["bfloat16", "float16", "float32"], help="Torch data type for inference")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=8000, help="TCP port to listen on")
+    parser.add_argument("--unix_socket", type=str, default=None, help="Serve on this Unix socket path instead of TCP")
+    parser.add_argument("--max_batch_size", type=int, default=32, help="Maximum number of sequences decoded together")
+    parser.add_argument("--kv_pool_blocks", type=int, default=1024, help="Blocks in the paged kv cache pool")
+    parser.add_argument("--kv_block_len", type=int, default=16, help="Tokens per kv cache block")
+    parser.add_argument("--max_new_tokens", type=int, default=256, help="Default number of tokens to generate per request")
+    parser.add_argument("--temperature", type=float, default=0.8, help="Default sampling temperature")
+    parser.add_argument("--top_k", type=int, default=200, help="Default top_k")
+    parser.add_argument("--top_p", type=float, default=None, help="Default nucleus sampling probability")
+    parser.add_argument("--min_p", type=float, default=None, help="Default min_p")
+    parser.add_argument("--token_boundary", type=str, default=None, help="optional separator between emitted tokens")
+    parser.add_argument("--seed", type=int, default=1337, help="Seed for pseudorandom number generator")
+    return parser.parse_args()
+
+
+class GenerationRequest:
+    """ One client request, its kv cache sequence and the queue its output is streamed to. """
+    def __init__(self, prompt_ids, max_new_tokens, sampler, stop_matcher, decode):
+        self.prompt_ids = prompt_ids
+        self.max_new_tokens = max_new_tokens
+        self.sampler = sampler
+        self.stop_matcher = stop_matcher
+        self.detokenizer = StreamingDetokenizer(decode)
+        self.tokens = list(prompt_ids)
+        self.generated = []
+        self.text = ""
+        self.seq = None
+        self.next_logits = None
+        self.events = queue.Queue()
+        self.start_time = time.perf_counter()
+
+
+class ContinuousBatchScheduler:
+    """ Iteration level scheduler: admits, prefills and decodes requests one step at a time. """
+    def __init__(self, model, pool, max_batch_size, ctx):
+        self.model = model
+        self.pool = pool
+        self.max_batch_size = max_batch_size
+        self.ctx = ctx
+        self.block_size = model.config.block_size
+        self.pending = queue.Queue()
+        self.waiting = []
+        self.active = []
+        self.tokens_generated = 0
+
+    def submit(self, request):
+        self.pending.put(request)
+
+    def _blocks_needed(self, n_tokens):
+        return (n_tokens + self.pool.block_len - 1) // self.pool.block_len
+
+    def _prefill(self, request, tokens):
+        """Run the prompt (or the most recent tokens after a refill) into a fresh sequence."""
+        request.seq = PagedSequence(self.pool)
+        kv_cache = PagedKVCache(self.model.config, self.pool, sequences=[request.seq])
+        idx = torch.tensor(tokens, dtype=torch.long, device=self.model.transformer.wte.weight.device)[None, :]
+        logits, _ = self.model(idx, kv_cache=kv_cache)
+        request.next_logits = logits[0, -1]
+
+    def _admit(self):
+        while True:
+            try:
+                self.waiting.append(self.pending.get_nowait())
+            except queue.Empty:
+                break
+        while self.waiting and len(self.active) < self.max_batch_size:
+            request = self.waiting[0]
+            tokens = request.tokens[-self.block_size:]
+            # keep room for the prompt and a block of decoding
+            if self._blocks_needed(len(tokens)) + 1 > self.pool.num_free_blocks:
+                break
+            self.waiting.pop(0)
+            # active before the prefill, so a failing prefill is reported to its client
+            self.active.append(request)
+            self._prefill(request, tokens)
+
+    def _finish(self, request, reason, error=None):
+        if request.seq is not None:
+            request.seq.free()
+        elapsed = time.perf_counter() - request.start_time
+        event = {"done": True, "finish_reason": reason, "text": request.text,
+                 "tokens": len(request.generated), "seconds": elapsed}
+        if error is not None:
+            event["error"] = error
+        request.events.put(event)
+
+    def _abort_active(self, error):
+        """End every active request with error, after a step failed part way through."""
+        for request in self.active:
+            self._finish(request, "error", error)
+        self.active = []
+
+    def _emit(self, request, token):
+        """Append a sampled token, stream its text, return a finish reason or None."""
+        request.tokens.append(token)
+        request.generated.append(token)
+        reason = None
+        if request.stop_matcher is not None and request.stop_matcher.push(token):
+            reason = "stop"
+        elif len(request.generated) >= request.max_new_tokens:
+            reason = "length"
+        delta = request.detokenizer.push(token)
+        if reason is not None:
+            delta += request.detokenizer.flush()
+        request.text += delta
+        if delta:
+            request.events.put({"text": delta})
+        return reason
+
+    def step(self):
+        """Admit new requests, then sample one token for every active request."""
+        self._admit()
+        if not self.active:
+            return False
+
+        finished = []
+        for request in self.active:
+            token = int(request.sampler.sample(request.next_logits[None, :]))
+            reason = self._emit(request, token)
+            if reason is not None:
+                finished.append((request, reason))
+        for request, reason in finished:
+            self.active.remove(request)
+            self._finish(request, reason)
+        self.tokens_generated += len(self.active) + len(finished)
+
+        # sequences at the end of the context window restart from their latest half block
+        running = []
+        for request in self.active:
+            if request.seq.lengths[0] + 1 > self.block_size:
+                request.seq.free()
+                self._prefill(request, request.tokens[-(self.block_size // 2):])
+            else:
+                running.append(request)
+        if not running:
+            return True
+
+        # sequences at a block boundary need a new block, preempt the newest
+        # requests back to the queue (to be prefilled again) when the pool runs out
+        while sum(r.seq.lengths[0] % self.pool.block_len == 0 for r in running) > self.pool.num_free_blocks:
+            victim = running.pop()
+            self.active.remove(victim)
+            victim.seq.free()
+            self.waiting.insert(0, victim)
+        if not running:
+            return True
+
+        # one forward for the newest token of every running sequence
+        kv_cache = PagedKVCache(self.model.config, self.pool, sequences=[r.seq for r in running])
+        device = self.model.transformer.wte.weight.device
+        idx = torch.tensor([[r.tokens[-1]] for r in running], dtype=torch.long, device=device)
+        logits, _ = self.model(idx, kv_cache=kv_cache)
+        for r, row_logits in zip(running, logits[:, -1]):
+            r.next_logits = row_logits
+        return True
+
+    def run(self):
+        with torch.no_grad():
+            with self.ctx:
+                while True:
+                    try:
+                        busy = self.step()
+                    except Exception as e:
+                        # the requests of the failed step get the error, the server keeps serving
+                        traceback.print_exc()
+                        self._abort_active(f"{type(e).__name__}: {e}")
+                        continue
+                    if not busy:
+                        # idle, block until a request arrives
+                        self.waiting.append(self.pending.get())
+
+
+def make_handler(scheduler, encode, decode, defaults):
+    class GenerationHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def address_string(self):
+            # client_address is empty for Unix sockets
+            return str(self.client_address[0]) if self.client_address else "unix"
+
+        def _send_json(self, status, payload):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send_chunk(self, payload):
+            data = (json.dumps(payload) + "\n").encode("utf-8")
+            self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+            self.wfile.flush()
+
+        def do_GET(self):
+            if self.path != "/health":
+                self._send_json(404, {"error": "not found"})
+                return
+            self._send_json(200, {"active": len(scheduler.active), "waiting": len(scheduler.waiting) + scheduler.pending.qsize(),
+                                  "free_blocks": scheduler.pool.num_free_blocks, "num_blocks": scheduler.pool.num_blocks,
+                                  "tokens_generated": scheduler.tokens_generated})
+
+        def do_POST(self):
+            if self.path != "/generate":
+                self._send_json(404, {"error": "not found"})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                prompt_ids = encode(body["prompt"])
+            except (ValueError, KeyError) as e:
+                self._send_json(400, {"error": f"bad request: {e}"})
+                return
+            if not prompt_ids:
+                self._send_json(400, {"error": "prompt encodes to no tokens"})
+                return
+            if scheduler._blocks_needed(min(len(prompt_ids), scheduler.block_size)) + 1 > scheduler.pool.num_blocks:
+                self._send_json(400, {"error": "prompt does not fit in the kv cache pool"})
+                return
+
+            sampler = scheduler.model.sampler(float(body.get("temperature", defaults.temperature)),
+                                              body.get("top_k", defaults.top_k),
+                                              body.get("top_p", defaults.top_p),
+                                              body.get("min_p", defaults.min_p))
+            stop = body.get("stop")
+            try:
+                # stop strings are matched on token ids, one or a list of them
+                stop_matcher = StopSequenceMatcher.from_strings([stop] if isinstance(stop, str) else stop, encode) if stop else None
+            except (KeyError, TypeError) as e:
+                self._send_json(400, {"error": f"bad stop: {e}"})
+                return
+            request = GenerationRequest(prompt_ids,
+                                        int(body.get("max_new_tokens", defaults.max_new_tokens)),
+                                        sampler,
+                                        stop_matcher,
+                                        decode)
+            scheduler.submit(request)
+
+            if body.get("stream", False):
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                while True:
+                    event = request.events.get()
+                    self._send_chunk(event)
+                    if event.get("done"):
+                        break
+                self.wfile.write(b"0\r\n\r\n")
+            else:
+                while True:
+                    event = request.events.get()
+                    if event.get("done"):
+                        self._send_json(500 if "error" in event else 200, event)
+                        break
+
+    return GenerationHandler
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def main():
+    args = parse_args()
+
+    torch.manual_seed(args.seed)
+    device_type = 'cuda' if 'cuda' in args.device else 'cpu'
+    ptdtype = {'bfloat16': torch.bfloat16, 'float16': torch.float16, 'float32': torch.float32}[args.dtype]
+    ctx = nullcontext() if device_type == 'cpu' else torch.amp.autocast(device_type=device_type, dtype=ptdtype)
+
+    model, checkpoint = load_checkpoint_model(args.out_dir, args.device)
+    if model.config.attention_variant != "causal":
+        sys.exit(f"attention_variant {model.config.attention_variant} has no kv cache support, cannot serve")
+    meta_path = find_meta_path(args.out_dir, checkpoint)
+    if meta_path is None:
+        sys.exit(f"No meta.pkl found for checkpoint in {args.out_dir}")
+    encode, decode, separator_token = load_tokenizer(meta_path, args.token_boundary)
+    if separator_token:
+        decode_tokens = decode
+        decode = lambda l: decode_tokens(l).replace(separator_token, " ")
+
+    pool = KVBlockPool(model.config, args.kv_pool_blocks, block_len=args.kv_block_len)
+    scheduler = ContinuousBatchScheduler(model, pool, args.max_batch_size, ctx)
+    threading.Thread(target=scheduler.run, daemon=True).start()
+
+    handler = make_handler(scheduler, encode, decode, args)
+    if args.unix_socket:
+        if os.path.exists(args.unix_socket):
+            os.remove(args.unix_socket)
+        server = ThreadingUnixHTTPServer(args.unix_socket, handler)
+        print(f"serving {args.out_dir} on unix socket {args.unix_socket}")
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), handler)
+        print(f"serving {args.out_dir} on http://{args.host}:{args.port}")
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+#/bin/bash
+
+# head to repo root
+cd ../
+
+dataset="shakespeare_char"
+python3 "data/${dataset}/prepare.py"
+
+n_layer="2"
+n_head="2"
+n_embd="60"
+max_iters="50"
+block_size="32"
+eval_iters="20"
+eval_interval="25"
+timestamp="$(date +%F_%T)"
+notes="check_data_loading"
+
+# background prefetching with each sampling method, and with gradient accumulation
+sampling_methods=("random" "sequential" "without_replacement")
+for sampling_method in "${sampling_methods[@]}"
+do
+  output_dir="results/${timestamp}_${notes}_prefetch_${sampling_method}"
+  if [ ! -d "${output_dir}" ]; then
+    mkdir -p "${output_dir}"
+  fi
+
+  python3 train.py \
+    --max_iters "$max_iters" \
+    --n_layer "$n_layer" \
+    --n_head "$n_head" \
+    --n_embd "$n_embd" \
+    --eval_iters "$eval_iters" \
+    --eval_interval "$eval_interval" \
+    --log_interval 10 \
+    --device cpu \
+    --dataset "$dataset" \
+    --block_size "$block_size" \
+    --sampling_method "$sampling_method" \
+    --prefetch_batches 4 \
+    --gradient_accumulation_steps 2 \
+    --csv_name "prefetch_${sampling_method}" \
+    --out_dir "${output_dir}"
+
+  sleep 1
+done
+
+# data worker processes, two runs with the same seed and worker count have to match
+for run in 1 2
+do
+  output_dir="results/${timestamp}_${notes}_workers_${run}"
+  if [ ! -d "${output_dir}" ]; then
+    mkdir -p "${output_dir}"
+  fi
+
+  python3 train.py \
+    --max_iters "$max_iters" \
+    --n_layer "$n_layer" \
+    --n_head "$n_head" \
+    --n_embd "$n_embd" \
+    --eval_iters "$eval_iters" \
+    --eval_interval "$eval_interval" \
+    --log_interval 10 \
+    --device cpu \
+    --dataset "$dataset" \
+    --block_size "$block_size" \
+    --sampling_method without_replacement \
+    --data_workers 2 \
+    --no-tensorboard_log \
+    --csv_dir "csv_logs/${timestamp}_${notes}_workers_${run}" \
+    --csv_name "workers" \
+    --out_dir "${output_dir}"
+
+  sleep 1
+done
+
+# the loss columns of the two runs
+cut -d, -f3,4 "csv_logs/${timestamp}_${notes}_workers_1/${dataset}_workers.csv" > "results/${timestamp}_${notes}_workers_1.losses"
+cut -d, -f3,4 "csv_logs/${timestamp}_${notes}_workers_2/${dataset}_workers.csv" > "results/${timestamp}_${notes}_workers_2.losses"
+if ! cmp -s "results/${timestamp}_${notes}_workers_1.losses" "results/${timestamp}_${notes}_workers_2.losses"; then
+  echo "data worker runs with the same seed differ"
+  exit 1
+fi
+
+# document packing: shakespeare speeches (separated by blank lines) as documents
+packed_dataset="shakespeare_char_packed"
+mkdir -p "data/${packed_dataset}"
+pushd "data/${packed_dataset}"
+python3 ../template/prepare.py --method char -t ../shakespeare_char/input.txt --document_separator '\n\n'
+popd
+
+position_encodings=("--use_abs_pos_embeddings --no-use_rotary_embeddings" "--no-use_abs_pos_embeddings --use_rotary_embeddings")
+for position_encoding in "${position_encodings[@]}"
+do
+  output_dir="results/${timestamp}_${notes}_packed"
+  if [ ! -d "${output_dir}" ]; then
+    mkdir -p "${output_dir}"
+  fi
+
+  python3 train.py \
+    --max_iters "$max_iters" \
+    --n_layer "$n_layer" \
+    --n_head "$n_head" \
+    --n_embd "$n_embd" \
+    --eval_iters "$eval_iters" \
+    --eval_interval "$eval_interval" \
+    --log_interval 10 \
+    --device cpu \
+    --dataset "$packed_dataset" \
+    --block_size "$block_size" \
+    --pack_documents \
+    --prefetch_batches 2 \
+    $position_encoding \
+    --out_dir "${output_dir}"
+
+  sleep 1
+done
+
+# token shards: the same tokens as shakespeare_char_packed in shards of 10000
+# tokens (windows cross shard boundaries), training on both has to match
+sharded_dataset="shakespeare_char_sharded"
+mkdir -p "data/${sharded_dataset}"
+pushd "data/${sharded_dataset}"
+python3 ../template/prepare.py --method char -t ../shakespeare_char/input.txt --shard_size 10000
+popd
+
+for shard_dataset in "$packed_dataset" "$sharded_dataset"
+do
+  output_dir="results/${timestamp}_${notes}_${shard_dataset}"
+  if [ ! -d "${output_dir}" ]; then
+    mkdir -p "${output_dir}"
+  fi
+
+  python3 train.py \
+    --max_iters "$max_iters" \
+    --n_layer "$n_layer" \
+    --n_head "$n_head" \
+    --n_embd "$n_embd" \
+    --eval_iters "$eval_iters" \
+    --eval_interval "$eval_interval" \
+    --log_interval 10 \
+    --device cpu \
+    --dataset "$shard_dataset" \
+    --block_size "$block_size" \
+    --data_workers 2 \
+    --no-tensorboard_log \
+    --csv_dir "csv_logs/${timestamp}_${notes}_shards" \
+    --csv_name "shards" \
+    --out_dir "${output_dir}"
+
+  sleep 1
+done
+
+cut -d, -f3,4 "csv_logs/${timestamp}_${notes}_shards/${packed_dataset}_shards.csv" > "results/${timestamp}_${notes}_unsharded.losses"
+cut -d, -f3,4 "csv_logs/${timestamp}_${notes}_shards/${sharded_dataset}_shards.csv" > "results/${timestamp}_${notes}_sharded.losses"
+if ! cmp -s "results/${timestamp}_${notes}_unsharded.losses" "results/${timestamp}_${notes}_sharded.losses"; then
+  echo "training on token shards differs from training on train.bin"
+  exit 1
+fi
+
+# evaluation and calibration read the sharded val split as well
+python3 sample.py \
+  --out_dir "results/${timestamp}_${notes}_${sharded_dataset}" \
+  --device "cpu" \
+  --eval_only \
+  --eval_stride 16 \
+  --eval_batch_size 16
+
+python3 quantization/ptq.py \
+  --out_dir "results/${timestamp}_${notes}_${sharded_dataset}" \
+  --ptq_out_dir "results/${timestamp}_${notes}_${sharded_dataset}_ptq" \
+  --device "cpu" \
+  --calibration_batches 4 \
+  --eval_batches 2
+
+# data workers on a dataset_list, the trainer plans the sequential chunks of every dataset
+output_dir="results/${timestamp}_${notes}_workers_dataset_list"
+if [ ! -d "${output_dir}" ]; then
+  mkdir -p "${output_dir}"
+fi
+
+python3 train.py \
+  --max_iters "$max_iters" \
+  --n_layer "$n_layer" \
+  --n_head "$n_head" \
+  --n_embd "$n_embd" \
+  --eval_iters "$eval_iters" \
+  --eval_interval "$eval_interval" \
+  --log_interval 10 \
+  --device cpu \
+  --dataset_list "$packed_dataset" "$sharded_dataset" \
+  --dataset_sampling_probs 1 3 \
+  --block_size "$block_size" \
+  --sampling_method sequential \
+  --data_workers 2 \
+  --out_dir "${output_dir}"
@@ -0,0 +1,332 @@
+#/bin/bash
+
+# head to repo root
+cd ../
+
+dataset="shakespeare_char"
+python3 "data/${dataset}/prepare.py"
+
+n_layer="2"
+n_head="2"
+n_kv_group="2"
+n_embd="60"
+max_iters="50"
+block_size="32"
+eval_iters="50"
+eval_interval="50"
+timestamp="$(date +%F_%T)"
+notes="check_inference_variations"
+run_name="${dataset}_${max_iters}_${block_size}_${n_layer}_${n_head}_${n_embd}_${notes}"
+
+output_dir="results/${timestamp}_${notes}"
+if [ ! -d "${output_dir}" ]; then
+  mkdir -p "${output_dir}"
+fi
+
+python3 train.py \
+  --max_iters "$max_iters" \
+  --n_layer "$n_layer" \
+  --n_head "$n_head" \
+  --n_kv_group "$n_kv_group" \
+  --n_embd "$n_embd" \
+  --eval_iters "$eval_iters" \
+  --eval_interval "$eval_interval" \
+  --log_interval 10 \
+  --device cpu \
+  --dataset "$dataset" \
+  --use_rotary_embeddings \
+  --no-use_abs_pos_embeddings \
+  --tensorboard_run_name "$run_name" \
+  --block_size "$block_size" \
+  --out_dir "${output_dir}"
+
+# kv cache on and off, generating past block_size to exercise the cache refill
+kv_cache=("--use_kv_cache" "--no-use_kv_cache")
+for kv in "${kv_cache[@]}"
+do
+  python3 sample.py \
+    --out_dir "${output_dir}" \
+    --device "cpu" \
+    --num_samples 1 \
+    --max_new_tokens 100 \
+    "$kv" \
+    --start "What great fortune this is"
+done
+
+# strided perplexity over the whole validation file
+python3 sample.py \
+  --out_dir "${output_dir}" \
+  --device "cpu" \
+  --eval_only \
+  --eval_stride 16 \
+  --eval_batch_size 16
+
+# nucleus and min-p sampling over the top_k candidates, then greedy decoding
+python3 sample.py \
+  --out_dir "${output_dir}" \
+  --device "cpu" \
+  --num_samples 1 \
+  --max_new_tokens 50 \
+  --top_k 20 \
+  --top_p 0.9 \
+  --min_p 0.05 \
+  --start "What great fortune this is"
+
+python3 sample.py \
+  --out_dir "${output_dir}" \
+  --device "cpu" \
+  --num_samples 1 \
+  --max_new_tokens 50 \
+  --temperature 0 \
+  --start "What great fortune this is"
+
+# interactive session past block_size, keeping the start prompt and the recent turns in the kv cache
+printf 'Good morrow\nHow now\nexit\n' | python3 sample.py \
+  --out_dir "${output_dir}" \
+  --device "cpu" \
+  --interactive \
+  --max_new_tokens 40 \
+  --stop_string "." \
+  --start "ROMEO:"
+
+# batched generation of prompts with different lengths
+printf 'To be\nWhat great fortune this is\nO Romeo\n' > "${output_dir}/prompts.txt"
+python3 sample.py \
+  --out_dir "${output_dir}" \
+  --device "cpu" \
+  --max_new_tokens 100 \
+  --prompts_file "${output_dir}/prompts.txt" \
+  --batch_size 2 \
+  --batch_stop_string "."
+
+# speculative decoding with a smaller draft model on the same tokenizer
+python3 train.py \
+  --max_iters "$max_iters" \
+  --n_layer 1 \
+  --n_head "$n_head" \
+  --n_kv_group "$n_kv_group" \
+  --n_embd "$n_embd" \
+  --eval_iters "$eval_iters" \
+  --eval_interval "$eval_interval" \
+  --log_interval 10 \
+  --device cpu \
+  --dataset "$dataset" \
+  --use_rotary_embeddings \
+  --no-use_abs_pos_embeddings \
+  --tensorboard_run_name "${run_name}_draft" \
+  --block_size "$block_size" \
+  --out_dir "${output_dir}_draft"
+
+python3 sample.py \
+  --out_dir "${output_dir}" \
+  --device "cpu" \
+  --num_samples 1 \
+  --max_new_tokens 100 \
+  --draft_out_dir "${output_dir}_draft" \
+  --num_draft_tokens 4 \
+  --start "What great fortune this is"
+
+# greedy and nucleus sampling through the same sampler as regular generation
+python3 sample.py \
+  --out_dir "${output_dir}" \
+  --device "cpu" \
+  --num_samples 1 \
+  --max_new_tokens 100 \
+  --draft_out_dir "${output_dir}_draft" \
+  --num_draft_tokens 4 \
+  --temperature 0 \
+  --start "What great fortune this is"
+
+python3 sample.py \
+  --out_dir "${output_dir}" \
+  --device "cpu" \
+  --num_samples 1 \
+  --max_new_tokens 100 \
+  --draft_out_dir "${output_dir}_draft" \
+  --num_draft_tokens 4 \
+  --top_p 0.9 \
+  --min_p 0.05 \
+  --start "What great fortune this is"
+
+# medusa heads trained on the frozen backbone, then self-speculative decoding
+python3 train.py \
+  --init_from resume \
+  --max_iters 100 \
+  --eval_iters "$eval_iters" \
+  --eval_interval "$eval_interval" \
+  --log_interval 10 \
+  --device cpu \
+  --dataset "$dataset" \
+  --n_medusa_heads 2 \
+  --medusa_freeze_backbone \
+  --tensorboard_run_name "${run_name}_medusa" \
+  --block_size "$block_size" \
+  --out_dir "${output_dir}"
+
+python3 sample.py \
+  --out_dir "${output_dir}" \
+  --device "cpu" \
+  --num_samples 1 \
+  --max_new_tokens 100 \
+  --medusa \
+  --start "What great fortune this is"
+
+python3 sample.py \
+  --out_dir "${output_dir}" \
+  --device "cpu" \
+  --num_samples 1 \
+  --max_new_tokens 100 \
+  --medusa \
+  --temperature 0 \
+  --start "What great fortune this is"
+
+# batched generation on a paged kv cache, the shared prompt is stored once
+python3 sample.py \
+  --out_dir "${output_dir}" \
+  --device "cpu" \
+  --num_samples 8 \
+  --batch_size 8 \
+  --max_new_tokens 100 \
+  --kv_pool_blocks 64 \
+  --kv_block_len 8 \
+  --start "What great fortune this is"
+
+# repeated samples of one prompt reuse its prefilled keys and values
+python3 sample.py \
+  --out_dir "${output_dir}" \
+  --device "cpu" \
+  --num_samples 3 \
+  --max_new_tokens 50 \
+  --prefix_cache_mb 16 \
+  --start "What great fortune this is"
+
+# int8 and packed int4 kv cache, then its memory and perplexity against a float cache
+cache_bits=("8" "4")
+for bits in "${cache_bits[@]}"
+do
+  python3 sample.py \
+    --out_dir "${output_dir}" \
+    --device "cpu" \
+    --num_samples 1 \
+    --max_new_tokens 100 \
+    --kv_cache_quant_bits "$bits" \
+    --start "What great fortune this is"
+done
+
+python3 benchmarks/kv_cache_quant.py \
+  --out_dir "${output_dir}" \
+  --device "cpu" \
+  --num_windows 4 \
+  --bits 8 4
+
+# sliding window model generating far past block_size on a rolling kv cache
+python3 train.py \
+  --max_iters "$max_iters" \
+  --n_layer "$n_layer" \
+  --n_head "$n_head" \
+  --n_kv_group "$n_kv_group" \
+  --n_embd "$n_embd" \
+  --eval_iters "$eval_iters" \
+  --eval_interval "$eval_interval" \
+  --log_interval 10 \
+  --device cpu \
+  --dataset "$dataset" \
+  --use_rotary_embeddings \
+  --no-use_abs_pos_embeddings \
+  --window_size 16 \
+  --tensorboard_run_name "${run_name}_window" \
+  --block_size "$block_size" \
+  --out_dir "${output_dir}_window"
+
+python3 sample.py \
+  --out_dir "${output_dir}_window" \
+  --device "cpu" \
+  --num_samples 1 \
+  --max_new_tokens 300 \
+  --rolling_kv_cache \
+  --attention_sinks 4 \
+  --start "What great fortune this is"
+
+# linear attention trained in chunks, decoded recurrently with O(1) state per token
+python3 train.py \
+  --max_iters "$max_iters" \
+  --n_layer "$n_layer" \
+  --n_head "$n_head" \
+  --n_embd "$n_embd" \
+  --eval_iters "$eval_iters" \
+  --eval_interval "$eval_interval" \
+  --log_interval 10 \
+  --device cpu \
+  --dataset "$dataset" \
+  --attention_variant linear \
+  --linear_attn_chunk_size 8 \
+  --no-use_abs_pos_embeddings \
+  --tensorboard_run_name "${run_name}_linear" \
+  --block_size "$block_size" \
+  --out_dir "${output_dir}_linear"
+
+python3 sample.py \
+  --out_dir "${output_dir}_linear" \
+  --device "cpu" \
+  --num_samples 1 \
+  --max_new_tokens 100 \
+  --start "What great fortune this is"
+
+# interactive linear attention past block_size: with absolute position embeddings
+# the recurrent state is bounded, it is reset and re-prefilled with the start prompt and the recent turns
+python3 train.py \
+  --max_iters "$max_iters" \
+  --n_layer "$n_layer" \
+  --n_head "$n_head" \
+  --n_embd "$n_embd" \
+  --eval_iters "$eval_iters" \
+  --eval_interval "$eval_interval" \
+  --log_interval 10 \
+  --device cpu \
+  --dataset "$dataset" \
+  --attention_variant linear \
+  --linear_attn_chunk_size 8 \
+  --use_abs_pos_embeddings \
+  --tensorboard_run_name "${run_name}_linear_abs" \
+  --block_size "$block_size" \
+  --out_dir "${output_dir}_linear_abs"
+
+printf 'Good morrow\nHow now\nexit\n' | python3 sample.py \
+  --out_dir "${output_dir}_linear_abs" \
+  --device "cpu" \
+  --interactive \
+  --max_new_tokens 40 \
+  --stop_string "." \
+  --start "ROMEO:"
+
+# continuous batching server: one streamed and one non-streamed request
+server_port="8765"
+python3 serve.py \
+  --out_dir "${output_dir}" \
+  --device "cpu" \
+  --port "$server_port" \
+  --kv_pool_blocks 64 &
+server_pid=$!
+
+for attempt in $(seq 1 60); do
+  if curl -sf "http://127.0.0.1:${server_port}/health"; then
+    break
+  fi
+  sleep 1
+done
+
+curl -sf -X POST "http://127.0.0.1:${server_port}/generate" \
+  -H "Content-Type: application/json" \
+  -d '{"prompt": "What great fortune this is", "max_new_tokens": 50, "stream": true}'
+stream_status=$?
+
+curl -sf -X POST "http://127.0.0.1:${server_port}/generate" \
+  -H "Content-Type: application/json" \
+  -d '{"prompt": "ROMEO:", "max_new_tokens": 50, "stop": "."}'
+generate_status=$?
+
+kill "$server_pid"
+if [ "$stream_status" -ne 0 ] || [ "$generate_status" -ne 0 ]; then
+  echo "serve.py requests failed"
+  exit 1
+fi
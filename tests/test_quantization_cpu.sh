@@ -55,6 +55,15 @@ python3 sample.py \
   --max_new_tokens 100 \
   --start "What great fortune this is"
 
+# int8 activations x int8 weights with int32 accumulation
+python3 sample.py \
+  --out_dir "${output_dir}" \
+  --device "cpu" \
+  --num_samples 1 \
+  --max_new_tokens 100 \
+  --quantize_linear_eval_path "int8_gemm" \
+  --start "What great fortune this is"
+
 python3 quantization/save_weights.py \
   --out_dir "${output_dir}" \
   --file_name "quantized_data" \
@@ -67,4 +76,134 @@ python3 quantization/visualize.py \
 --weight "all" \
 --graph="histogram"
 
+# bitlinear_1p58 exported with packed ternary weights (5 trits per byte)
+bitlinear_dir="${output_dir}_bitlinear_1p58"
+python3 train.py \
+  --max_iters "$max_iters" \
+  --n_layer "$n_layer" \
+  --n_head "$n_head" \
+  --n_kv_group "$n_kv_group" \
+  --n_embd "$n_embd" \
+  --eval_iters "$eval_iters" \
+  --eval_interval "$eval_interval" \
+  --log_interval 10 \
+  --device cpu \
+  --dataset "$dataset" \
+  --linear_variant_attn "bitlinear_1p58" \
+  --linear_variant_mlp "bitlinear_1p58" \
+  --block_size "$block_size" \
+  --out_dir "${bitlinear_dir}"
+
+python3 quantization/export_1p58.py \
+  --out_dir "${bitlinear_dir}" \
+  --packed_out_dir "${bitlinear_dir}_packed" \
+  --tile_size 32
+
+python3 sample.py \
+  --out_dir "${bitlinear_dir}_packed" \
+  --device "cpu" \
+  --num_samples 1 \
+  --max_new_tokens 100 \
+  --start "What great fortune this is"
+
+# float model converted offline to weight-only int4 (n_embd 60 pads the last group)
+float_dir="${output_dir}_float"
+python3 train.py \
+  --max_iters "$max_iters" \
+  --n_layer "$n_layer" \
+  --n_head "$n_head" \
+  --n_kv_group "$n_kv_group" \
+  --n_embd "$n_embd" \
+  --eval_iters "$eval_iters" \
+  --eval_interval "$eval_interval" \
+  --log_interval 10 \
+  --device cpu \
+  --dataset "$dataset" \
+  --block_size "$block_size" \
+  --out_dir "${float_dir}"
+
+python3 quantization/convert_int4.py \
+  --out_dir "${float_dir}" \
+  --int4_out_dir "${float_dir}_int4" \
+  --group_size 32
+
+python3 sample.py \
+  --out_dir "${float_dir}_int4" \
+  --device "cpu" \
+  --num_samples 1 \
+  --max_new_tokens 100 \
+  --start "What great fortune this is"
+
+# post-training int8 quantization of the float model, scales calibrated on val.bin
+for observer in minmax percentile mse; do
+  python3 quantization/ptq.py \
+    --out_dir "${float_dir}" \
+    --ptq_out_dir "${float_dir}_ptq_${observer}" \
+    --device "cpu" \
+    --observer "$observer" \
+    --calibration_batches 4 \
+    --eval_batches 2
+done
+
+python3 sample.py \
+  --out_dir "${float_dir}_ptq_mse" \
+  --device "cpu" \
+  --num_samples 1 \
+  --max_new_tokens 100 \
+  --start "What great fortune this is"
+
+# mixed precision search, then post-training quantization with the allocation
+python3 quantization/bit_search.py \
+  --out_dir "${float_dir}" \
+  --device "cpu" \
+  --bits 8 4 \
+  --avg_weight_bits 6 \
+  --avg_act_bits 6 \
+  --eval_batches 2 \
+  --config_out "${float_dir}/mixed_precision.json"
+
+python3 quantization/ptq.py \
+  --out_dir "${float_dir}" \
+  --ptq_out_dir "${float_dir}_ptq_mixed" \
+  --device "cpu" \
+  --no-quantize_attn_act \
+  --no-quantize_mlp_act \
+  --bits_config "${float_dir}/mixed_precision.json" \
+  --calibration_batches 4 \
+  --eval_batches 2
+
+python3 sample.py \
+  --out_dir "${float_dir}_ptq_mixed" \
+  --device "cpu" \
+  --num_samples 1 \
+  --max_new_tokens 100 \
+  --start "What great fortune this is"
+
+# GPTQ 3 bit per row grid (float weights) and 4 bit groups (packed int4)
+python3 quantization/gptq.py \
+  --out_dir "${float_dir}" \
+  --gptq_out_dir "${float_dir}_gptq_3bit" \
+  --device "cpu" \
+  --bits 3 \
+  --quant_method "symmetric_quant" \
+  --calibration_batches 4 \
+  --eval_batches 2
+
+python3 quantization/gptq.py \
+  --out_dir "${float_dir}" \
+  --gptq_out_dir "${float_dir}_gptq_int4" \
+  --device "cpu" \
+  --bits 4 \
+  --group_size 32 \
+  --format "int4" \
+  --calibration_batches 4 \
+  --eval_batches 2
+
+python3 sample.py \
+  --out_dir "${float_dir}_gptq_int4" \
+  --device "cpu" \
+  --num_samples 1 \
+  --max_new_tokens 100 \
+  --start "What great fortune this is"
+
 sleep 3
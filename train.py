@@ -9,9 +9,13 @@ import random
 import pickle
 import shutil
 import sys
+import threading
 import time
 
 from utils.gpu_monitoring import get_gpu_memory_info
+from utils.data_workers import DataWorkerPool
+from utils.prefetch import BatchPrefetcher, gather_segment_ids, gather_windows, split_windows
+from utils.token_shards import load_tokens
 from utils.model_info import (
     print_summary,
     print_module_structure,
@@ -59,6 +63,12 @@ class Trainer:
         self.grad_norm = None
         self.grad_std = None
         self.tokens_trained = 0
+
+        # Batch loading, sampling state is shared with the prefetch thread
+        self.sampling_lock = threading.Lock()
+        self.prefetcher = None
+        self.prefetch_queue_depth = None
+
         # If using multiple datasets, track tokens trained per dataset.
         if self.args.dataset_list is not None:
             # Flatten each element (which may contain multiple dataset names) into a single list of tokens
@@ -210,16 +220,24 @@ class Trainer:
             for k,v in list(state_dict.items()):
                 if k.startswith('_orig_mod.'):
                     state_dict[k[len('_orig_mod.'):]] = state_dict.pop(k)
-            self.model.load_state_dict(state_dict)
+            # medusa heads may be added to a checkpoint trained without them
+            missing_keys, unexpected_keys = self.model.load_state_dict(state_dict, strict=False)
+            added_medusa_heads = len(missing_keys) > 0 and all(k.startswith("medusa_heads.") for k in missing_keys)
+            if unexpected_keys or (missing_keys and not added_medusa_heads):
+                sys.exit(f"Error loading checkpoint, missing keys: {missing_keys}, unexpected keys: {unexpected_keys}")
             self.best_val_loss = checkpoint['best_val_loss']
             if self.args.lsv_focused_training:
                 self.model.freeze_non_lsv_parameters()
+            if self.args.medusa_freeze_backbone:
+                self.model.freeze_non_medusa_parameters()
 
             # Ensure optimizer and scheduler are initialized before loading state
             self.optimizer = self.create_optimizer()
             self.scheduler = self.create_scheduler()
 
-            if "optimizer" in checkpoint and checkpoint["optimizer"] is not None:
+            if added_medusa_heads:
+                print("Warning: medusa heads added to checkpoint, using newly initialized optimizer.")
+            elif "optimizer" in checkpoint and checkpoint["optimizer"] is not None:
                 self.optimizer.load_state_dict(checkpoint["optimizer"])
             else:
                 print("Warning: No optimizer state found in checkpoint. Using newly initialized optimizer.")
@@ -430,12 +448,11 @@ class Trainer:
             x = start_ids
 
             with torch.no_grad():
+                kv_cache = self.raw_model.init_kv_cache(x.size(0))
                 for _ in range(max_sample_tokens):
-                    x_cond = x if x.size(1) <= self.args.block_size else x[:, -self.args.block_size:]
-                    logits, _ = self.model(x_cond, iter_num=self.iter_num)
-                    logits = logits[:, -1, :]
-                    probs = torch.softmax(logits, dim=-1)
-                    next_id = torch.multinomial(probs, num_samples=1)
+                    x_cond = self.raw_model.crop_idx_cond(x, kv_cache)
+                    logits, _ = self.model(x_cond, iter_num=self.iter_num, kv_cache=kv_cache)
+                    next_id = self.raw_model.sampler().sample(logits[:, -1, :])
                     x = torch.cat((x, next_id), dim=1)
 
             sampled_text = self.decode(x[0].tolist())
@@ -475,14 +492,8 @@ class Trainer:
 
             if self.model_args['vocab_size'] is None:
                 sys.exit("Error: no vocab size specified")
-            elif self.model_args['vocab_size'] == 100277:
-                # cl100k_base, vocab size 100277, requires np.uint32
-                self.train_data = np.memmap(os.path.join('data', self.args.dataset, 'train.bin'), dtype=np.uint32, mode='r')
-                self.val_data = np.memmap(os.path.join('data', self.args.dataset, 'val.bin'), dtype=np.uint32, mode='r')
-            else:
-                # all other tokenations so far require only np.uint16
-                self.train_data = np.memmap(os.path.join('data', self.args.dataset, 'train.bin'), dtype=np.uint16, mode='r')
-                self.val_data = np.memmap(os.path.join('data', self.args.dataset, 'val.bin'), dtype=np.uint16, mode='r')
+            self.train_data = self.load_split(self.args.dataset, 'train')
+            self.val_data = self.load_split(self.args.dataset, 'val')
             # Store total token count for the single dataset.
             self.dataset_size_tokens = len(self.train_data)
         else:
@@ -490,8 +501,6 @@ class Trainer:
             self.val_data_dict = {}
 
             for dataset in self.args.dataset_list:
-                train_data = None
-                val_data = None
                 meta_path = os.path.join('data', dataset, 'meta.pkl')
                 if not os.path.exists(meta_path):
                     sys.exit(f"Error: Meta file not found at {meta_path}")
@@ -502,28 +511,46 @@ class Trainer:
                     if vocab_size:
                         self.model_args['vocab_size'] = vocab_size
 
-                # Load train and val data for each dataset
                 if self.model_args['vocab_size'] is None:
                     sys.exit("Error: no vocab size specified")
-                elif self.model_args['vocab_size'] == 100277:
-                    # cl100k_base, vocab size 100277, requires np.uint32
-                    train_data = np.memmap(os.path.join('data', dataset, 'train.bin'), dtype=np.uint32, mode='r')
-                    val_data = np.memmap(os.path.join('data', dataset, 'val.bin'), dtype=np.uint32, mode='r')
-                else:
-                    # all other tokenations so far require only np.uint16
-                    train_data = np.memmap(os.path.join('data', dataset, 'train.bin'), dtype=np.uint16, mode='r')
-                    val_data = np.memmap(os.path.join('data', dataset, 'val.bin'), dtype=np.uint16, mode='r')
 
-                # Store in dictionaries
-                self.train_data_dict[dataset] = train_data
-                self.val_data_dict[dataset] = val_data
+                # Load train and val data for each dataset
+                self.train_data_dict[dataset] = self.load_split(dataset, 'train')
+                self.val_data_dict[dataset] = self.load_split(dataset, 'val')
             # For multi-dataset case, store the token count for each dataset in a dictionary.
             self.dataset_size_tokens = {d: len(self.train_data_dict[d]) for d in self.args.dataset_list}
 
+        if self.args.pack_documents:
+            self.load_document_starts()
 
-    def get_batch(self, split, target_dataset=None):
+    def load_split(self, dataset, split):
+        """Tokens of data/<dataset>/<split>, token shards or a .bin, see utils/token_shards.py."""
+        try:
+            return load_tokens(os.path.join('data', dataset), split, self.model_args['vocab_size'])
+        except ValueError as e:
+            sys.exit(f"Error: {e}")
+
+    def load_document_starts(self):
+        """Document start offsets written by prepare.py --document_separator, for --pack_documents."""
+        self.document_starts = {}
+        for dataset in (self.args.dataset_list or [self.args.dataset]):
+            for split in ['train', 'val']:
+                docs_path = os.path.join('data', dataset, f'{split}_docs.bin')
+                if not os.path.exists(docs_path):
+                    sys.exit(f"Error: {docs_path} not found, prepare {dataset} with --document_separator to use --pack_documents")
+                self.document_starts[(dataset, split)] = np.memmap(docs_path, dtype=np.int64, mode='r')
+
+    def sample_batch(self, split, target_dataset=None, iter_num=None, batch_size=None, np_rng=np.random, torch_rng=None, py_rng=random):
+        """
+        Sampling decisions for one batch: the dataset and the window starts ix,
+        updating the sequential / without_replacement state. iter_num and
+        batch_size default to the current ones, the prefetcher passes those the
+        batch will be trained at, and its own random generators.
+        """
         dataset = None
         data = None
+        iter_num = self.iter_num if iter_num is None else iter_num
+        batch_size = self.args.batch_size if batch_size is None else batch_size
         def interpolate_probs(initial_probs, final_probs, method, step_ratio):
             if method == 'linear':
                 return initial_probs + step_ratio * (final_probs - initial_probs)
@@ -536,10 +563,10 @@ class Trainer:
 
         def get_transitioned_probs():
             initial_probs = np.array(self.args.dataset_sampling_probs)
-            if self.args.final_dataset_sampling_probs:
-                step_ratio = self.iter_num / self.args.max_iters
+            if self.args.dataset_sampling_probs_final:
+                step_ratio = iter_num / self.args.max_iters
                 final_probs = np.array(self.args.dataset_sampling_probs_final)
-                return interpolate_probs(initial_probs, final_probs, self.args.transition_method, step_ratio)
+                return interpolate_probs(initial_probs, final_probs, self.args.dataset_sampling_probs_transition_method, step_ratio)
             return initial_probs
 
         if self.args.dataset_list:
@@ -577,7 +604,7 @@ class Trainer:
 
                         # shuffle
                         if self.args.dataset_interleaving_shuffle:
-                            random.shuffle(self.remaining_datasets)
+                            py_rng.shuffle(self.remaining_datasets)
                         # print("reset", self.remaining_datasets)
 
                     # pop from front of stack
@@ -586,7 +613,7 @@ class Trainer:
                 else:
                     # If proportions and order not specified, then do 1:1 interleaving
                     num_datasets = len(self.args.dataset_list)
-                    dataset_index = self.iter_num % num_datasets
+                    dataset_index = iter_num % num_datasets
                     dataset = self.args.dataset_list[dataset_index]
 
                 data = self.train_data_dict[dataset] if split == 'train' else self.val_data_dict[dataset]
@@ -594,85 +621,176 @@ class Trainer:
                 # print("using probabilities")
                 if self.args.dataset_sampling_probs:
                     # Sample dataset based on probabilities
-                    dataset = np.random.choice(self.args.dataset_list, p=get_transitioned_probs() / np.sum(get_transitioned_probs()))
+                    dataset = np_rng.choice(self.args.dataset_list, p=get_transitioned_probs() / np.sum(get_transitioned_probs()))
                 else:
                     # Default to uniform sampling if probabilities are not provided
-                    dataset = np.random.choice(self.args.dataset_list)
+                    dataset = np_rng.choice(self.args.dataset_list)
                 # print(dataset)
                 data = self.train_data_dict[dataset] if split == 'train' else self.val_data_dict[dataset]
 
-            if self.args.use_lsv:
-                self.model.set_lsv_index(self.args.dataset_list.index(dataset))
-
-
-            # set learning rate
-            if self.args.dataset_sampling_learning_rate:
-                dataset_index = self.args.dataset_list.index(dataset)
-                self.args.learning_rate = self.args.dataset_sampling_learning_rate[dataset_index]
-
         else:
             # Else use the 'dataset' arg by default for backwards compatibility
             dataset = self.args.dataset
             data = self.train_data if split == 'train' else self.val_data
 
-        # Adaptive GNS settings
-        if (self.gns is not None) and (self.args.gns_target is not None):
-            if self.gns < self.args.gns_target:
-                if self.args.batch_size < self.args.gns_max_batch:
-                    self.args.batch_size = math.ceil(self.args.batch_size * (1.0 + self.args.gns_batch_pct))
-            if self.gns > self.args.gns_target:
-                self.args.batch_size = math.ceil(self.args.batch_size * (1.0 - self.args.gns_batch_pct))
-
         # Generate random indices for the batch
-        ix = torch.randint(len(data) - self.args.block_size, (self.args.batch_size,))
         available = len(data) - self.args.block_size
         if self.args.sampling_method == "random":
-            ix = torch.randint(available, (self.args.batch_size,))
+            ix = torch.randint(available, (batch_size,), generator=torch_rng)
         elif self.args.sampling_method == "sequential":
             # Use the sequential indices from self.indices_perm (or per dataset)
             if self.args.dataset_list is None:
-                if self.current_ptr + self.args.batch_size > available:
+                if self.current_ptr + batch_size > available:
                     self.current_ptr = 0
-                selected_indices = self.indices_perm[self.current_ptr: self.current_ptr + self.args.batch_size]
-                self.current_ptr += self.args.batch_size
+                selected_indices = self.indices_perm[self.current_ptr: self.current_ptr + batch_size]
+                self.current_ptr += batch_size
             else:
                 d = target_dataset if target_dataset is not None else self.args.dataset
-                if self.dataset_ptr[d] + self.args.batch_size > available:
+                if self.dataset_ptr[d] + batch_size > available:
                     self.dataset_ptr[d] = 0
-                selected_indices = self.dataset_perm[d][self.dataset_ptr[d]: self.dataset_ptr[d] + self.args.batch_size]
-                self.dataset_ptr[d] += self.args.batch_size
+                selected_indices = self.dataset_perm[d][self.dataset_ptr[d]: self.dataset_ptr[d] + batch_size]
+                self.dataset_ptr[d] += batch_size
             ix = torch.tensor(selected_indices)
         elif self.args.sampling_method == "without_replacement":
             # Similar to sequential but with a shuffled permutation that is reshuffled when exhausted.
             if self.args.dataset_list is None:
-                if self.current_ptr + self.args.batch_size > available:
-                    self.indices_perm = np.random.permutation(available)
+                if self.current_ptr + batch_size > available:
+                    self.indices_perm = np_rng.permutation(available)
                     self.current_ptr = 0
-                selected_indices = self.indices_perm[self.current_ptr: self.current_ptr + self.args.batch_size]
-                self.current_ptr += self.args.batch_size
+                selected_indices = self.indices_perm[self.current_ptr: self.current_ptr + batch_size]
+                self.current_ptr += batch_size
             else:
                 d = target_dataset if target_dataset is not None else self.args.dataset
-                if self.dataset_ptr[d] + self.args.batch_size > available:
-                    self.dataset_perm[d] = np.random.permutation(available)
+                if self.dataset_ptr[d] + batch_size > available:
+                    self.dataset_perm[d] = np_rng.permutation(available)
                     self.dataset_ptr[d] = 0
-                selected_indices = self.dataset_perm[d][self.dataset_ptr[d]: self.dataset_ptr[d] + self.args.batch_size]
-                self.dataset_ptr[d] += self.args.batch_size
+                selected_indices = self.dataset_perm[d][self.dataset_ptr[d]: self.dataset_ptr[d] + batch_size]
+                self.dataset_ptr[d] += batch_size
             ix = torch.tensor(selected_indices)
         else:
             # Default to random sampling if unknown method
-            ix = torch.randint(available, (self.args.batch_size,))
+            ix = torch.randint(available, (batch_size,), generator=torch_rng)
 
+        return data, ix, dataset
 
-        # Get training and targets
-        x = torch.stack([torch.from_numpy((data[i:i+self.args.block_size]).astype(np.int64)) for i in ix])
-        y = torch.stack([torch.from_numpy((data[i+1:i+1+self.args.block_size]).astype(np.int64)) for i in ix])
+    def set_dataset_settings(self, dataset):
+        """Per dataset settings, applied when a batch of dataset is trained on."""
+        if self.args.dataset_list:
+            if self.args.use_lsv:
+                self.model.set_lsv_index(self.args.dataset_list.index(dataset))
 
-        # Send to appropriate device
+            # set learning rate
+            if self.args.dataset_sampling_learning_rate:
+                dataset_index = self.args.dataset_list.index(dataset)
+                self.args.learning_rate = self.args.dataset_sampling_learning_rate[dataset_index]
+
+    def gns_batch_size(self, batch_size):
+        # Adaptive GNS settings
+        if (self.gns is not None) and (self.args.gns_target is not None):
+            if self.gns < self.args.gns_target:
+                if batch_size < self.args.gns_max_batch:
+                    batch_size = math.ceil(batch_size * (1.0 + self.args.gns_batch_pct))
+            if self.gns > self.args.gns_target:
+                batch_size = math.ceil(batch_size * (1.0 - self.args.gns_batch_pct))
+        return batch_size
+
+    def get_batch(self, split, target_dataset=None):
+        with self.sampling_lock:
+            self.args.batch_size = self.gns_batch_size(self.args.batch_size)
+            data, ix, dataset = self.sample_batch(split, target_dataset)
+        self.set_dataset_settings(dataset)
+
+        # Get training and targets, one window of block_size + 1 tokens per row in the dataset dtype
+        windows = gather_windows(data, ix, self.args.block_size)
+
+        # Send to appropriate device, widened to int64 there
         if self.device_type == 'cuda':
-            x, y = x.pin_memory().to(self.device, non_blocking=True), y.pin_memory().to(self.device, non_blocking=True)
+            windows = windows.pin_memory().to(self.device, non_blocking=True)
+        else:
+            windows = windows.to(self.device)
+        x, y = split_windows(windows, data.dtype)
+
+        # Document of each input token, attention stays within documents
+        segment_ids = None
+        if self.args.pack_documents:
+            segment_ids = gather_segment_ids(self.document_starts[(dataset, split)], ix, self.args.block_size).to(self.device)
+        return x, y, dataset, segment_ids
+
+    def train_batch_schedule(self):
+        """
+        Yields the (iter_num, batch_size) each training batch is trained at, for
+        the background loaders. get_train_batch is called once before the loop
+        and then once per micro step, and the GNS rule grows or shrinks the
+        batch size once per batch, as get_batch does.
+        """
+        start_iter = self.iter_num
+        batch_size = self.args.batch_size
+        batches = 0
+        while True:
+            batch_size = self.gns_batch_size(batch_size)
+            yield start_iter + max(batches - 1, 0) // self.args.gradient_accumulation_steps, batch_size
+            batches += 1
+
+    def start_prefetcher(self):
+        """Background thread loading the training batches, with its own random generators."""
+        seed = self.args.seed + self.seed_offset
+        np_rng = np.random.RandomState(seed)
+        torch_rng = torch.Generator().manual_seed(seed)
+        py_rng = random.Random(seed)
+        schedule = self.train_batch_schedule()
+
+        def sample_batch():
+            iter_num, batch_size = next(schedule)
+            with self.sampling_lock:
+                data, ix, dataset = self.sample_batch('train', iter_num=iter_num, batch_size=batch_size, np_rng=np_rng, torch_rng=torch_rng, py_rng=py_rng)
+            document_starts = self.document_starts[(dataset, 'train')] if self.args.pack_documents else None
+            return data, ix, dataset, document_starts
+
+        self.prefetcher = BatchPrefetcher(sample_batch, self.args.block_size, self.device, self.args.prefetch_batches)
+
+    def start_data_workers(self):
+        """Worker processes loading the training batches, see utils/data_workers.py."""
+        if self.args.pack_documents:
+            sys.exit("Error: --pack_documents is not supported with --data_workers, use --prefetch_batches")
+        if self.args.dataset_list:
+            train_data = self.train_data_dict
         else:
-            x, y = x.to(self.device), y.to(self.device)
-        return x, y, dataset
+            train_data = {self.args.dataset: self.train_data}
+        dtypes = {data.dtype for data in train_data.values()}
+        if len(dtypes) > 1:
+            sys.exit(f"Error: --data_workers needs all datasets in one token dtype, got {sorted(str(d) for d in dtypes)}")
+        config = {
+            'paths': {dataset: data.filename for dataset, data in train_data.items()},
+            'available': {dataset: len(data) - self.args.block_size for dataset, data in train_data.items()},
+            'dtype': dtypes.pop().str,
+            'dataset': self.args.dataset,
+            'dataset_list': self.args.dataset_list,
+            'dataset_interleaving': self.args.dataset_interleaving,
+            'dataset_interleaving_shuffle': self.args.dataset_interleaving_shuffle,
+            'dataset_sampling_probs': self.args.dataset_sampling_probs,
+            'dataset_sampling_probs_final': self.args.dataset_sampling_probs_final,
+            'transition_method': self.args.dataset_sampling_probs_transition_method,
+            'sampling_method': self.args.sampling_method,
+            'block_size': self.args.block_size,
+            'max_iters': self.args.max_iters,
+            'seed': self.args.seed,
+            'rank': self.ddp_rank if self.ddp else 0,
+        }
+        max_batch_size = self.args.batch_size
+        if self.args.gns_target is not None:
+            # largest size the GNS rule can grow to
+            max_batch_size = max(max_batch_size, math.ceil(self.args.gns_max_batch * (1.0 + self.args.gns_batch_pct)))
+        self.prefetcher = DataWorkerPool(config, self.train_batch_schedule(), self.args.data_workers, self.args.data_worker_depth, max_batch_size, self.device)
+
+    def get_train_batch(self):
+        if self.prefetcher is None:
+            return self.get_batch('train')
+        self.prefetch_queue_depth = self.prefetcher.qsize()
+        x, y, dataset, segment_ids = self.prefetcher.get()
+        # the batch size the batch was sampled with, for the token counts and GNS
+        self.args.batch_size = x.size(0)
+        self.set_dataset_settings(dataset)
+        return x, y, dataset, segment_ids
 
     @torch.no_grad()
     def custom_loss_with_top1_focus(self, logits, targets):
@@ -702,9 +820,9 @@ class Trainer:
                 dataset_losses = {'train': torch.zeros(self.args.eval_iters), 'val': torch.zeros(self.args.eval_iters)}
                 for split in ['train', 'val']:
                     for k in range(self.args.eval_iters):
-                        X, Y, test_dataset = self.get_batch(split, target_dataset=dataset)
+                        X, Y, test_dataset, segment_ids = self.get_batch(split, target_dataset=dataset)
                         with self.ctx:
-                            logits, loss = self.model(X, Y, iter_num=self.iter_num)
+                            logits, loss = self.model(X, Y, iter_num=self.iter_num, segment_ids=segment_ids)
                         dataset_losses[split][k] = loss.item()
                 out['datasets'][dataset] = {
                     'train': dataset_losses['train'].mean(),
@@ -721,9 +839,9 @@ class Trainer:
             for split in ['train', 'val']:
                 losses = torch.zeros(self.args.eval_iters)
                 for k in range(self.args.eval_iters):
-                    X, Y, _ = self.get_batch(split)
+                    X, Y, _, segment_ids = self.get_batch(split)
                     with self.ctx:
-                        logits, loss = self.model(X, Y, iter_num=self.iter_num)
+                        logits, loss = self.model(X, Y, iter_num=self.iter_num, segment_ids=segment_ids)
                     losses[k] = loss.item()
                 out[split] = losses.mean()
                 out[split + "_std"] = losses.std()
@@ -851,6 +969,9 @@ class Trainer:
             self.writer.add_scalar(f"{target_dataset}/grad_std", self.grad_std, self.iter_num)
             self.writer.add_scalar(f"{target_dataset}/grad_std", self.grad_std, tokens_trained)
 
+            if self.prefetcher is not None:
+                self.writer.add_scalar(f"{target_dataset}/prefetch_queue_depth", self.prefetch_queue_depth, self.iter_num)
+
             if self.args.gns_type is not None:
                 self.writer.add_scalar(f"{target_dataset}/gns", self.gns, self.iter_num)
                 self.writer.add_scalar(f"{target_dataset}/gns", self.gns, tokens_trained)
@@ -874,6 +995,8 @@ class Trainer:
             args.append(self.tokens_trained)
             if self.args.gns_type is not None:
                 args.append(self.gns)
+            if self.prefetcher is not None:
+                args.append(self.prefetch_queue_depth)
             writer.writerow(args)
 
 
@@ -913,7 +1036,12 @@ class Trainer:
         torch.save(checkpoint, os.path.join(self.args.out_dir, filename))
 
     def train(self):
-        self.X, self.Y, current_dataset = self.get_batch('train')
+        # background training batch loader, worker processes or a thread
+        if self.args.data_workers > 0:
+            self.start_data_workers()
+        elif self.args.prefetch_batches > 0:
+            self.start_prefetcher()
+        self.X, self.Y, current_dataset, self.segment_ids = self.get_train_batch()
         t0 = time.time()
         local_iter_num = 0
         running_mfu = -1.0
@@ -1024,7 +1152,7 @@ class Trainer:
                         self.model.require_backward_grad_sync = (micro_step == self.args.gradient_accumulation_steps - 1)
 
                     with self.ctx:
-                        logits, loss = self.model(self.X, self.Y, iter_num=self.iter_num)
+                        logits, loss = self.model(self.X, self.Y, iter_num=self.iter_num, segment_ids=self.segment_ids)
 
                         if self.args.focus_on_top1_loss:
                             loss = self.custom_loss_with_top1_focus(logits, self.Y)  # Use custom loss
@@ -1052,7 +1180,7 @@ class Trainer:
                     # measure grad norms
                     self.get_gradient_stats()
 
-                    self.X, self.Y, current_dataset = self.get_batch('train')
+                    self.X, self.Y, current_dataset, self.segment_ids = self.get_train_batch()
 
                     if self.args.gns_type is not None:
                         approx_gns_results = gather_hook_results(self.model)
@@ -1126,6 +1254,9 @@ class Trainer:
                             self.sample_and_print(self.args.max_sample_tokens, start_tokens=self.args.sample_start_tokens)
                     break
 
+            if self.prefetcher is not None:
+                self.prefetcher.close()
+
             if self.args.plot_statistics:
                 plot_statistics(self.args, self.stats, graph_y_labels)
 
@@ -1,6 +1,7 @@
 # train_args.py
 import argparse
 import math
+import json
 
 def parse_args():
 
@@ -62,6 +63,13 @@ def parse_args():
     training_group.add_argument('--sampling_method', default="random",
         choices=["random", "sequential", "without_replacement"],
         help="Sampling method for get_batch: 'random' (with replacement), 'sequential' (without shuffling), or 'without_replacement' (shuffled without replacement)")
+    training_group.add_argument('--prefetch_batches', default=0, type=int,
+        help="Training batches a background thread keeps ready (pinned host buffers, copied to the device on a side stream), 0 loads each batch on the training thread")
+    training_group.add_argument('--data_workers', default=0, type=int,
+        help="Worker processes sampling and gathering training batches into shared memory, reproducible for a given seed and worker count. Takes precedence over --prefetch_batches")
+    training_group.add_argument('--data_worker_depth', default=2, type=int, help="Batches requested ahead from each data worker")
+    training_group.add_argument('--pack_documents', default=False, action=argparse.BooleanOptionalAction,
+        help="Keep attention within documents: windows get per token segment ids from the <split>_docs.bin index of prepare.py --document_separator, positions restart at each document")
 
     # Add a new argument for specifying multiple datasets
     training_group.add_argument('--dataset_list', default=None, nargs='+', type=str, help="If not None, training will be done from a list of datasets to train on, e.g. --dataset_list shakespeare wikitext103 openwebtext")
@@ -173,6 +181,11 @@ def parse_args():
 
     training_group.add_argument("--lsv_focused_training", default=False, action=argparse.BooleanOptionalAction, help="train but only unfreeze lsv")
 
+    ## Multi-token prediction (Medusa) heads
+    model_group.add_argument('--n_medusa_heads', type=int, default=0, help="extra heads predicting tokens t+2..t+1+n, used for self-speculative decoding")
+    model_group.add_argument('--medusa_loss_weight', type=float, default=0.2, help="weight of the mean medusa head loss added to the main loss")
+    training_group.add_argument("--medusa_freeze_backbone", default=False, action=argparse.BooleanOptionalAction, help="train only the medusa heads, e.g. on a backbone loaded with init_from='resume'")
+
     ## MLP Options
     model_group.add_argument('--use_parallel_mlp', default=False, action=argparse.BooleanOptionalAction)
     model_group.add_argument("--mlp_variant", type=str, default="mlp", choices=["mlp", "kan", "swiglu"], help="MLP variation type")
@@ -278,10 +291,11 @@ def parse_args():
         choices=["causal", "linear"],
         help="Which attention variant to use for the Transformer blocks."
     )
+    model_group.add_argument("--linear_attn_chunk_size", type=int, default=None, help="Compute linear attention running sums in chunks of this many positions, default the whole sequence at once")
 
 
     # LINEAR VARIATIONS
-    linear_variants = ["linear", "bitlinear", "bitlinear_1p58", "bitlinear_optimized", "kan","quantized_linear"]
+    linear_variants = ["linear", "bitlinear", "bitlinear_1p58", "bitlinear_optimized", "kan","quantized_linear", "int4_weight_only"]
     model_group.add_argument("--linear_variant_attn", type=str, default="linear", choices=linear_variants)
     model_group.add_argument("--linear_variant_q", type=str, default=None, choices=linear_variants, help="sets the linear variant for c_attn_q in attention (takes precedence over linear_variant_attn)")
     model_group.add_argument("--linear_variant_k", type=str, default=None, choices=linear_variants, help="sets the linear variant for c_attn_k in attention (takes precedence over linear_variant_attn)")
@@ -290,6 +304,10 @@ def parse_args():
     model_group.add_argument("--linear_variant_mlp", type=str, default="linear", choices=linear_variants)
     model_group.add_argument("--linear_variant_mlp_up", type=str, default=None, choices=linear_variants, help="sets the linear variant for c_fc in mlp (takes precedence over linear_variant_mlp)")
     model_group.add_argument("--linear_variant_mlp_down", type=str, default=None, choices=linear_variants, help="sets the linear variant for c_proj in mlp (takes precedence over linear_variant_mlp)")
+    model_group.add_argument("--linear_variant_lm_head", type=str, default="linear", choices=linear_variants, help="sets the linear variant for the lm_head, tied to wte unless the variant has no float weight")
+    model_group.add_argument("--int4_group_size", type=int, default=128, choices=[32, 64, 128], help="input channels sharing a scale and zero point in int4_weight_only layers")
+    model_group.add_argument("--int4_tile_size", type=int, default=256, help="output rows dequantized at a time by int4_weight_only layers")
+    model_group.add_argument("--bitlinear_1p58_tile_size", type=int, default=256, help="output rows unpacked at a time by bitlinear_1p58 layers exported with quantization/export_1p58.py")
     ## Linear Weight Initialization Options
     model_group.add_argument( "--linear_mean_init", type=float, default=0.0)
     model_group.add_argument( "--linear_std_init", type=float, default=0.02)
@@ -361,6 +379,7 @@ def parse_args():
     model_group.add_argument("--quantize_mlp_act_output_bits", type=int, default=None, help="number of bits for mlp output quantization")
 
     ### Whether activations should be saved
+    model_group.add_argument("--quantization_layer_bits", type=json.loads, default=None, help="per layer quantize_*_bits overrides as json, e.g. '{\"0\": {\"quantize_linear_attn_q_bits\": 4}}', see quantization/bit_search.py")
     model_group.add_argument("--store_activations", action=argparse.BooleanOptionalAction, default=False, help="whether the activations should be saved as a buffer and updated through training")
 
     ## Linear Attn Weight Quantization Precision and Method
@@ -390,6 +409,7 @@ def parse_args():
 
     ## Quantized Linear Warmup Iterations -- how many to first use regular linear, before switching to quantized
     model_group.add_argument("--quantization_warmup_iters", type=int, default=100)
+    model_group.add_argument("--quantize_linear_eval_path", type=str, default="dequant", choices=["dequant", "int8_gemm"], help="quantized_linear inference: F.linear on cached dequantized weights, or int8 activations x int8 weights with int32 accumulation")
 
     # POSITIONAL EMBEDDING VARIATIONS
     model_group.add_argument('--use_rotary_embeddings', default=False, action=argparse.BooleanOptionalAction)
@@ -0,0 +1,196 @@
+"""
+Multi-process training batch loading for train.py (--data_workers).
+
+Every worker process opens its own memmaps (or token shards) and gathers
+whole batches into shared memory slots, the trainer only copies finished
+batches to the device. The trainer process plans the batches in order:
+which dataset each one comes from and, for sequential and
+without_replacement, which chunk of the epoch, so the workers together cover
+every epoch without overlap whatever datasets they are given. Batch n is
+always made by worker n % num_workers and the trainer takes them in order.
+Dataset choices and epoch permutations come from generators seeded with
+(seed, rank), random window starts from generators seeded with (seed, rank,
+worker id), so the batches are bit reproducible for a given seed and worker
+count.
+"""
+import traceback
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from utils.prefetch import gather_windows, signed_dtypes, split_windows
+from utils.token_shards import open_tokens
+
+
+def epoch_order(config, dataset, epoch):
+    """Window starts of an epoch of dataset in sampling order, for sequential and without_replacement."""
+    available = config['available'][dataset]
+    if config['sampling_method'] == "sequential":
+        return np.arange(available)
+    index = config['dataset_list'].index(dataset) if config['dataset_list'] else 0
+    return np.random.default_rng([config['seed'], config['rank'], 2, index, epoch]).permutation(available)
+
+
+class WindowSampler:
+    """
+    Plans the batches in the trainer process, in batch order, following
+    train.py's --sampling_method and dataset_list options: the dataset of
+    every batch and, for sequential and without_replacement, the epoch and
+    offset of its chunk of window starts. Each dataset keeps one pointer
+    advanced by every batch drawn from it, as in Trainer.sample_batch.
+    """
+    def __init__(self, config):
+        self.config = config
+        self.rng = np.random.default_rng([config['seed'], config['rank']])
+        self.ptr = {}
+        self.epoch = {}
+
+    def sampling_probs(self, iter_num):
+        probs = np.array(self.config['dataset_sampling_probs'], dtype=np.float64)
+        final_probs = self.config['dataset_sampling_probs_final']
+        if final_probs:
+            final_probs = np.array(final_probs, dtype=np.float64)
+            step_ratio = iter_num / self.config['max_iters']
+            method = self.config['transition_method']
+            if method == 'linear':
+                probs = probs + step_ratio * (final_probs - probs)
+            elif method == 'cosine':
+                probs = probs + 0.5 * (1 - np.cos(np.pi * step_ratio)) * (final_probs - probs)
+            elif method == 'exponential':
+                probs = probs * (final_probs / probs) ** step_ratio
+            else:
+                raise ValueError(f"Unknown transition method: {method}")
+        return probs / probs.sum()
+
+    def choose_dataset(self, n, iter_num):
+        dataset_list = self.config['dataset_list']
+        if not dataset_list:
+            return self.config['dataset']
+        counts = self.config['dataset_sampling_probs']
+        if self.config['dataset_interleaving']:
+            if counts is None:
+                return dataset_list[iter_num % len(dataset_list)]
+            pattern = [dataset for dataset, count in zip(dataset_list, counts) for _ in range(int(count))]
+            cycle = n // len(pattern)
+            if self.config['dataset_interleaving_shuffle']:
+                cycle_rng = np.random.default_rng([self.config['seed'], self.config['rank'], 1, cycle])
+                pattern = [pattern[i] for i in cycle_rng.permutation(len(pattern))]
+            return pattern[n % len(pattern)]
+        if counts:
+            return dataset_list[self.rng.choice(len(dataset_list), p=self.sampling_probs(iter_num))]
+        return dataset_list[self.rng.integers(len(dataset_list))]
+
+    def plan(self, n, iter_num, batch_size):
+        """(dataset, epoch, start) of batch n, epoch and start None for random sampling."""
+        dataset = self.choose_dataset(n, iter_num)
+        if self.config['sampling_method'] not in ("sequential", "without_replacement"):
+            return dataset, None, None
+        available = self.config['available'][dataset]
+        if dataset not in self.ptr or self.ptr[dataset] + batch_size > available:
+            self.epoch[dataset] = self.epoch.get(dataset, -1) + 1
+            self.ptr[dataset] = 0
+        start = self.ptr[dataset]
+        self.ptr[dataset] += batch_size
+        return dataset, self.epoch[dataset], start
+
+
+class WindowReader:
+    """ Window starts of planned batches in a worker, and the token arrays to gather them from. """
+    def __init__(self, config, worker_id):
+        self.config = config
+        self.data = {dataset: open_tokens(path, config['dtype']) for dataset, path in config['paths'].items()}
+        self.rng = np.random.default_rng([config['seed'], config['rank'], worker_id])
+        # dataset: (epoch, order) of the latest epoch seen
+        self.order = {}
+
+    def window_starts(self, dataset, epoch, start, batch_size):
+        if start is None:
+            return self.rng.integers(self.config['available'][dataset], size=batch_size)
+        if self.order.get(dataset, (None,))[0] != epoch:
+            self.order[dataset] = (epoch, epoch_order(self.config, dataset, epoch))
+        return self.order[dataset][1][start:start + batch_size]
+
+
+def worker_loop(config, worker_id, slots, requests, results):
+    torch.set_num_threads(1)
+    try:
+        reader = WindowReader(config, worker_id)
+        while True:
+            request = requests.get()
+            if request is None:
+                return
+            n, slot, batch_size, dataset, epoch, start = request
+            ix = reader.window_starts(dataset, epoch, start, batch_size)
+            gather_windows(reader.data[dataset], ix, config['block_size'], out=slots[slot, :batch_size])
+            results.put((n, slot, batch_size, dataset))
+    except Exception:
+        results.put(traceback.format_exc())
+
+
+class DataWorkerPool:
+    """
+    Keeps depth batches requested from each of num_workers worker processes.
+    schedule yields the (iter_num, batch_size) of every training batch in
+    order, batches are planned by a WindowSampler and requested up to
+    num_workers * depth ahead.
+    """
+    def __init__(self, config, schedule, num_workers, depth, max_batch_size, device):
+        self.config = config
+        self.schedule = schedule
+        self.num_workers = num_workers
+        self.max_batch_size = max_batch_size
+        self.device = device
+        self.data_dtype = np.dtype(config['dtype'])
+        self.sampler = WindowSampler(config)
+        torch_dtype, _ = signed_dtypes[self.data_dtype]
+        # spawned, forking a process that has initialized cuda is unsafe
+        context = mp.get_context('spawn')
+        self.slots = [torch.empty((depth, max_batch_size, config['block_size'] + 1), dtype=torch_dtype).share_memory_() for _ in range(num_workers)]
+        self.requests = [context.Queue() for _ in range(num_workers)]
+        self.results = [context.Queue() for _ in range(num_workers)]
+        self.workers = [context.Process(target=worker_loop, args=(config, w, self.slots[w], self.requests[w], self.results[w]), daemon=True)
+                        for w in range(num_workers)]
+        for worker in self.workers:
+            worker.start()
+        self.next_request = 0
+        self.next_batch = 0
+        for n in range(num_workers * depth):
+            self.request(n // num_workers)
+
+    def request(self, slot):
+        n = self.next_request
+        iter_num, batch_size = next(self.schedule)
+        if batch_size > self.max_batch_size:
+            raise ValueError(f"batch size {batch_size} is larger than the worker buffers, {self.max_batch_size}")
+        dataset, epoch, start = self.sampler.plan(n, iter_num, batch_size)
+        self.requests[n % self.num_workers].put((n, slot, batch_size, dataset, epoch, start))
+        self.next_request += 1
+
+    def qsize(self):
+        """Batches finished by the workers and not taken yet, None where the platform cannot tell."""
+        try:
+            return sum(results.qsize() for results in self.results)
+        except NotImplementedError:
+            return None
+
+    def get(self):
+        worker = self.next_batch % self.num_workers
+        item = self.results[worker].get()
+        if isinstance(item, str):
+            raise RuntimeError(f"data worker {worker} failed:\n{item}")
+        n, slot, batch_size, dataset = item
+        assert n == self.next_batch, f"data worker {worker} returned batch {n}, expected {self.next_batch}"
+        # copied out before the slot is handed back to the worker
+        x, y = split_windows(self.slots[worker][slot, :batch_size].to(self.device), self.data_dtype)
+        self.next_batch += 1
+        self.request(slot)
+        return x, y, dataset, None
+
+    def close(self):
+        for requests in self.requests:
+            requests.put(None)
+        for worker in self.workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
@@ -0,0 +1,160 @@
+"""
+Batch loading for train.py.
+
+The block_size + 1 token windows of a batch are read from the memmap with one
+fancy index and stay in the dataset's uint16 / uint32 dtype until they are on
+the device, where they are widened to int64 and split into x and y.
+
+With --pack_documents the segment ids of the input tokens (which document
+each token belongs to) are looked up in the document start index and sent
+along with the batch.
+
+With --prefetch_batches a thread keeps up to depth ready batches queued while
+the model computes. Windows are gathered straight into a ring of pinned host
+buffers, and on cuda the host to device copy is issued on a side stream, so
+neither the gather nor the copy sits on the training thread.
+"""
+import queue
+import threading
+
+import numpy as np
+import torch
+
+# torch has little support for uint16 / uint32, tokens are shipped as the
+# signed type of the same width and masked back to unsigned after widening
+signed_dtypes = {
+    np.dtype(np.uint16): (torch.int16, 0xFFFF),
+    np.dtype(np.uint32): (torch.int32, 0xFFFFFFFF),
+}
+
+
+def gather_windows(data, ix, block_size, out=None):
+    """
+    Tokens data[i:i+block_size+1] for every i in ix as one (len(ix), block_size + 1)
+    tensor in the narrow dtype of signed_dtypes, read with a single fancy index
+    into out (a pinned buffer) when given.
+    """
+    ix = np.asarray(ix, dtype=np.int64)
+    index = ix[:, None] + np.arange(block_size + 1)
+    torch_dtype, _ = signed_dtypes[data.dtype]
+    if out is None:
+        out = torch.empty(index.shape, dtype=torch_dtype)
+    np.take(data, index, out=out.numpy().view(data.dtype))
+    return out
+
+
+def gather_segment_ids(document_starts, ix, block_size):
+    """
+    Document of every input token of the windows starting at ix, numbered from
+    0 at the first (possibly partial) document of each row, as (len(ix), block_size) int32.
+    document_starts are the sorted token offsets written by prepare.py --document_separator.
+    """
+    ix = np.asarray(ix, dtype=np.int64)
+    segments = np.searchsorted(document_starts, ix[:, None] + np.arange(block_size), side='right')
+    return torch.from_numpy((segments - segments[:, :1]).astype(np.int32))
+
+
+def split_windows(windows, data_dtype):
+    """Widen gathered windows (on the device) to int64 and split them into inputs and targets."""
+    _, mask = signed_dtypes[data_dtype]
+    windows = windows.long() & mask
+    return windows[:, :-1].contiguous(), windows[:, 1:].contiguous()
+
+
+class BatchPrefetcher:
+    """
+    Runs sample_batch() -> (data, ix, dataset, document_starts) in a background
+    thread and queues the gathered device tensors (document_starts None
+    without --pack_documents). sample_batch makes every sampling
+    decision (dataset, window starts, batch size = len(ix)), the prefetcher
+    only gathers and copies, so batches come out in the order sampled.
+    """
+    def __init__(self, sample_batch, block_size, device, depth):
+        self.sample_batch = sample_batch
+        self.block_size = block_size
+        self.device = torch.device(device)
+        self.cuda = self.device.type == 'cuda'
+        self.queue = queue.Queue(maxsize=depth)
+        # one slot more than the queue holds, the slot being filled is never waiting to be copied
+        self.slots = [None] * (depth + 1)
+        self.copy_done = [None] * (depth + 1)
+        self.stream = torch.cuda.Stream(self.device) if self.cuda else None
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def host_buffer(self, slot, batch_size, data_dtype):
+        torch_dtype, _ = signed_dtypes[data_dtype]
+        if not self.cuda:
+            return torch.empty((batch_size, self.block_size + 1), dtype=torch_dtype)
+        # the previous copy out of this slot has to finish before it is overwritten
+        if self.copy_done[slot] is not None:
+            self.copy_done[slot].synchronize()
+        # grown when the GNS batch size grows, never shrunk
+        buffer = self.slots[slot]
+        if buffer is None or buffer.size(0) < batch_size or buffer.dtype != torch_dtype:
+            buffer = torch.empty((batch_size, self.block_size + 1), dtype=torch_dtype, pin_memory=True)
+            self.slots[slot] = buffer
+        return buffer[:batch_size]
+
+    def run(self):
+        slot = 0
+        try:
+            if self.cuda:
+                torch.cuda.set_device(self.device)
+            while not self.stop.is_set():
+                data, ix, dataset, document_starts = self.sample_batch()
+                windows = gather_windows(data, ix, self.block_size, out=self.host_buffer(slot, len(ix), data.dtype))
+                segment_ids = None
+                if document_starts is not None:
+                    segment_ids = gather_segment_ids(document_starts, ix, self.block_size)
+                copy_done = None
+                if self.cuda:
+                    with torch.cuda.stream(self.stream):
+                        x, y = split_windows(windows.to(self.device, non_blocking=True), data.dtype)
+                        if segment_ids is not None:
+                            segment_ids = segment_ids.to(self.device)
+                        copy_done = torch.cuda.Event()
+                        copy_done.record(self.stream)
+                    self.copy_done[slot] = copy_done
+                    slot = (slot + 1) % len(self.slots)
+                else:
+                    x, y = split_windows(windows.to(self.device), data.dtype)
+                    if segment_ids is not None:
+                        segment_ids = segment_ids.to(self.device)
+                self.put((x, y, dataset, segment_ids, copy_done))
+        except Exception as e:
+            # raised on the training thread by the next get()
+            self.put(e)
+
+    def put(self, item):
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def qsize(self):
+        """Batches ready, 0 when the training loop is about to wait on the loader."""
+        return self.queue.qsize()
+
+    def get(self):
+        item = self.queue.get()
+        if isinstance(item, Exception):
+            raise item
+        x, y, dataset, segment_ids, copy_done = item
+        if copy_done is not None:
+            stream = torch.cuda.current_stream(self.device)
+            stream.wait_event(copy_done)
+            # allocated on the side stream, keep the memory until the compute stream is done with it
+            for tensor in (x, y, segment_ids):
+                if tensor is not None:
+                    tensor.record_stream(stream)
+        return x, y, dataset, segment_ids
+
+    def close(self):
+        self.stop.set()
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.thread.join()
@@ -0,0 +1,99 @@
+"""
+Streaming helpers for generation: incremental detokenization and stop
+sequence matching on token ids, both with constant work per new token.
+"""
+
+class StreamingDetokenizer:
+    """
+    Turns a stream of token ids into text, emitting only complete characters.
+
+    Byte level vocabularies (tiktoken, byte fallback) can split one UTF-8
+    character over several tokens, decoding those alone gives U+FFFD. Like
+    incremental detokenization in vLLM, only a short window is decoded: the
+    tokens since the last emitted text plus the few before them (for
+    tokenizers whose output depends on the neighbouring tokens), and text is
+    emitted once it no longer ends in a replacement character.
+    """
+    def __init__(self, decode):
+        self.decode = decode
+        self.tokens = []
+        # tokens[:prefix_offset] are done, tokens[prefix_offset:read_offset] give context
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+    def push(self, token):
+        """Add a token id, return the newly completed text (possibly empty)."""
+        self.tokens.append(token)
+        prefix_text = self.decode(self.tokens[self.prefix_offset:self.read_offset])
+        new_text = self.decode(self.tokens[self.prefix_offset:])
+        if len(new_text) <= len(prefix_text) or new_text.endswith("�"):
+            return ""
+        # drop tokens no longer needed as context, so the window stays short
+        del self.tokens[:self.prefix_offset]
+        self.read_offset -= self.prefix_offset
+        self.prefix_offset = self.read_offset
+        self.read_offset = len(self.tokens)
+        return new_text[len(prefix_text):]
+
+    def flush(self):
+        """Text of any tokens still held back (incomplete characters decode to U+FFFD)."""
+        prefix_text = self.decode(self.tokens[self.prefix_offset:self.read_offset])
+        new_text = self.decode(self.tokens[self.prefix_offset:])
+        self.tokens = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+        return new_text[len(prefix_text):]
+
+
+class StopSequenceMatcher:
+    """
+    Aho-Corasick automaton over token ids for a set of stop sequences.
+
+    Stop strings are tokenized once up front, then every generated token
+    advances the automaton in amortized O(1) instead of decoding and
+    searching a growing string. Note a stop string is only found when the
+    model emits it with the same tokenization as encode(stop_string).
+    """
+    def __init__(self, stop_sequences):
+        self.goto = [{}]
+        self.fail = [0]
+        # length of the longest stop sequence ending at each state, 0 if none
+        self.match = [0]
+        for seq in stop_sequences:
+            assert len(seq) > 0, "stop sequences must not be empty"
+            state = 0
+            for token in seq:
+                if token not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.match.append(0)
+                    self.goto[state][token] = len(self.goto) - 1
+                state = self.goto[state][token]
+            self.match[state] = max(self.match[state], len(seq))
+
+        # breadth first failure links
+        queue = list(self.goto[0].values())
+        while queue:
+            state = queue.pop(0)
+            for token, child in self.goto[state].items():
+                queue.append(child)
+                fallback = self.fail[state]
+                while fallback and token not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(token, 0)
+                self.match[child] = max(self.match[child], self.match[self.fail[child]])
+        self.state = 0
+
+    @classmethod
+    def from_strings(cls, stop_strings, encode):
+        return cls([encode(s) for s in stop_strings if s])
+
+    def reset(self):
+        self.state = 0
+
+    def push(self, token):
+        """Advance by one token id, return the length of a stop sequence ending here or 0."""
+        while self.state and token not in self.goto[self.state]:
+            self.state = self.fail[self.state]
+        self.state = self.goto[self.state].get(token, 0)
+        return self.match[self.state]
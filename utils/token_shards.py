@@ -0,0 +1,258 @@
+"""
+Sharded token datasets.
+
+data/template/prepare.py --shard_size and data/combine_datasets.py --shard_size
+write a split as <split>_shards/<split>_000000.bin, <split>_000001.bin, ...
+of shard_size tokens each (the last one shorter). Every shard starts with a
+64 byte little endian header
+
+    magic (8 bytes)  version (uint32)  header size (uint32)  dtype (4 bytes, e.g. '<u2')
+    token count (uint64)  tokenizer hash (32 bytes)  reserved (4 bytes)
+
+followed by the tokens, so a shard can be read without knowing how it was
+made. The tokenizer hash is the sha256 of the meta.pkl the tokens were
+written with (zeros when unknown). <split>_shards/manifest.json lists the
+shards in order with their token counts and cumulative offsets, it is
+rebuilt from the shard headers by write_manifest, so shards written by
+separate processes only need distinct names.
+
+train.py reads a split with load_tokens: the shards of the manifest when
+there is one, else the headerless <split>.bin, its dtype taken from meta.pkl.
+"""
+import glob
+import hashlib
+import json
+import os
+import pickle
+import struct
+
+import numpy as np
+
+MAGIC = b"NGPTSHRD"
+VERSION = 1
+HEADER = struct.Struct("<8sII4sQ32s4x")
+HEADER_SIZE = HEADER.size
+NO_HASH = bytes(32)
+MANIFEST = "manifest.json"
+shard_dtypes = {np.dtype(np.uint16).str: np.uint16, np.dtype(np.uint32).str: np.uint32}
+
+
+def tokenizer_hash(meta_path):
+    """sha256 of a meta.pkl, NO_HASH when there is none."""
+    if meta_path is None or not os.path.exists(meta_path):
+        return NO_HASH
+    with open(meta_path, 'rb') as f:
+        return hashlib.sha256(f.read()).digest()
+
+
+def token_dtype(vocab_size):
+    """Narrowest dtype holding every token id of the vocabulary."""
+    return np.dtype(np.uint32 if vocab_size > 65536 else np.uint16)
+
+
+def write_header(f, dtype, num_tokens, hash_bytes):
+    f.write(HEADER.pack(MAGIC, VERSION, HEADER_SIZE, np.dtype(dtype).str.encode(), num_tokens, hash_bytes))
+
+
+def read_header(path):
+    """(dtype, token count, tokenizer hash) of a shard, ValueError if it is not one."""
+    with open(path, 'rb') as f:
+        raw = f.read(HEADER_SIZE)
+    if len(raw) < HEADER_SIZE:
+        raise ValueError(f"{path} is too short for a shard header")
+    magic, version, header_size, dtype, num_tokens, hash_bytes = HEADER.unpack(raw)
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a token shard (magic {magic!r})")
+    if version != VERSION or header_size != HEADER_SIZE:
+        raise ValueError(f"{path} is shard format version {version}, this code reads version {VERSION}")
+    dtype = dtype.rstrip(b"\0").decode()
+    if dtype not in shard_dtypes:
+        raise ValueError(f"{path} has unsupported token dtype {dtype}")
+    expected = HEADER_SIZE + num_tokens * np.dtype(dtype).itemsize
+    if os.path.getsize(path) != expected:
+        raise ValueError(f"{path} holds {os.path.getsize(path)} bytes, its header says {expected}")
+    return np.dtype(dtype), num_tokens, hash_bytes
+
+
+def write_manifest(shard_dir):
+    """List the shards of shard_dir (in name order) in shard_dir/manifest.json from their headers."""
+    shards = []
+    offset = 0
+    dtypes = set()
+    hashes = set()
+    for path in sorted(glob.glob(os.path.join(shard_dir, "*.bin"))):
+        dtype, num_tokens, hash_bytes = read_header(path)
+        dtypes.add(dtype.str)
+        hashes.add(hash_bytes)
+        shards.append({"file": os.path.basename(path), "tokens": num_tokens, "offset": offset})
+        offset += num_tokens
+    if not shards:
+        raise ValueError(f"no shards in {shard_dir}")
+    if len(dtypes) > 1 or len(hashes) > 1:
+        raise ValueError(f"shards of {shard_dir} were written with different dtypes or tokenizers")
+    manifest = {
+        "version": VERSION,
+        "dtype": dtypes.pop(),
+        "tokenizer_hash": hashes.pop().hex(),
+        "total_tokens": offset,
+        "shards": shards,
+    }
+    with open(os.path.join(shard_dir, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=4)
+    return manifest
+
+
+class ShardWriter:
+    """
+    Writes tokens to shards of shard_size tokens in shard_dir, named
+    <prefix>_<index>.bin, and the manifest on close(). Shards of the prefix
+    left from an earlier run are removed.
+    """
+    def __init__(self, shard_dir, prefix, dtype, shard_size, hash_bytes=NO_HASH):
+        assert shard_size > 0, "shard_size has to be positive"
+        self.shard_dir = shard_dir
+        self.prefix = prefix
+        self.dtype = np.dtype(dtype)
+        assert self.dtype.str in shard_dtypes, f"unsupported token dtype {self.dtype}"
+        self.shard_size = shard_size
+        self.hash_bytes = hash_bytes
+        os.makedirs(shard_dir, exist_ok=True)
+        for path in glob.glob(os.path.join(shard_dir, f"{prefix}_*.bin")):
+            os.remove(path)
+        self.index = 0
+        self.file = None
+        self.count = 0
+
+    def finish_shard(self):
+        # the token count is only known now, rewrite the header
+        self.file.seek(0)
+        write_header(self.file, self.dtype, self.count, self.hash_bytes)
+        self.file.close()
+        self.file = None
+        self.index += 1
+
+    def write(self, ids):
+        ids = np.asarray(ids)
+        if len(ids) and ids.max() > np.iinfo(self.dtype).max:
+            raise ValueError(f"token id {ids.max()} does not fit in {self.dtype}")
+        ids = ids.astype(self.dtype, copy=False)
+        while len(ids):
+            if self.file is None:
+                self.file = open(os.path.join(self.shard_dir, f"{self.prefix}_{self.index:06d}.bin"), 'wb')
+                write_header(self.file, self.dtype, 0, self.hash_bytes)
+                self.count = 0
+            n = min(len(ids), self.shard_size - self.count)
+            ids[:n].tofile(self.file)
+            self.count += n
+            ids = ids[n:]
+            if self.count == self.shard_size:
+                self.finish_shard()
+
+    def close(self):
+        if self.file is not None:
+            self.finish_shard()
+        return write_manifest(self.shard_dir)
+
+
+class ShardedTokens:
+    """
+    The tokens of a manifest as one read only array: len(), dtype, slicing
+    and np.take with global token offsets, which may span shards. Shards are
+    memmapped on first access.
+    """
+    def __init__(self, manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest.get("version") != VERSION:
+            raise ValueError(f"{manifest_path} is manifest version {manifest.get('version')}, this code reads version {VERSION}")
+        self.filename = manifest_path
+        self.shard_dir = os.path.dirname(manifest_path)
+        self.dtype = np.dtype(manifest["dtype"])
+        self.tokenizer_hash = bytes.fromhex(manifest["tokenizer_hash"])
+        self.files = [shard["file"] for shard in manifest["shards"]]
+        self.counts = [shard["tokens"] for shard in manifest["shards"]]
+        self.offsets = np.array([shard["offset"] for shard in manifest["shards"]] + [manifest["total_tokens"]], dtype=np.int64)
+        self.shards = [None] * len(self.files)
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    @property
+    def shape(self):
+        return (len(self),)
+
+    def shard(self, i):
+        if self.shards[i] is None:
+            path = os.path.join(self.shard_dir, self.files[i])
+            dtype, num_tokens, hash_bytes = read_header(path)
+            if dtype != self.dtype or num_tokens != self.counts[i] or hash_bytes != self.tokenizer_hash:
+                raise ValueError(f"{path} does not match {self.filename}, rebuild the manifest")
+            self.shards[i] = np.memmap(path, dtype=self.dtype, mode='r', offset=HEADER_SIZE, shape=(num_tokens,))
+        return self.shards[i]
+
+    def take(self, indices, axis=None, out=None, mode='raise'):
+        """np.take(tokens, indices, out=out), a single fancy index when all indices fall in one shard."""
+        assert axis is None, "token shards are one dimensional"
+        indices = np.asarray(indices, dtype=np.int64)
+        if out is None:
+            out = np.empty(indices.shape, dtype=self.dtype)
+        if indices.size == 0:
+            return out
+        if indices.min() < 0 or indices.max() >= len(self):
+            raise IndexError(f"token index out of range for {len(self)} tokens")
+        first, last = np.searchsorted(self.offsets, [indices.min(), indices.max()], side='right') - 1
+        if first == last:
+            np.take(self.shard(first), indices - self.offsets[first], out=out)
+            return out
+        shard_ids = np.searchsorted(self.offsets, indices, side='right') - 1
+        for i in range(first, last + 1):
+            selected = shard_ids == i
+            if selected.any():
+                out[selected] = self.shard(i)[indices[selected] - self.offsets[i]]
+        return out
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self.take(np.arange(*key.indices(len(self))))
+        if isinstance(key, (int, np.integer)):
+            return self.take(np.array(key if key >= 0 else key + len(self)))[()]
+        return self.take(key)
+
+
+def open_tokens(path, dtype):
+    """Tokens of a manifest, or of a headerless .bin of dtype."""
+    if os.path.basename(path) == MANIFEST:
+        return ShardedTokens(path)
+    return np.memmap(path, dtype=dtype, mode='r')
+
+
+def load_tokens(dataset_dir, split, vocab_size=None):
+    """
+    Tokens of a split of a dataset directory: <split>_shards/manifest.json
+    when it exists, checked against the tokenizer in meta.pkl, else the
+    headerless <split>.bin in the dtype of meta.pkl (its 'dtype', or the
+    narrowest dtype holding vocab_size tokens).
+    """
+    meta_path = os.path.join(dataset_dir, 'meta.pkl')
+    manifest_path = os.path.join(dataset_dir, f"{split}_shards", MANIFEST)
+    if os.path.exists(manifest_path):
+        tokens = ShardedTokens(manifest_path)
+        meta_hash = tokenizer_hash(meta_path)
+        if NO_HASH not in (meta_hash, tokens.tokenizer_hash) and meta_hash != tokens.tokenizer_hash:
+            raise ValueError(f"{manifest_path} was tokenized with a different tokenizer than {meta_path}")
+        return tokens
+    bin_path = os.path.join(dataset_dir, f"{split}.bin")
+    if not os.path.exists(bin_path):
+        raise ValueError(f"neither {manifest_path} nor {bin_path} found")
+    meta = {}
+    if os.path.exists(meta_path):
+        with open(meta_path, 'rb') as f:
+            meta = pickle.load(f)
+    if 'dtype' in meta:
+        dtype = np.dtype(meta['dtype'])
+    else:
+        vocab_size = meta.get('vocab_size', vocab_size)
+        if vocab_size is None:
+            raise ValueError(f"no vocab size to tell the token dtype of {bin_path}")
+        dtype = token_dtype(vocab_size)
+    return np.memmap(bin_path, dtype=dtype, mode='r')
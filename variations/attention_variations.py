@@ -4,12 +4,49 @@ import math
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
+from torch.nn.attention.flex_attention import create_block_mask
 from variations.linear_variations import linear_dictionary
 from quantization.quantize import fake_quantize_act
-from quantization.quant_utils import set_variant, create_activation_buffers
+from quantization.quant_utils import set_variant, create_activation_buffers, create_static_quant_buffers
 from variations.softmax_variations import softmax_dictionary
 from variations.position_encoding_variations import QuantizedEmbedding, RotaryEmbedding, SymmetricalOverlapAngularPositions, FIRE
 
+class PackedSegments:
+    """
+    Documents packed into the rows of a batch, from (B, T) segment ids (the
+    document of each token, non-decreasing along a row). Tokens only attend
+    to earlier tokens of their own document, and positions restart at 0 at
+    every document start. Built once per forward and shared by all layers.
+    """
+    def __init__(self, segment_ids, window_size=None, use_flex_attn=False):
+        self.segment_ids = segment_ids
+        B, T = segment_ids.size()
+        index = torch.arange(T, device=segment_ids.device)
+        new_document = torch.ones_like(segment_ids, dtype=torch.bool)
+        new_document[:, 1:] = segment_ids[:, 1:] != segment_ids[:, :-1]
+        document_start = torch.cummax(torch.where(new_document, index, 0), dim=1).values
+        self.positions = index - document_start # (B, T)
+        self.window_size = window_size
+
+        self.mask = None
+        self.block_mask = None
+        if use_flex_attn:
+            self.block_mask = create_block_mask(self.document_causal, B=B, H=None, Q_LEN=T, KV_LEN=T, device=segment_ids.device)
+        else:
+            # causal, same document (and sliding window) mask of shape (B, 1, T, T)
+            q_idx = index[:, None]
+            kv_idx = index[None, :]
+            mask = (kv_idx <= q_idx) & (segment_ids[:, :, None] == segment_ids[:, None, :])
+            if window_size is not None:
+                mask = mask & (q_idx - kv_idx <= window_size)
+            self.mask = mask.unsqueeze(1)
+
+    def document_causal(self, b, h, q_idx, kv_idx):
+        mask = (q_idx >= kv_idx) & (self.segment_ids[b, q_idx] == self.segment_ids[b, kv_idx])
+        if self.window_size is not None:
+            mask = mask & (q_idx - kv_idx <= self.window_size)
+        return mask
+
 class CausalSelfAttention(nn.Module):
     def __init__(self, config, fire_pos_enc=None):
         super().__init__()
@@ -34,6 +71,8 @@ class CausalSelfAttention(nn.Module):
                 self.quantization_attn_dict[arg] = set_variant(val, config.quantize_attn_act)
                 if config.store_activations and arg != "quantize_attn_act" and self.quantization_attn_dict[arg]:
                     create_activation_buffers(self, arg)
+                if config.static_activation_quant and arg != "quantize_attn_act" and self.quantization_attn_dict[arg]:
+                    create_static_quant_buffers(self, arg)
             # Set each attention Linear precision and method
             elif arg.startswith("quantize_") and "linear_attn" in arg and arg.endswith("_bits"):
                 self.quantization_attn_dict[arg] = set_variant(val, config.quantize_linear_bits)
@@ -197,8 +236,27 @@ class CausalSelfAttention(nn.Module):
         return block_mask
     # End Flex Attention Related
 
-    def forward(self, x, iter_num):
+    # KV Cache Related
+    def get_cache_mask(self, q_pos, k_pos, num_sink=0):
+        """Boolean (T, L) mask of the cached keys each new query may attend to,
+        built from absolute positions rather than the square causal buffer.
+        With left padded rows positions are (B, T) / (B, L) and the mask is
+        (B, 1, T, L); padding slots have negative positions, real queries never
+        see them and padding queries only see other padding. The first num_sink
+        positions (attention sinks) stay visible outside the sliding window."""
+        q_pos = q_pos[..., :, None]
+        k_pos = k_pos[..., None, :]
+        mask = (k_pos <= q_pos) & ((k_pos >= 0) | (q_pos < 0))
+        if self.window_size is not None:
+            mask = mask & ((q_pos - k_pos <= self.window_size) | (k_pos < num_sink))
+        if mask.dim() == 3:
+            mask = mask.unsqueeze(1)
+        return mask
+    # End KV Cache Related
+
+    def forward(self, x, iter_num, layer_cache=None, segments=None):
         B, T, C = x.size() # batch size, sequence length, embedding dimensionality (n_embd)
+        assert segments is None or layer_cache is None, "packed documents are not supported with a kv cache"
 
         if self.quantization_attn_dict["quantize_attn_act_input"]:
             num_bits = self.quantization_attn_dict["quantize_attn_act_input_bits"]
@@ -209,7 +267,7 @@ class CausalSelfAttention(nn.Module):
         k = self.c_attn_k(x)
         v = self.c_attn_v(x)
 
-        if self.window_size is not None:
+        if self.window_size is not None and layer_cache is None:
             if self.use_flex_attn is not None:
                 self.block_masks = {}
             else:
@@ -240,17 +298,46 @@ class CausalSelfAttention(nn.Module):
         k = k.view(B, T, self.n_kv_group, C // self.n_head).transpose(1, 2) # (B, n_kv, T, hs)
         v = v.view(B, T, self.n_kv_group, C // self.n_head).transpose(1, 2) # (B, n_kv, T, hs)
 
+        # number of positions already held in the kv cache, offsets the new tokens
+        past = layer_cache.pos if layer_cache is not None else 0
+
         # rotate q and k before evaluating with the heads
         if (self.rotary_emb_q is not None) and (self.rotary_emb_k is not None):
+            if layer_cache is not None:
+                self.rotary_emb_q.set_start_index(layer_cache.start_index(x.device))
+                self.rotary_emb_k.set_start_index(layer_cache.start_index(x.device))
+            elif segments is not None:
+                # positions restart at every packed document
+                self.rotary_emb_q.set_start_index(segments.positions)
+                self.rotary_emb_k.set_start_index(segments.positions)
             q = self.rotary_emb_q(q)
             k = self.rotary_emb_k(k)
+            if layer_cache is not None or segments is not None:
+                self.rotary_emb_q.reset_start_index()
+                self.rotary_emb_k.reset_start_index()
+
+        # append new keys and values to the cache, then attend over all cached positions
+        attn_mask = None
+        if layer_cache is not None:
+            q_pos = layer_cache.positions(past, T, x.device)
+            k, v = layer_cache.update(k, v)
+            k_pos = layer_cache.key_positions(x.device)
+            attn_mask = self.get_cache_mask(q_pos, k_pos, layer_cache.num_sink)
+        elif segments is not None:
+            # block diagonal: causal within each packed document
+            attn_mask = segments.mask
 
         y = None
         # causal self-attention; Self-attend: (B, nh, T, hs) x (B, nh, hs, T) -> (B, nh, T, T)
-        if self.flash:
+        if self.use_flex_attn and segments is not None:
+            y = torch.nn.attention.flex_attention.flex_attention(q, k, v, block_mask=segments.block_mask, enable_gqa=self.n_head != self.n_kv_group)
+        elif self.flash and attn_mask is not None:
+            # new queries against cached keys (the causal mask is no longer square) or packed documents
+            y = torch.nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, dropout_p=self.dropout if self.training else 0, is_causal=False)
+        elif self.flash:
             # efficient attention using Flash Attention CUDA kernels
             y = torch.nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=None, dropout_p=self.dropout if self.training else 0, is_causal=True)
-        elif self.use_flex_attn and self.window_size is not None:
+        elif self.use_flex_attn and self.window_size is not None and layer_cache is None:
             block_mask = self.get_block_mask(T, x.device)
             y = torch.nn.attention.flex_attention.flex_attention(q, k, v, block_mask=block_mask)
         else:
@@ -272,7 +359,10 @@ class CausalSelfAttention(nn.Module):
                 att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))
 
             # apply masks
-            if self.window_size is not None:
+            if attn_mask is not None:
+                # causal (and sliding window) mask over absolute cache positions, or within packed documents
+                att = att.masked_fill(~attn_mask, float('-inf'))
+            elif self.window_size is not None:
                 # add mask for sliding window attention
                 att = att.masked_fill(self.window_mask == 0, float('-inf'))
             else:
@@ -282,7 +372,12 @@ class CausalSelfAttention(nn.Module):
             # fire position embeddings
             if self.use_fire_embeddings is not None:
                 # add learned fire bias
-                att = att + self.fire_pos_enc(x)
+                if layer_cache is not None:
+                    att = att + self.fire_pos_enc(x, q_pos, k_pos)
+                elif segments is not None:
+                    att = att + self.fire_pos_enc(x, segments.positions, segments.positions)
+                else:
+                    att = att + self.fire_pos_enc(x)
 
             if self.quantization_attn_dict["quantize_attn_act_softmax_input"]:
                 num_bits = self.quantization_attn_dict["quantize_attn_act_softmax_input_bits"]
@@ -352,10 +447,38 @@ class LinearAttention(nn.Module):
         self.c_proj = nn.Linear(config.n_embd, config.n_embd)
 
         self.scale = torch.nn.Parameter(torch.tensor(1.0 / math.sqrt(self.head_size)))
-
-
-    def forward(self, x, iter_num=None):
+        self.chunk_size = config.linear_attn_chunk_size
+
+    def chunked_attention(self, q, k, v, kv_state=None, k_state=None):
+        """
+        Causal linear attention over (B, H, T, D) feature mapped q, k and v.
+        The running sums of k * v and k are computed in fp32 one chunk of
+        chunk_size positions at a time, carrying the sums of previous chunks
+        (or the recurrent state of a decoding cache) forward, so only a chunk
+        of cumsums is materialized. Returns y and the sums after the last position.
+        """
+        T = q.size(2)
+        chunk_size = self.chunk_size if self.chunk_size else T
+        eps = 1e-3  # Increased epsilon
+        ys = []
+        for start in range(0, T, chunk_size):
+            qc = q[:, :, start:start + chunk_size].float()
+            kc = k[:, :, start:start + chunk_size].float()
+            vc = v[:, :, start:start + chunk_size].float()
+            kv_cumsum = (kc * vc).cumsum(dim=2)
+            k_cumsum = kc.cumsum(dim=2)
+            if kv_state is not None:
+                kv_cumsum = kv_cumsum + kv_state[:, :, None]
+                k_cumsum = k_cumsum + k_state[:, :, None]
+            y = (qc * kv_cumsum) / ((qc * k_cumsum).sum(dim=-1, keepdim=True).clamp(min=eps))
+            ys.append(y.to(q.dtype))
+            kv_state = kv_cumsum[:, :, -1]
+            k_state = k_cumsum[:, :, -1]
+        return torch.cat(ys, dim=2), kv_state, k_state
+
+    def forward(self, x, iter_num=None, layer_cache=None, segments=None):
         B, T, C = x.size()
+        assert segments is None, "packed documents need the causal attention variant"
 
         q, k, v = self.c_attn(x).split(self.n_embd, dim=2)
 
@@ -374,13 +497,16 @@ class LinearAttention(nn.Module):
         k = k.transpose(1, 2)
         v = v.transpose(1, 2)
 
-        kv = k * v
-        k_cumsum = k.cumsum(dim=2)
-        kv_cumsum = kv.cumsum(dim=2)
-
-
-        eps = 1e-3  # Increased epsilon
-        y = torch.einsum("BHTD,BHTD->BHTD", q, kv_cumsum) / (torch.einsum("BHTD,BHTD->BHT", q, k_cumsum)[..., None].clamp(min=eps))
+        if layer_cache is None:
+            y, _, _ = self.chunked_attention(q, k, v)
+        else:
+            # recurrent decoding: only the new tokens are processed, on top of the carried sums
+            if layer_cache.pad is not None:
+                # left padding tokens must not enter the running sums
+                real = layer_cache.positions(layer_cache.pos, T, x.device) >= 0
+                k = k * real[:, None, :, None].to(k.dtype)
+            y, kv_state, k_state = self.chunked_attention(q, k, v, layer_cache.kv_sum, layer_cache.k_sum)
+            layer_cache.update(kv_state, k_state, T)
 
         y = y.transpose(1, 2).contiguous().view(B, T, C)
         y = self.c_proj(y)
@@ -0,0 +1,738 @@
+# variations/kv_cache_variations.py
+
+import hashlib
+from array import array
+from collections import OrderedDict
+
+import torch
+
+from quantization.quantize import quantize_dictionary, dequantize, pack_int4, unpack_int4
+
+class KVCacheLayer:
+    """ Contiguous key/value cache for a single attention layer.
+
+    Keys and values are stored after projection (and after rotary embeddings),
+    in the GQA layout (B, n_kv_group, max_len, head_size), so only kv_dim per
+    token is kept rather than n_embd. Storage is allocated lazily on the first
+    update so that it matches the dtype/device produced under autocast.
+
+    `pad` optionally holds the number of left padding slots per row (B,), for
+    batches of prompts with different lengths. Padded slots get negative
+    positions and are never attended to by real tokens.
+    """
+    num_sink = 0
+    rollback = True
+
+    def __init__(self, config, batch_size, max_len, layer_idx=0):
+        self.batch_size = batch_size
+        self.layer_idx = layer_idx
+        self.max_len = max_len
+        self.n_kv_group = config.n_kv_group if config.n_kv_group is not None else config.n_head
+        self.head_size = config.n_embd // config.n_head
+        self.k = None
+        self.v = None
+        self.pos = 0
+        self.pad = None
+
+    def reset(self):
+        """Forget all cached positions (storage is kept for reuse)."""
+        self.pos = 0
+
+    def free_slots(self):
+        return self.max_len - self.pos
+
+    def update(self, k, v):
+        """Append new keys/values of shape (B, n_kv, T, hs), return all cached keys and values."""
+        T = k.size(2)
+        assert self.pos + T <= self.max_len, f"kv cache overflow: {self.pos} + {T} > {self.max_len}"
+        if self.k is None or self.k.dtype != k.dtype or self.k.device != k.device:
+            shape = (k.size(0), self.n_kv_group, self.max_len, self.head_size)
+            self.k = k.new_zeros(shape)
+            self.v = v.new_zeros(shape)
+        self.k[:, :, self.pos:self.pos + T] = k
+        self.v[:, :, self.pos:self.pos + T] = v
+        self.pos += T
+        return self.k[:, :, :self.pos], self.v[:, :, :self.pos]
+
+    def truncate(self, length):
+        """Drop cached positions past length, e.g. rejected speculative tokens."""
+        assert 0 <= length <= self.pos
+        self.pos = length
+
+    def select_rows(self, rows):
+        """Keep only the given batch rows (index or bool tensor), e.g. to drop finished sequences."""
+        if self.k is not None:
+            self.k = self.k[rows]
+            self.v = self.v[rows]
+        self.batch_size = self.k.size(0) if self.k is not None else self.batch_size
+
+    def start_index(self, device):
+        """Position of the next token, a (B,) tensor when rows are left padded."""
+        if self.pad is None:
+            return self.pos
+        return self.pos - self.pad.to(device)
+
+    def positions(self, start, length, device):
+        """Positions of cache slots start..start+length, (length,) or (B, length) with padding."""
+        pos = torch.arange(start, start + length, device=device)
+        if self.pad is not None:
+            pos = pos[None, :] - self.pad.to(device)[:, None]
+        return pos
+
+    def key_positions(self, device):
+        """Absolute positions of the keys returned by the last update."""
+        return self.positions(0, self.pos, device)
+
+    def memory_bytes(self):
+        return sum(t.numel() * t.element_size() for t in (self.k, self.v) if t is not None)
+
+
+class QuantizedKVCacheLayer(KVCacheLayer):
+    """ Contiguous key/value cache holding int8 or int4 keys and values.
+
+    New keys and values are quantized with symmetric_quant or affine_quant
+    (quantization/quantize.py), with one scale (and zero point) per token,
+    kv head and group of group_size head channels. 4 bit values are packed
+    two per byte. Each update dequantizes the cached positions on the fly,
+    so attention sees regular floating point keys and values.
+    """
+    def __init__(self, config, batch_size, max_len, layer_idx=0, bits=8, quant_method="symmetric_quant", group_size=None):
+        super().__init__(config, batch_size, max_len, layer_idx=layer_idx)
+        assert bits in (4, 8), "kv cache quantization supports 4 and 8 bits"
+        assert quant_method in ("symmetric_quant", "affine_quant"), f"unsupported kv cache quant_method {quant_method}"
+        self.bits = bits
+        self.quant_method = quant_method
+        self.group_size = group_size if group_size is not None else self.head_size
+        assert self.head_size % self.group_size == 0, "group_size must divide the head size"
+        assert bits == 8 or self.group_size % 2 == 0, "int4 kv cache needs an even group_size"
+        self.n_groups = self.head_size // self.group_size
+        self.store = None
+
+    def _quantize(self, x):
+        """(B, n_kv, T, hs) -> values, scales and zero points (or None) for the store."""
+        groups = x.float().unflatten(-1, (self.n_groups, self.group_size))
+        zero_point, scale, q = quantize_dictionary[self.quant_method](groups, self.bits, dim=-1)
+        q = q.flatten(-2)
+        if self.bits == 4:
+            q = pack_int4(q)
+        zero_point = zero_point.squeeze(-1) if self.quant_method == "affine_quant" else None
+        return q, scale.squeeze(-1), zero_point
+
+    def _dequantize(self, q, scale, zero_point, dtype):
+        if self.bits == 4:
+            q = unpack_int4(q)
+        q = q.unflatten(-1, (self.n_groups, self.group_size))
+        zero_point = zero_point.unsqueeze(-1) if zero_point is not None else 0
+        return dequantize(zero_point, scale.unsqueeze(-1), q).flatten(-2).to(dtype)
+
+    def update(self, k, v):
+        """Quantize and append new keys/values (B, n_kv, T, hs), return all cached ones dequantized."""
+        T = k.size(2)
+        assert self.pos + T <= self.max_len, f"kv cache overflow: {self.pos} + {T} > {self.max_len}"
+        new = [self._quantize(k), self._quantize(v)]
+        if self.store is None or self.store[0][1].device != k.device:
+            B = k.size(0)
+            self.store = []
+            for q, scale, zero_point in new:
+                self.store.append([q.new_zeros((B, self.n_kv_group, self.max_len, q.size(-1))),
+                                   scale.new_zeros((B, self.n_kv_group, self.max_len, self.n_groups)),
+                                   zero_point.new_zeros((B, self.n_kv_group, self.max_len, self.n_groups)) if zero_point is not None else None])
+        for buffers, values in zip(self.store, new):
+            for buffer, value in zip(buffers, values):
+                if buffer is not None:
+                    buffer[:, :, self.pos:self.pos + T] = value
+        self.pos += T
+        k, v = [self._dequantize(*[b[:, :, :self.pos] if b is not None else None for b in buffers], k.dtype) for buffers in self.store]
+        return k, v
+
+    def select_rows(self, rows):
+        if self.store is not None:
+            self.store = [[b[rows] if b is not None else None for b in buffers] for buffers in self.store]
+            self.batch_size = self.store[0][0].size(0)
+
+    def memory_bytes(self):
+        if self.store is None:
+            return 0
+        return sum(b.numel() * b.element_size() for buffers in self.store for b in buffers if b is not None)
+
+
+class RollingKVCacheLayer:
+    """ Ring buffer key/value cache for sliding window attention.
+
+    Only the keys and values a query can still attend to are kept: the last
+    window_size positions, plus the first num_sink positions (attention sinks,
+    Xiao et al. 2023) which stay pinned and visible to every query. Memory and
+    per-token cost are constant however long the sequence gets, while pos and
+    with it the RoPE/SOAP/FIRE positions keep increasing.
+
+    Slots are not in sequence order, attention masks them by the absolute
+    positions from key_positions (empty slots have position -1).
+    """
+    rollback = True
+
+    def __init__(self, config, batch_size, max_len, layer_idx=0, num_sink=0):
+        assert config.window_size is not None, "rolling kv cache needs a sliding window model (window_size)"
+        self.batch_size = batch_size
+        self.layer_idx = layer_idx
+        self.max_len = max_len
+        self.window = config.window_size
+        self.num_sink = num_sink
+        self.capacity = num_sink + self.window
+        self.n_kv_group = config.n_kv_group if config.n_kv_group is not None else config.n_head
+        self.head_size = config.n_embd // config.n_head
+        self.k = None
+        self.v = None
+        self.slot_pos = None
+        self.last_key_pos = None
+        self.pos = 0
+        self.pad = None
+
+    def reset(self):
+        self.pos = 0
+        if self.slot_pos is not None:
+            self.slot_pos.fill_(-1)
+
+    def free_slots(self):
+        # old positions are overwritten, the cache never needs a refill
+        return float('inf')
+
+    def update(self, k, v):
+        """Return the kept keys/values plus the new (B, n_kv, T, hs) ones, then write the new ones into the ring."""
+        T = k.size(2)
+        if self.k is None or self.k.dtype != k.dtype or self.k.device != k.device:
+            shape = (k.size(0), self.n_kv_group, self.capacity, self.head_size)
+            self.k = k.new_zeros(shape)
+            self.v = v.new_zeros(shape)
+            self.slot_pos = torch.full((self.capacity,), -1, dtype=torch.long, device=k.device)
+        new_pos = torch.arange(self.pos, self.pos + T, device=k.device)
+        keys = torch.cat((self.k, k), dim=2)
+        values = torch.cat((self.v, v), dim=2)
+        self.last_key_pos = torch.cat((self.slot_pos, new_pos))
+
+        # keep the sink positions and the newest window of the rest
+        sink = new_pos < self.num_sink
+        keep = sink | (new_pos >= self.pos + T - self.window)
+        slots = torch.where(sink, new_pos, self.num_sink + (new_pos - self.num_sink) % self.window)[keep]
+        self.k[:, :, slots] = k[:, :, keep]
+        self.v[:, :, slots] = v[:, :, keep]
+        self.slot_pos[slots] = new_pos[keep]
+        self.pos += T
+        return keys, values
+
+    def truncate(self, length):
+        """Forget positions past length, positions already overwritten are not restored."""
+        assert 0 <= length <= self.pos
+        if self.slot_pos is not None:
+            self.slot_pos[self.slot_pos >= length] = -1
+        self.pos = length
+
+    def select_rows(self, rows):
+        if self.k is not None:
+            self.k = self.k[rows]
+            self.v = self.v[rows]
+        self.batch_size = self.k.size(0) if self.k is not None else self.batch_size
+
+    def start_index(self, device):
+        if self.pad is None:
+            return self.pos
+        return self.pos - self.pad.to(device)
+
+    def positions(self, start, length, device):
+        pos = torch.arange(start, start + length, device=device)
+        if self.pad is not None:
+            pos = pos[None, :] - self.pad.to(device)[:, None]
+        return pos
+
+    def key_positions(self, device):
+        """Positions of the keys returned by the last update, in slot order."""
+        pos = self.last_key_pos.to(device)
+        if self.pad is not None:
+            pos = torch.where(pos >= 0, pos[None, :] - self.pad.to(device)[:, None], pos[None, :])
+        return pos
+
+    def memory_bytes(self):
+        return sum(t.numel() * t.element_size() for t in (self.k, self.v, self.slot_pos) if t is not None)
+
+
+class LinearAttentionState:
+    """ Recurrent state of one LinearAttention layer.
+
+    Linear attention is an RNN: instead of keys and values only the running
+    sums of k * v and of k over all previous positions are kept, (B, H, D)
+    each in fp32, so every new token costs O(1) whatever the sequence length.
+    The state cannot be rolled back (truncate) to an earlier position.
+    """
+    num_sink = 0
+    rollback = False
+
+    def __init__(self, config, batch_size, max_len, layer_idx=0):
+        self.batch_size = batch_size
+        self.layer_idx = layer_idx
+        self.max_len = max_len
+        # absolute position embeddings end at block_size, then the state must be refilled
+        self.bounded = config.use_abs_pos_embeddings
+        self.kv_sum = None
+        self.k_sum = None
+        self.pos = 0
+        self.pad = None
+
+    def reset(self):
+        self.kv_sum = None
+        self.k_sum = None
+        self.pos = 0
+
+    def free_slots(self):
+        return self.max_len - self.pos if self.bounded else float('inf')
+
+    def update(self, kv_sum, k_sum, T):
+        """Store the running sums after T more positions."""
+        self.kv_sum = kv_sum
+        self.k_sum = k_sum
+        self.pos += T
+
+    def truncate(self, length):
+        # callers check KVCache.rollback, only a no-op truncate reaches the state
+        assert length == self.pos, f"linear attention state cannot be truncated from {self.pos} to {length}"
+
+    def select_rows(self, rows):
+        if self.kv_sum is not None:
+            self.kv_sum = self.kv_sum[rows]
+            self.k_sum = self.k_sum[rows]
+            self.batch_size = self.kv_sum.size(0)
+
+    def start_index(self, device):
+        if self.pad is None:
+            return self.pos
+        return self.pos - self.pad.to(device)
+
+    def positions(self, start, length, device):
+        pos = torch.arange(start, start + length, device=device)
+        if self.pad is not None:
+            pos = pos[None, :] - self.pad.to(device)[:, None]
+        return pos
+
+    def memory_bytes(self):
+        return sum(t.numel() * t.element_size() for t in (self.kv_sum, self.k_sum) if t is not None)
+
+
+class KVCache:
+    """ Per-layer key/value caches for incremental decoding with GPT.
+
+    One cache entry is kept per Block (not per attention module), so models
+    with shared attention still get separate keys and values for each layer.
+    `offset` is the index in the full token sequence of the first cached token,
+    `pad` the number of left padding tokens of each row of that sequence.
+
+    With a pinned prefix (pin_prefix) the first `pinned` slots always hold the
+    first tokens of the sequence (e.g. a system prompt), and `offset` counts
+    the tokens skipped between them and the rest of the cache, so slot i >=
+    pinned holds token offset + i.
+    """
+    def __init__(self, config, batch_size, max_len=None, variant="contiguous", **layer_kwargs):
+        self.max_len = max_len if max_len is not None else config.block_size
+        self.variant = variant
+        self.offset = 0
+        self.pad = None
+        self.pinned = 0
+        self.recent = None
+        self.layers = [kv_cache_dictionary[variant](config, batch_size, self.max_len, layer_idx=i, **layer_kwargs) for i in range(config.n_layer)]
+
+    @property
+    def seq_len(self):
+        """Number of positions already processed and stored in the cache."""
+        return self.layers[0].pos
+
+    def free_slots(self):
+        return self.layers[0].free_slots()
+
+    @property
+    def rollback(self):
+        """Whether truncate can drop cached positions, recurrent state cannot be rolled back."""
+        return self.layers[0].rollback
+
+    def set_pad(self, pad):
+        """Set the (B,) number of left padding tokens per row, or None."""
+        self.pad = pad
+        self._update_layer_pad()
+
+    def _update_layer_pad(self):
+        # padding is counted from the start of the sequence, the cache may start later
+        layer_pad = None
+        if self.pad is not None:
+            layer_pad = (self.pad - self.offset).clamp(min=0)
+        for layer in self.layers:
+            layer.pad = layer_pad
+
+    def positions(self, length, device):
+        """Positions of the next length tokens, for absolute position embeddings."""
+        return self.layers[0].positions(self.seq_len, length, device)
+
+    def truncate(self, length):
+        """Keep only the first length cached positions in every layer."""
+        for layer in self.layers:
+            layer.truncate(length)
+
+    def memory_bytes(self):
+        """Bytes held by the cached keys and values of all layers."""
+        return sum(layer.memory_bytes() for layer in self.layers)
+
+    def select_rows(self, rows):
+        """Keep only the given batch rows in every layer."""
+        if self.pad is not None:
+            self.pad = self.pad[rows.to(self.pad.device)]
+        for layer in self.layers:
+            layer.select_rows(rows)
+        self._update_layer_pad()
+
+    def reset(self, offset=0):
+        self.offset = offset
+        for layer in self.layers:
+            layer.reset()
+        self._update_layer_pad()
+
+    def pin_prefix(self, length, recent=None):
+        """
+        Keep the first length tokens of the sequence when the cache overflows,
+        together with the last recent tokens (default half the free space).
+        """
+        assert length < self.max_len // 2, "pinned prefix must be shorter than half the cache"
+        self.pinned = length
+        self.recent = recent
+
+    def drop_after_prefix(self, offset):
+        """Keep only the pinned slots, the next token cached is offset + pinned."""
+        self.truncate(self.pinned)
+        self.offset = offset
+        self._update_layer_pad()
+
+class KVBlockPool:
+    """ Fixed-size blocks of key/value memory shared by many sequences.
+
+    Every layer gets a (num_blocks, block_len, n_kv_group, head_size) store,
+    so only kv_dim values per token and layer are kept. A block id addresses
+    the same block in every layer. Blocks are reference counted so sequences
+    can share common prefixes and copy a block only when writing to it.
+    """
+    def __init__(self, config, num_blocks, block_len=16):
+        self.num_blocks = num_blocks
+        self.block_len = block_len
+        self.n_layer = config.n_layer
+        self.n_kv_group = config.n_kv_group if config.n_kv_group is not None else config.n_head
+        self.head_size = config.n_embd // config.n_head
+        self.k = [None] * config.n_layer
+        self.v = [None] * config.n_layer
+        self.free_blocks = list(range(num_blocks - 1, -1, -1))
+        self.ref_count = [0] * num_blocks
+
+    @property
+    def num_free_blocks(self):
+        return len(self.free_blocks)
+
+    def storage(self, layer_idx, like):
+        """Key and value stores of a layer, allocated on first use to match like's dtype/device."""
+        if self.k[layer_idx] is None:
+            shape = (self.num_blocks, self.block_len, self.n_kv_group, self.head_size)
+            self.k[layer_idx] = like.new_zeros(shape)
+            self.v[layer_idx] = like.new_zeros(shape)
+        return self.k[layer_idx], self.v[layer_idx]
+
+    def memory_bytes(self):
+        return sum(t.numel() * t.element_size() for t in self.k + self.v if t is not None)
+
+    def allocate(self):
+        if not self.free_blocks:
+            raise RuntimeError(f"kv block pool exhausted, all {self.num_blocks} blocks are in use")
+        block = self.free_blocks.pop()
+        self.ref_count[block] = 1
+        return block
+
+    def incref(self, block):
+        self.ref_count[block] += 1
+
+    def decref(self, block):
+        self.ref_count[block] -= 1
+        if self.ref_count[block] == 0:
+            self.free_blocks.append(block)
+
+    def copy_block(self, src, dst):
+        for k, v in zip(self.k, self.v):
+            if k is not None:
+                k[dst] = k[src]
+                v[dst] = v[src]
+
+
+class PagedSequence:
+    """ Block table of one sequence in a KVBlockPool, with its cached length per layer. """
+    def __init__(self, pool):
+        self.pool = pool
+        self.blocks = []
+        self.lengths = [0] * pool.n_layer
+
+    def reserve(self, start, end):
+        """Make slots start..end writable: allocate missing blocks and copy shared ones (copy-on-write)."""
+        bl = self.pool.block_len
+        while len(self.blocks) * bl < end:
+            self.blocks.append(self.pool.allocate())
+        for i in range(start // bl, (end + bl - 1) // bl):
+            block = self.blocks[i]
+            if self.pool.ref_count[block] > 1:
+                new_block = self.pool.allocate()
+                self.pool.copy_block(block, new_block)
+                self.pool.decref(block)
+                self.blocks[i] = new_block
+
+    def release_after(self, length):
+        """Return blocks no longer needed to hold length slots to the pool."""
+        bl = self.pool.block_len
+        keep = (length + bl - 1) // bl
+        for block in self.blocks[keep:]:
+            self.pool.decref(block)
+        del self.blocks[keep:]
+
+    def fork(self, length=None):
+        """New sequence sharing the first length slots (default all) of this one."""
+        length = self.lengths[0] if length is None else length
+        seq = PagedSequence(self.pool)
+        bl = self.pool.block_len
+        seq.blocks = self.blocks[:(length + bl - 1) // bl]
+        for block in seq.blocks:
+            self.pool.incref(block)
+        seq.lengths = [min(l, length) for l in self.lengths]
+        return seq
+
+    def free(self):
+        self.release_after(0)
+        self.lengths = [0] * self.pool.n_layer
+
+
+class PagedKVCacheLayer:
+    """ Key/value cache layer reading and writing PagedSequences of a KVBlockPool.
+
+    Rows may hold different lengths. The layer presents them to attention the
+    same way as left padded rows of a contiguous cache: update gathers each
+    row's blocks right aligned into (B, n_kv_group, max_length, head_size) and
+    pad counts the empty slots in front, so attention needs no paged path.
+    """
+    num_sink = 0
+    rollback = True
+
+    def __init__(self, config, batch_size, max_len, layer_idx=0, sequences=None):
+        self.max_len = max_len
+        self.layer_idx = layer_idx
+        self.sequences = sequences
+        self.token_pad = None
+
+    @property
+    def pos(self):
+        return max((seq.lengths[self.layer_idx] for seq in self.sequences), default=0)
+
+    @property
+    def pad(self):
+        lengths = [seq.lengths[self.layer_idx] for seq in self.sequences]
+        if self.token_pad is None and len(set(lengths)) <= 1:
+            return None
+        pad = torch.tensor([self.pos - l for l in lengths], dtype=torch.long)
+        if self.token_pad is not None:
+            pad = pad.to(self.token_pad.device) + self.token_pad
+        return pad
+
+    @pad.setter
+    def pad(self, token_pad):
+        # left padding tokens of the prompts, on top of the length difference of the rows
+        self.token_pad = token_pad
+
+    def reset(self):
+        for seq in self.sequences:
+            seq.lengths[self.layer_idx] = 0
+            if self.layer_idx == 0:
+                seq.release_after(0)
+
+    def free_slots(self):
+        return self.max_len - self.pos
+
+    def _slot_index(self, table, slots):
+        # physical row of logical slots (B, L) in the flattened block store
+        bl = self.sequences[0].pool.block_len
+        return table.gather(1, slots // bl) * bl + slots % bl
+
+    def update(self, k, v):
+        """Write new keys/values (B, n_kv, T, hs) into the rows' blocks, return all of them gathered."""
+        B, _, T, _ = k.shape
+        pool = self.sequences[0].pool
+        k_store, v_store = pool.storage(self.layer_idx, k)
+        k_flat = k_store.view(-1, pool.n_kv_group, pool.head_size)
+        v_flat = v_store.view(-1, pool.n_kv_group, pool.head_size)
+
+        lengths = [seq.lengths[self.layer_idx] for seq in self.sequences]
+        assert max(lengths) + T <= self.max_len, f"kv cache overflow: {max(lengths)} + {T} > {self.max_len}"
+        for seq, length in zip(self.sequences, lengths):
+            seq.reserve(length, length + T)
+            seq.lengths[self.layer_idx] = length + T
+
+        n_blocks = max(len(seq.blocks) for seq in self.sequences)
+        table = torch.tensor([seq.blocks + [0] * (n_blocks - len(seq.blocks)) for seq in self.sequences], dtype=torch.long, device=k.device)
+        start = torch.tensor(lengths, dtype=torch.long, device=k.device)
+
+        # scatter the new tokens
+        write_slots = self._slot_index(table, start[:, None] + torch.arange(T, device=k.device)[None, :])
+        k_flat[write_slots.view(-1)] = k.transpose(1, 2).reshape(B * T, pool.n_kv_group, pool.head_size)
+        v_flat[write_slots.view(-1)] = v.transpose(1, 2).reshape(B * T, pool.n_kv_group, pool.head_size)
+
+        # gather every row right aligned, slots in front of shorter rows are masked as padding
+        L = max(lengths) + T
+        slots = torch.arange(L, device=k.device)[None, :] - (L - (start + T))[:, None]
+        read_slots = self._slot_index(table, slots.clamp(min=0))
+        return k_flat[read_slots].transpose(1, 2), v_flat[read_slots].transpose(1, 2)
+
+    def truncate(self, length):
+        """Drop the last pos - length slots of every row."""
+        drop = self.pos - length
+        assert drop >= 0
+        for seq in self.sequences:
+            seq.lengths[self.layer_idx] = max(0, seq.lengths[self.layer_idx] - drop)
+            if self.layer_idx == 0:
+                seq.release_after(seq.lengths[0])
+
+    def select_rows(self, rows):
+        # rows are selected once for all layers by PagedKVCache
+        pass
+
+    def start_index(self, device):
+        pad = self.pad
+        if pad is None:
+            return self.pos
+        return self.pos - pad.to(device)
+
+    def positions(self, start, length, device):
+        pos = torch.arange(start, start + length, device=device)
+        pad = self.pad
+        if pad is not None:
+            pos = pos[None, :] - pad.to(device)[:, None]
+        return pos
+
+    def key_positions(self, device):
+        return self.positions(0, self.pos, device)
+
+
+class PagedKVCache(KVCache):
+    """ KVCache whose rows are PagedSequences in a (possibly shared) KVBlockPool.
+
+    Memory comes from fixed-size blocks instead of one max_len buffer per row,
+    so many sequences of different lengths fit in the same memory. Repeated
+    rows (select_rows with duplicates) share their blocks copy-on-write, e.g.
+    several samples of one prompt only store the prompt once.
+    """
+    def __init__(self, config, pool, batch_size=1, max_len=None, sequences=None):
+        self.pool = pool
+        self.sequences = sequences if sequences is not None else [PagedSequence(pool) for _ in range(batch_size)]
+        super().__init__(config, len(self.sequences), max_len, variant="paged", sequences=self.sequences)
+
+    def select_rows(self, rows):
+        """Keep the given rows, duplicated rows are forked and dropped rows freed."""
+        if rows.dtype == torch.bool:
+            rows = rows.nonzero()[:, 0]
+        rows = rows.tolist()
+        kept = set()
+        selected = []
+        for r in rows:
+            selected.append(self.sequences[r].fork() if r in kept else self.sequences[r])
+            kept.add(r)
+        for r, seq in enumerate(self.sequences):
+            if r not in kept:
+                seq.free()
+        # layers hold a reference to this list
+        self.sequences[:] = selected
+        if self.pad is not None:
+            self.pad = self.pad[torch.tensor(rows, device=self.pad.device)]
+        self._update_layer_pad()
+
+    def memory_bytes(self):
+        """Bytes of the whole block pool, which may be shared with other caches."""
+        return self.pool.memory_bytes()
+
+    def free(self):
+        """Return all blocks of this cache to the pool."""
+        for seq in self.sequences:
+            seq.free()
+
+class PrefixCache:
+    """ LRU cache of key/value states of token prefixes, e.g. a long --start prompt.
+
+    Entries are keyed by a hash of the token ids (plus a namespace, for model
+    states such as learned steering vectors that change the keys and values)
+    and hold the per-layer keys and values of a batch 1 contiguous KVCache.
+    The least recently used entries are evicted to stay within max_bytes.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.lengths = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(tokens, namespace=None):
+        digest = hashlib.sha1(array('q', tokens).tobytes())
+        if namespace is not None:
+            digest.update(repr(namespace).encode())
+        return digest.hexdigest()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries), "bytes": self.bytes}
+
+    def restore(self, idx, kv_cache, namespace=None):
+        """
+        Load the longest cached prefix of idx (1, T) into an empty kv_cache.
+        At least the last token is left to be fed to the model, so its logits
+        are computed. Returns the number of restored positions.
+        """
+        if kv_cache is None or kv_cache.variant != "contiguous" or idx.size(0) != 1 or kv_cache.seq_len != 0:
+            return 0
+        tokens = idx[0].tolist()
+        if len(tokens) > kv_cache.max_len:
+            return 0
+        for length in sorted(set(self.lengths.values()), reverse=True):
+            if length > len(tokens):
+                continue
+            key = self.key(tokens[:length], namespace)
+            if key in self.entries and self.entries[key][0] == tokens[:length]:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                _, layer_kv, _ = self.entries[key]
+                use = min(length, len(tokens) - 1)
+                kv_cache.reset()
+                for layer, (k, v) in zip(kv_cache.layers, layer_kv):
+                    layer.update(k[:, :, :use], v[:, :, :use])
+                return use
+        self.misses += 1
+        return 0
+
+    def store(self, idx, kv_cache, namespace=None):
+        """Store the cached positions of kv_cache, if they are a prefix of idx (1, T)."""
+        if kv_cache is None or kv_cache.variant != "contiguous" or idx.size(0) != 1 or kv_cache.offset != 0:
+            return
+        length = kv_cache.seq_len
+        tokens = idx[0, :length].tolist()
+        key = self.key(tokens, namespace)
+        if length == 0 or key in self.entries:
+            return
+        layer_kv = [(layer.k[:, :, :length].clone(), layer.v[:, :, :length].clone()) for layer in kv_cache.layers]
+        nbytes = sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in layer_kv)
+        if nbytes > self.max_bytes:
+            return
+        self.entries[key] = (tokens, layer_kv, nbytes)
+        self.lengths[key] = length
+        self.bytes += nbytes
+        while self.bytes > self.max_bytes:
+            evicted, (_, _, evicted_bytes) = self.entries.popitem(last=False)
+            del self.lengths[evicted]
+            self.bytes -= evicted_bytes
+
+kv_cache_dictionary = {
+    "contiguous": KVCacheLayer,
+    "paged": PagedKVCacheLayer,
+    "rolling": RollingKVCacheLayer,
+    "quantized": QuantizedKVCacheLayer,
+    "linear_state": LinearAttentionState,
+}
@@ -4,7 +4,7 @@ import math
 import torch.nn.functional as F
 from .activation_variations import *
 from functools import lru_cache
-from quantization.quantize import _fake_quantize, quantize_dictionary, dequantize
+from quantization.quantize import _fake_quantize, quantize_dictionary, dequantize, pack_trits, unpack_trits, pack_int4, unpack_int4
 
 class WrappedLinear(nn.Linear):
     """ Adapts nn.Linear to add 'config' parameter for interface polymorphism"""
@@ -15,6 +15,12 @@ class QuantizedLinear(nn.Linear):
     """Linear layer with quantization aware training capability
     Source: https://github.com/Alexstrasza98/Transformer-Quantization/blob/main
     Source License: MIT
+
+    In eval mode the weights are quantized once and cached until they change
+    (tracked by the weight's version counter). eval_path "dequant" runs F.linear
+    on the cached dequantized weight, "int8_gemm" quantizes activations per row
+    and multiplies int8 x int8 with int32 accumulation (torch._int_mm), for
+    weights of at most 8 bits.
     """
 
     def __init__(self, in_features, out_features, config=None, method="affine_quant", bits=8, bias=True):
@@ -22,6 +28,7 @@ class QuantizedLinear(nn.Linear):
 
         self.weight_bits = bits
         self.quant_method = method
+        self.eval_path = config.quantize_linear_eval_path
         self.start_quant_level = config.start_quant_level
         self.quant_scheduler = config.quant_scheduler
         self.full_quant_iteration = config.full_quant_iteration
@@ -46,6 +53,14 @@ class QuantizedLinear(nn.Linear):
         self.register_buffer("weight_norm", None)
         self.register_buffer("weight_zero_point", torch.tensor([0]))
 
+        # Eval caches, rebuilt when the weight or bias changes
+        self._eval_cache_key = None
+        self._dequantized_weight = None
+        self._dequantized_bias = None
+        self._int_mm_supported = hasattr(torch, "_int_mm")
+        # (device, rows) torch._int_mm failed on, dequant is used for those from then on
+        self._int_mm_failed = set()
+
     def training_quantized_forward(self, input):
         """Fake quantizes weights. Function should only be used while training"""
         assert self.training, "Should be called only during training"
@@ -61,20 +76,43 @@ class QuantizedLinear(nn.Linear):
         """Simulate quantized inference. Function should be called only during inference"""
         assert not self.training, "Should be called only during inference"
 
-        # Compute the dequantized weight
-        weight = dequantize(self.weight_zero_point[0], self.weight_norm, self.quantized_weight)
-
-        # Compute the dequantized bias
-        if self.bias is not None:
-            bias = dequantize(self.bias_zero_point[0], self.bias_norm, self.quantized_bias)
-
-        # Uses the dequantized weights and bias to compute the output using F.linear
-        if self.bias:
-            out = F.linear(input, weight, bias)
-        else:
-            out = F.linear(input, weight)
-
-        return out
+        if self.eval_path == "int8_gemm" and self._int_mm_supported and self.quantized_weight.dtype == torch.int8:
+            rows = input.numel() // input.size(-1)
+            key = (input.device, rows)
+            if self.int_mm_usable(rows, input.device) and key not in self._int_mm_failed:
+                try:
+                    return self.int8_gemm_forward(input)
+                except RuntimeError:
+                    # no int8 matmul kernel for this device / shape, not retried
+                    self._int_mm_failed.add(key)
+
+        # Uses the cached dequantized weights and bias to compute the output using F.linear
+        return F.linear(input, self._dequantized_weight, self._dequantized_bias)
+
+    def int_mm_usable(self, rows, device):
+        """torch._int_mm on cuda needs more than 16 rows and feature counts that are multiples of 8, e.g. not decode steps."""
+        if device.type == "cuda":
+            return rows > 16 and self.in_features % 8 == 0 and self.out_features % 8 == 0
+        return True
+
+    def int8_gemm_forward(self, input):
+        """
+        x @ W.T with W = (q - zero_point) * scale, computed as
+        scale * (x_scale * (x_q @ q.T) - zero_point * x.sum(-1)) where x_q are the
+        rows of x symmetrically quantized to int8 and x_q @ q.T accumulates in int32.
+        """
+        x = input.reshape(-1, input.size(-1))
+        x_scale = (x.abs().amax(dim=-1, keepdim=True) / 127).clamp(min=1e-8)
+        x_q = torch.round(x / x_scale).clamp(-128, 127).to(torch.int8)
+        acc = torch._int_mm(x_q, self.quantized_weight.t())
+        out = acc.to(torch.float32) * x_scale.float()
+        zero_point = self.weight_zero_point[0]
+        if zero_point != 0:
+            out = out - zero_point * x.float().sum(dim=-1, keepdim=True)
+        out = out * self.weight_norm
+        if self._dequantized_bias is not None:
+            out = out + self._dequantized_bias
+        return out.to(input.dtype).reshape(*input.shape[:-1], -1)
 
     def _eval(self):
         """Sets the model for inference by quantizing the model"""
@@ -83,6 +121,21 @@ class QuantizedLinear(nn.Linear):
         if self.bias is not None:
             self.bias_zero_point[0], self.bias_norm, self.quantized_bias = quantize_dictionary[self.quant_method](self.bias, self.accumulation_bits)
 
+    def _eval_cached(self):
+        """Quantize (and dequantize) the weights only when they changed since the last call"""
+        key = (self.weight._version, self.weight.data_ptr(), self.weight.device)
+        if self.bias is not None:
+            key += (self.bias._version, self.bias.data_ptr())
+        if key == self._eval_cache_key:
+            return
+        with torch.no_grad():
+            self._eval()
+            self._dequantized_weight = dequantize(self.weight_zero_point[0], self.weight_norm, self.quantized_weight).to(self.weight.dtype)
+            self._dequantized_bias = None
+            if self.bias is not None:
+                self._dequantized_bias = dequantize(self.bias_zero_point[0], self.bias_norm, self.quantized_bias).to(self.bias.dtype)
+        self._eval_cache_key = key
+
     def forward(self, input):
         """Passes the input through the model during training and inference"""
         if self.training:
@@ -92,8 +145,8 @@ class QuantizedLinear(nn.Linear):
                 out = super().forward(input)
             self._step += 1
         else:
-            # Prepares the model for inference by quantizing weights and bias
-            self._eval()
+            # Prepares the model for inference by quantizing weights and bias, once per weight update
+            self._eval_cached()
             # Uses quantized weights and bias to compute the output
             out = self.inference_quantized_forward(input)
         return out
@@ -103,6 +156,11 @@ class BitLinear1p58(nn.Linear):
     Source: https://huggingface.co/1bitLLM/bitnet_b1_58-large/blob/main/utils_quant.py
     Source License: MIT
     Paper Link: https://arxiv.org/abs/2402.17764
+
+    pack() replaces the float weight with its ternary values packed 5 per byte
+    (packed_weight) and the absmean scale (weight_scale), see
+    quantization/export_1p58.py. Packed layers unpack tile_size output rows at a
+    time during inference, so the full weight is never materialized.
     """
 
     def __init__(self, in_features, out_features, config=None, method=None, bits=None, bias=True, num_groups=1):
@@ -116,7 +174,43 @@ class BitLinear1p58(nn.Linear):
         self.weight_bits = weight_bits
         self.input_bits = input_bits
 
+        self.packed = False
+        self.tile_size = 256
+        if config is not None:
+            self.tile_size = config.bitlinear_1p58_tile_size
+            if config.bitlinear_1p58_packed:
+                # filled by load_state_dict from an exported checkpoint
+                self.set_packed(torch.zeros(out_features, (in_features + 4) // 5, dtype=torch.uint8), torch.ones(()))
+
+    def set_packed(self, packed_weight, weight_scale):
+        self.register_parameter("weight", None)
+        self.register_buffer("packed_weight", packed_weight)
+        self.register_buffer("weight_scale", weight_scale)
+        self.packed = True
+
+    @torch.no_grad()
+    def pack(self):
+        """Replace the float weight by packed ternary values and their scale."""
+        assert not self.packed, "layer is already packed"
+        weight = self.weight.float()
+        scale = weight.abs().mean().clamp(min=1e-5)
+        trits = (weight / scale).round().clamp(-1, 1)
+        self.set_packed(pack_trits(trits), scale)
+
+    def packed_forward(self, x):
+        quant_input = self.activation_quant(x, self.input_bits)
+        out = []
+        for start in range(0, self.out_features, self.tile_size):
+            tile = unpack_trits(self.packed_weight[start:start + self.tile_size], self.in_features)
+            out.append(F.linear(quant_input, tile.to(quant_input.dtype)))
+        out = torch.cat(out, dim=-1) * self.weight_scale.to(quant_input.dtype)
+        if self.bias is not None:
+            out = out + self.bias
+        return out
+
     def forward(self, x):
+        if self.packed:
+            return self.packed_forward(x)
 
         quant_input = x + (self.activation_quant(x, self.input_bits) - x).detach()
         quant_weight = self.weight + (self.weight_quant(self.weight, self.weight_bits) - self.weight).detach()
@@ -143,6 +237,65 @@ class BitLinear1p58(nn.Linear):
         result = (x * s).round().clamp(Qn, Qp) / s
         return result.type(dtype)
 
+class Int4WeightLinear(nn.Linear):
+    """ Weight-only int4 linear for post-training quantized inference
+
+    Weights are affine quantized to 4 bits in groups of int4_group_size input
+    channels, with a scale and zero point per output row and group, and stored
+    two per byte (pack_int4). The layer holds no float weight: it is filled
+    with quantize_weight(), see quantization/convert_int4.py, and forward
+    dequantizes int4_tile_size output rows at a time, so only the packed
+    weights are read from memory.
+    """
+
+    def __init__(self, in_features, out_features, config=None, method=None, bits=None, bias=True):
+        super().__init__(in_features, out_features, bias)
+
+        self.group_size = config.int4_group_size
+        self.tile_size = config.int4_tile_size
+        assert self.group_size % 2 == 0, "int4_group_size must be even"
+        # the last group is zero padded when in_features is not a multiple of group_size
+        self.n_groups = math.ceil(in_features / self.group_size)
+
+        self.register_parameter("weight", None)
+        self.register_buffer("qweight", torch.zeros(out_features, self.n_groups * self.group_size // 2, dtype=torch.uint8))
+        self.register_buffer("scales", torch.ones(out_features, self.n_groups))
+        self.register_buffer("zeros", torch.zeros(out_features, self.n_groups))
+
+    @torch.no_grad()
+    def quantize_weight(self, weight):
+        """Quantize a float (out_features, in_features) weight into the packed buffers."""
+        weight = weight.float().to(self.qweight.device)
+        padding = self.n_groups * self.group_size - self.in_features
+        weight = F.pad(weight, (0, padding)).view(self.out_features, self.n_groups, self.group_size)
+        zero_point, scale, quantized = quantize_dictionary["affine_quant"](weight, 4, dim=-1)
+        self.set_quantized(quantized.view(self.out_features, -1)[:, :self.in_features], scale.squeeze(-1), zero_point.squeeze(-1))
+
+    @torch.no_grad()
+    def set_quantized(self, quantized, scale, zero_point):
+        """Store already quantized weights (int8 in [-8, 7]) with their (out_features, n_groups) scales and zero points, e.g. from quantization/gptq.py."""
+        padded = torch.zeros(self.out_features, self.n_groups * self.group_size, dtype=torch.int8, device=self.qweight.device)
+        padded[:, :self.in_features] = quantized
+        self.qweight.copy_(pack_int4(padded))
+        self.scales.copy_(scale)
+        self.zeros.copy_(zero_point)
+
+    def dequantize_rows(self, start, end):
+        """Float weight of output rows start:end, dequantized group by group."""
+        quantized = unpack_int4(self.qweight[start:end]).view(-1, self.n_groups, self.group_size)
+        weight = (quantized - self.zeros[start:end, :, None]) * self.scales[start:end, :, None]
+        return weight.flatten(1)[:, :self.in_features]
+
+    def forward(self, x):
+        out = []
+        for start in range(0, self.out_features, self.tile_size):
+            weight = self.dequantize_rows(start, start + self.tile_size)
+            out.append(F.linear(x, weight.to(x.dtype)))
+        out = torch.cat(out, dim=-1)
+        if self.bias is not None:
+            out = out + self.bias
+        return out
+
 class BitLinear(nn.Linear):
     """PyTorch BitLinear Layer
     Source: https://github.com/Beomi/BitNet-Transformers/tree/main
@@ -404,5 +557,6 @@ linear_dictionary = {
     "bitlinear_optimized": BitLinearOptimized,
     "bitlinear_1p58": BitLinear1p58,
     "kan": KAL_Net,
-    "quantized_linear": QuantizedLinear
+    "quantized_linear": QuantizedLinear,
+    "int4_weight_only": Int4WeightLinear,
 }
@@ -0,0 +1,32 @@
+# variations/medusa_variations.py
+
+import torch
+import torch.nn as nn
+from torch.nn import functional as F
+
+class MedusaHead(nn.Module):
+    """ Multi-token prediction head (Medusa, Cai et al. 2024).
+
+    A single residual block on top of the final norm, whose output goes through
+    the shared lm_head. Head i predicts the token i + 1 steps past the regular
+    next token. The projection is zero initialized (see GPT.__init__), so an
+    untrained head starts out predicting the same distribution as the lm_head.
+    """
+    def __init__(self, config):
+        super().__init__()
+        self.linear = nn.Linear(config.n_embd, config.n_embd, bias=True)
+
+    def forward(self, x):
+        return x + F.silu(self.linear(x))
+
+
+def typical_acceptance(probs, tokens, threshold=0.09, alpha=0.3):
+    """
+    Typical acceptance rule for verifying Medusa candidates: keep a token if
+    its probability under the model exceeds min(threshold, alpha * exp(-H)),
+    with H the entropy of the distribution. Approaches greedy verification as
+    the temperature goes to zero.
+    """
+    entropy = -(probs * torch.log(probs + 1e-10)).sum(dim=-1)
+    token_probs = probs.gather(-1, tokens.unsqueeze(-1)).squeeze(-1)
+    return token_probs > torch.minimum(torch.full_like(entropy, threshold), alpha * torch.exp(-entropy))
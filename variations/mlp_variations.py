@@ -7,7 +7,7 @@ import torch.nn.functional as F
 from variations.activation_variations import activation_dictionary
 from variations.linear_variations import linear_dictionary
 from quantization.quantize import fake_quantize_act
-from quantization.quant_utils import set_variant, create_activation_buffers
+from quantization.quant_utils import set_variant, create_activation_buffers, create_static_quant_buffers
 
 class OriginalMLP(nn.Module):
     def __init__(self, config):
@@ -45,6 +45,8 @@ class OriginalMLP(nn.Module):
                     self.quantization_mlp_dict[arg] = set_variant(val, config.quantize_mlp_act)
                     if config.store_activations and arg != "quantize_mlp_act" and self.quantization_mlp_dict[arg]:
                         create_activation_buffers(self, arg)
+                    if config.static_activation_quant and arg != "quantize_mlp_act" and self.quantization_mlp_dict[arg]:
+                        create_static_quant_buffers(self, arg)
                 # Set MLP Linear Weight precision and quantization method
                 elif arg.startswith("quantize_") and "linear_mlp" in arg and arg.endswith("_bits"):
                     self.quantization_mlp_dict[arg] = set_variant(val, config.quantize_linear_bits)
@@ -46,6 +46,12 @@ class RotaryEmbedding(nn.Module):
         """Reset start index to zero."""
         self.start_index += 1
 
+    def set_start_index(self, start_index):
+        """Set the position of the first element, e.g. number of tokens already in the kv cache.
+        May be a (B,) tensor to give each row of the batch its own offset, or a
+        (B, T) tensor giving every element its position (packed documents)."""
+        self.start_index = start_index
+
     def _generate_inv_freq(self, device):
         """Generate inverse frequencies for RoPE."""
         half_dim = self.rope_length // 2
@@ -67,11 +73,19 @@ class RotaryEmbedding(nn.Module):
         seq_len = x.shape[-2]
         device = x.device
 
-        # Create position indices
-        pos_indices = torch.arange(self.start_index, self.start_index + seq_len, device=x.device).type_as(self.inv_freq)
+        if torch.is_tensor(self.start_index):
+            # Per row offsets, angles of shape (B, 1, T, rope_length // 2) broadcast over heads
+            if self.start_index.dim() == 2:
+                pos_indices = self.start_index.type_as(self.inv_freq)
+            else:
+                pos_indices = (self.start_index[:, None] + torch.arange(seq_len, device=x.device)).type_as(self.inv_freq)
+            angles = (pos_indices[..., None] * self.inv_freq).unsqueeze(1)
+        else:
+            # Create position indices
+            pos_indices = torch.arange(self.start_index, self.start_index + seq_len, device=x.device).type_as(self.inv_freq)
 
-        # Compute the sinusoidal angles
-        angles = torch.einsum('i,d->id', pos_indices, self.inv_freq)
+            # Compute the sinusoidal angles
+            angles = torch.einsum('i,d->id', pos_indices, self.inv_freq)
         sin_angles = angles.sin()
         cos_angles = angles.cos()
 
@@ -119,6 +133,24 @@ class SymmetricalOverlapAngularPositions(nn.Module):
         self.first_pass = True
         self.angles = None
 
+        # Position offset of the first element, set while decoding with a kv cache
+        self.start_index = 0
+        # Cached keys were rotated with the current angle table, so rolling is
+        # paused while positions are driven by the kv cache
+        self.roll_angles = True
+
+    def reset_start_index(self):
+        """Reset start index to zero and resume rolling of the angle table."""
+        self.start_index = 0
+        self.roll_angles = True
+
+    def set_start_index(self, start_index):
+        """Set the position of the first element, e.g. number of tokens already in the kv cache.
+        May be a (B,) tensor to give each row of the batch its own offset, or a
+        (B, T) tensor giving every element its position (packed documents)."""
+        self.start_index = start_index
+        self.roll_angles = False
+
     def _generate_angles(self, num_angles, device):
         """Generate angles from 0 to 2*pi based on the number of angles."""
         return torch.linspace(0, 2 * math.pi - (2 * math.pi / num_angles), steps=num_angles, device=device)
@@ -144,17 +176,28 @@ class SymmetricalOverlapAngularPositions(nn.Module):
         seq_len = x.shape[-2]
         device = x.device
 
-        self.angles = torch.roll(self.angles, shifts=1, dims=0)
-
-        # Create index list, wrap around as necessary
-        angle_indices = torch.arange(seq_len, device=device) % self.num_angles
+        if self.roll_angles:
+            self.angles = torch.roll(self.angles, shifts=1, dims=0)
+
+        if torch.is_tensor(self.start_index):
+            # Per row offsets, angles of shape (B, 1, T, rope_length // 2) broadcast over heads
+            if self.start_index.dim() == 2:
+                angle_indices = self.start_index % self.num_angles
+            else:
+                angle_indices = (self.start_index[:, None] + torch.arange(seq_len, device=device)) % self.num_angles
+            selected_angles = self.angles[angle_indices].unsqueeze(1)
+            sin_angles = selected_angles.sin().unsqueeze(-1).expand(*selected_angles.shape, self.rope_length // 2)
+            cos_angles = selected_angles.cos().unsqueeze(-1).expand(*selected_angles.shape, self.rope_length // 2)
+        else:
+            # Create index list, wrap around as necessary
+            angle_indices = torch.arange(self.start_index, self.start_index + seq_len, device=device) % self.num_angles
 
-        # Assign angles
-        selected_angles = self.angles[angle_indices]
+            # Assign angles
+            selected_angles = self.angles[angle_indices]
 
-        # Run angles through sine and cosine
-        sin_angles = selected_angles.sin().unsqueeze(-1).repeat(1, self.rope_length // 2)
-        cos_angles = selected_angles.cos().unsqueeze(-1).repeat(1, self.rope_length // 2)
+            # Run angles through sine and cosine
+            sin_angles = selected_angles.sin().unsqueeze(-1).repeat(1, self.rope_length // 2)
+            cos_angles = selected_angles.cos().unsqueeze(-1).repeat(1, self.rope_length // 2)
 
         # Split input tensor into even and odd components for the rope length
         x_even, x_odd = x[..., :self.rope_length:2], x[..., 1:self.rope_length:2]
@@ -216,17 +259,24 @@ class FIRE(nn.Module):
         self.eps = eps
         self.fire_log_bias = config.fire_log_bias
 
-    def forward(self, x: torch.Tensor):
-        seq_length = x.size(1)
-        positions = torch.arange(seq_length, dtype=torch.float, device=x.device)
-        rel_distance = positions[:, None] - positions[None, :]
+    def forward(self, x: torch.Tensor, q_pos=None, k_pos=None):
+        """ q_pos/k_pos optionally give absolute query and key positions,
+        e.g. when the keys come from a kv cache, defaults to arange(seq_len).
+        They may also be per row (B, T) and (B, L) for left padded batches. """
+        if q_pos is None or k_pos is None:
+            seq_length = x.size(1)
+            q_pos = torch.arange(seq_length, dtype=torch.float, device=x.device)
+            k_pos = q_pos
+        q_pos = q_pos.float()
+        k_pos = k_pos.float()
+        rel_distance = q_pos[..., :, None] - k_pos[..., None, :]
 
         # Apply absolute value and ensure positive before log
         abs_rel_distance = torch.abs(rel_distance) + self.eps
 
         threshold = torch.abs(self.L_multiplier * self.init_L)
-        pos_normalizer = torch.max(positions, threshold)
-        pos_normalizer = pos_normalizer[:, None] + self.eps  # Ensure pos_normalizer is never zero
+        pos_normalizer = torch.max(q_pos, threshold)
+        pos_normalizer = pos_normalizer[..., :, None] + self.eps  # Ensure pos_normalizer is never zero
 
         # Use safe log operation
         log_rel_distance = torch.log(abs_rel_distance * self.c + self.fire_log_bias + self.eps)
@@ -235,7 +285,9 @@ class FIRE(nn.Module):
         normalized_distance = log_rel_distance / log_pos_normalizer
 
         fire_bias = self.mlp(normalized_distance.unsqueeze(-1))
-        fire_bias = fire_bias.unsqueeze(0).permute(0, 3, 1, 2)
+        if fire_bias.dim() == 3:
+            fire_bias = fire_bias.unsqueeze(0)
+        fire_bias = fire_bias.permute(0, 3, 1, 2)
 
         return fire_bias
 
@@ -0,0 +1,78 @@
+# variations/sampling_variations.py
+
+import torch
+from torch.nn import functional as F
+
+class TokenSampler:
+    """ Next token sampler with temperature, top-k, top-p (nucleus) and min-p.
+
+    With top_k the candidates are gathered once with torch.topk and the output
+    softmax, the top-p/min-p filters and multinomial sampling only run over
+    those k values, instead of masking and normalizing the full vocabulary.
+    Without top_k the full vocabulary is used (sorted once if top_p is set).
+    temperature 0 is greedy decoding (argmax). softmax_layer is the model's
+    softmax_variant_output module, None for the regular softmax; its outputs
+    are renormalized over the kept candidates before sampling.
+    """
+    def __init__(self, temperature=1.0, top_k=None, top_p=None, min_p=None, softmax_layer=None):
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.min_p = min_p
+        self.softmax_layer = softmax_layer
+
+    @property
+    def greedy(self):
+        return self.temperature == 0
+
+    def _probs(self, logits):
+        logits = logits / self.temperature
+        if self.softmax_layer is not None:
+            return self.softmax_layer(logits).clamp(min=0)
+        return F.softmax(logits, dim=-1)
+
+    def candidates(self, logits):
+        """
+        Probabilities of the sampling candidates for (B, vocab) logits.
+        Returns probs (B, K) and the vocabulary index of each column, (B, K),
+        or None when the columns are the full vocabulary in order.
+        """
+        indices = None
+        if self.top_k is not None and self.top_k < logits.size(-1):
+            logits, indices = torch.topk(logits, self.top_k, dim=-1)
+        elif self.top_p is not None:
+            logits, indices = torch.sort(logits, dim=-1, descending=True)
+        probs = self._probs(logits)
+
+        # both filters always keep the most likely candidate
+        if self.min_p is not None:
+            probs = probs * (probs >= self.min_p * probs.max(dim=-1, keepdim=True).values)
+        if self.top_p is not None:
+            # columns are sorted by probability: keep the smallest prefix reaching top_p
+            normalized = probs / probs.sum(dim=-1, keepdim=True)
+            probs = probs * ((normalized.cumsum(dim=-1) - normalized) < self.top_p)
+        return probs, indices
+
+    def probs(self, logits):
+        """
+        Sampling distribution over the full vocabulary for (..., vocab) logits:
+        the kept candidates renormalized and zero elsewhere, one-hot at the
+        argmax when greedy. For callers that need the probabilities themselves,
+        e.g. the acceptance tests of speculative decoding.
+        """
+        if self.greedy:
+            return F.one_hot(torch.argmax(logits, dim=-1), logits.size(-1)).float()
+        probs, indices = self.candidates(logits)
+        if indices is not None:
+            probs = torch.zeros(logits.shape, dtype=probs.dtype, device=probs.device).scatter(-1, indices, probs)
+        return probs / probs.sum(dim=-1, keepdim=True)
+
+    def sample(self, logits):
+        """Sample the next token of every row of (B, vocab) logits, returns (B, 1) token ids."""
+        if self.greedy:
+            return torch.argmax(logits, dim=-1, keepdim=True)
+        probs, indices = self.candidates(logits)
+        choice = torch.multinomial(probs, num_samples=1)
+        if indices is None:
+            return choice
+        return indices.gather(-1, choice)